@@ -0,0 +1,146 @@
+import asyncio
+import os
+
+from bgp_simulation import BGP_Router, get_router_config, BGP_PORT
+from messages.codec import BGP_OPEN, WIRE_BINARY
+from messages.framing import unpack_header
+from messages.message_base import BGP_HEADER_LEN
+from utils import logs
+from utils.timer_wheel import TimerWheel
+
+# Seconds another thread, such as a metrics scrape, waits for the loop to read router state
+READ_STATE_TIMEOUT = 5.0
+
+
+class AsyncBGPRouter(BGP_Router):
+    """ BGP router running every neighbor session as a coroutine on one event loop.
+
+        Each session has its own StreamReader/StreamWriter, the timer wheel
+        driving keepalives, hold timers, MRAI, voting and trust decay is
+        advanced by a callback on the loop every tick, and every RIB
+        mutation runs on the loop thread, so they are serialized without locks.
+        `self.sockets` maps neighbor IDs to StreamWriters.
+    """
+    def start_router(self):
+        """Sessions and timers are started by `run` once an event loop is running."""
+        self.loop = None
+        self.timers = TimerWheel()
+
+    async def run(self):
+        """Listen, connect to the neighbors and serve until cancelled."""
+        self.loop = asyncio.get_running_loop()
+        self.start_metrics()
+        self.start_profiling(self.loop)
+        server = await asyncio.start_server(self.accept_neighbor, self.ip, BGP_PORT)
+        self.log.info("Router %s listening for neighbors on %s...", self.router_id, self.ip)
+
+        await asyncio.sleep(5)
+        for neighbor_id in self.neighbors:
+            self.loop.create_task(self.connect_to_neighbor(neighbor_id))
+
+        self.loop.call_soon(self.advance_timers)
+        self.start_timers()
+        self.start_restart_timers()
+        self.log.info("All sessions and timers started for Router %s", self.router_id)
+
+        async with server:
+            await server.serve_forever()
+
+    def advance_timers(self):
+        """Fire the timers that came due and come back next tick."""
+        self.timers.advance()
+        self.loop.call_later(self.timers.tick, self.advance_timers)
+
+    async def accept_neighbor(self, reader, writer):
+        """Handle a connection opened by a neighbor."""
+        neighbor_id = self.get_neighbor_by_ip(writer.get_extra_info('peername')[0])
+        if not neighbor_id:
+            writer.close()
+            return
+        self.log.info("Router %s accepted connection from Router %s.", self.router_id, neighbor_id)
+        self.sockets[neighbor_id] = writer
+        self.start_session_timers(neighbor_id)
+        await self.handle_session(neighbor_id, reader, writer)
+
+    async def connect_to_neighbor(self, neighbor_id):
+        """Open a session to one neighbor and send our OPEN."""
+        neighbor_config = get_router_config(neighbor_id)
+        if not neighbor_config:
+            return
+        try:
+            reader, writer = await asyncio.open_connection(
+                neighbor_config['ip'], BGP_PORT, local_addr=(self.ip, 0)
+            )
+        except OSError as e:
+            self.log.warning("Router %s failed to connect to Router %s: %s", self.router_id, neighbor_id, e)
+            return
+        self.log.info("Router %s connected to Router %s at %s.", self.router_id, neighbor_id, neighbor_config['ip'])
+        self.sockets[neighbor_id] = writer
+        self.start_session_timers(neighbor_id)
+        self.open_sent.add(neighbor_id)
+        self.send_message(writer, BGP_OPEN)
+        await self.handle_session(neighbor_id, reader, writer)
+
+    async def handle_session(self, neighbor_id, reader, writer):
+        """Read framed messages from one neighbor until the connection closes."""
+        try:
+            while True:
+                header = await reader.readexactly(BGP_HEADER_LEN)
+                length, frame_type = unpack_header(header)
+                body = await reader.readexactly(length - BGP_HEADER_LEN)
+                for message in self.codec.decode(frame_type, body):
+                    self.process_message(neighbor_id, message)
+        except asyncio.IncompleteReadError:
+            self.log.info("Router %s closed the connection.", neighbor_id)
+        except Exception as e:
+            self.log.error("Error receiving data from Router %s: %s", neighbor_id, e)
+        finally:
+            if self.sockets.get(neighbor_id) is writer:
+                self.session_closed(neighbor_id)
+                self.sockets.pop(neighbor_id, None)
+            writer.close()
+
+    def send_message(self, writer, msg_type, payload=None, wire_format=WIRE_BINARY):
+        """ Queue a BGP message on a neighbor's writer; this never blocks the loop.
+            A neighbor whose transport has more than the send queue limit
+            still buffered is not keeping up, and has its session reset."""
+        if writer.is_closing():
+            self.send_errors += 1
+            self.log.warning("Error: connection to neighbor is closing.")
+            return False
+        if writer.transport.get_write_buffer_size() > self.send_queue_limit:
+            self.send_errors += 1
+            neighbor_id = next((peer for peer, peer_writer in self.sockets.items() if peer_writer is writer), None)
+            self.reset_session(neighbor_id, writer, "it is not keeping up with the messages sent to it")
+            return False
+        writer.writelines(self.codec.encode(msg_type, payload, wire_format))
+        return True
+
+    def read_state(self, function):
+        """Call `function` on the loop thread, where every RIB mutation runs, and wait for its result."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self.loop is None or running is self.loop:
+            return function()
+
+        async def call():
+            return function()
+
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result(READ_STATE_TIMEOUT)
+
+    def close_session_socket(self, writer):
+        """Drop what is still buffered; handle_session then sees the connection end."""
+        writer.transport.abort()
+
+    def send_queue_sizes(self):
+        return {
+            neighbor_id: writer.transport.get_write_buffer_size()
+            for neighbor_id, writer in list(self.sockets.items())
+        }
+
+
+if __name__ == "__main__":
+    logs.configure()
+    asyncio.run(AsyncBGPRouter(int(os.getenv("ROUTER_ID"))).run())
@@ -0,0 +1,98 @@
+""" Microbenchmark for the BgpMessageUpdate encoder.
+
+    Compares the former concatenating encoder (reproduced below as the
+    baseline) with the single pass `pack_into` encoder, one message at a
+    time and with many UPDATEs packed into one send buffer.
+
+    Run from the router directory:
+        python -m benchmarks.bench_codec [--messages N] [--prefixes N]
+"""
+import argparse
+import ipaddress
+import struct
+import time
+
+from messages.message_base import *
+
+
+def legacy_attr_pack(attr):
+    """Attribute encoder before the single pass rewrite: bytes concatenation per ASN."""
+    payload = struct.pack("!3B", attr.flags, attr.type.value, attr.length)
+    match attr.type:
+        case BgpAttributeType.ORIGIN:
+            payload += struct.pack("!B", attr.data['origin'])
+        case BgpAttributeType.AS_PATH:
+            packed_asns = bytes(0)
+            for _, asn in enumerate(attr.data['asns']):
+                packed_asns += struct.pack("!H", asn)
+            payload += struct.pack("!2B", attr.data['segment_type'], attr.data['length'])
+            payload += packed_asns
+        case BgpAttributeType.NEXT_HOP:
+            payload += struct.pack("!4s", attr.data['ip_addr'].packed)
+    return payload
+
+
+def legacy_pack(update):
+    """UPDATE encoder before the single pass rewrite: the payload is built three times per message."""
+    def payload():
+        packed_attr = bytes(0)
+        count = 0
+        for _, attr in enumerate(update.path_attributes):
+            count += 3 + attr.length
+            packed_attr += legacy_attr_pack(attr)
+        packed_nlri = bytes(0)
+        for _, nlri in enumerate(update.nlri):
+            addr_len = (nlri.prefixlen + 7) // 8
+            packed_nlri += struct.pack(f"!B{addr_len}s", nlri.prefixlen, nlri.network_address.packed[0:addr_len])
+        return struct.pack("!H", 0) + struct.pack("!H", count) + packed_attr + packed_nlri
+
+    length = 19 + (len(payload()) if payload() else 0)
+    byte_arr = bytearray()
+    byte_arr.extend(BGP_HEADER.pack(BGP_MARKER, length, update.msg_type.value))
+    byte_arr.extend(payload())
+    return bytes(byte_arr)
+
+
+def make_updates(count, prefixes_per_update):
+    updates = []
+    for i in range(count):
+        attrs = [
+            BgpPathAttribute(BgpAttributeType.ORIGIN.value, {"origin": 0}),
+            BgpPathAttribute(BgpAttributeType.AS_PATH.value, {"asns": [1, 2 + i % 50, 3, 4, 5]}),
+            BgpPathAttribute(BgpAttributeType.NEXT_HOP.value, {"ip_addr": ipaddress.IPv4Address("192.168.1.0")}),
+        ]
+        nlri = [
+            ipaddress.IPv4Network(((10 << 24) | ((i * prefixes_per_update + j) << 8), 24))
+            for j in range(prefixes_per_update)
+        ]
+        updates.append(BgpMessageUpdate(path_attributes=attrs, nlri=nlri))
+    return updates
+
+
+def measure(label, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed
+    print(f"{label:<32} {elapsed * 1000:9.1f} ms {rate:12.0f} msg/s")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--prefixes", type=int, default=8, help="NLRI prefixes per UPDATE")
+    args = parser.parse_args()
+
+    updates = make_updates(args.messages, args.prefixes)
+    assert all(legacy_pack(u) == u.pack() for u in updates[:100]), "encoders disagree"
+
+    print(f"{args.messages} UPDATEs, {args.prefixes} prefixes each")
+    before = measure("before: concatenation", lambda: [legacy_pack(u) for u in updates], args.messages)
+    after = measure("after: pack_into per message", lambda: [u.pack() for u in updates], args.messages)
+    batched = measure("after: pack_messages batch", lambda: pack_messages(updates), args.messages)
+    print(f"speedup: {after / before:.1f}x per message, {batched / before:.1f}x batched")
+
+
+if __name__ == "__main__":
+    main()
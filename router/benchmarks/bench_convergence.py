@@ -0,0 +1,142 @@
+""" Convergence benchmark over generated topologies.
+
+    Each case builds a topology, runs it in the in-process simulator until
+    no OPEN/UPDATE/WITHDRAW is in flight (so every route goes through
+    `process_message` and `propagate_routes`), and records:
+
+      - convergence time (virtual) and wall time
+      - messages sent, by type
+      - best-path computations per second of wall time
+      - peak memory while building and converging (tracemalloc, separate run)
+
+    Results are written as JSON with stable key order, so two runs can be
+    diffed directly or compared with --baseline.
+
+    Run from the router directory:
+        python -m benchmarks.bench_convergence [--cases ring:50,ba:200] [-o results.json]
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from benchmarks.topologies import generate
+from simulation import Simulation
+
+DEFAULT_CASES = "ring:50,mesh:20,ba:200,tiered:200"
+
+
+def converge(topology, latency):
+    simulation = Simulation(topology, latency=latency, voting=False)
+    simulation.start()
+    simulation.run_until_converged()
+    return simulation
+
+
+def run_case(kind, routers, seed=0, latency=0.01, memory=True, mrai=None):
+    """Benchmark one topology and return its result record."""
+    topology = generate(kind, routers, seed)
+    if mrai is not None:
+        topology['bgp_defaults']['mrai'] = mrai
+    links = sum(len(router['neighbors']) for router in topology['routers']) // 2
+
+    started = time.perf_counter()
+    simulation = converge(topology, latency)
+    wall_time = time.perf_counter() - started
+
+    selections = sum(router.rib.selections for router in simulation.routers.values())
+    result = {
+        "topology": kind,
+        "routers": routers,
+        "links": links,
+        "seed": seed,
+        "mrai": topology['bgp_defaults'].get('mrai', 0),
+        "convergence_time": simulation.last_route_change,
+        "wall_time": wall_time,
+        "messages_sent": dict(sorted(simulation.messages_sent.items())),
+        "messages_total": sum(simulation.messages_sent.values()),
+        "loc_rib_routes": sum(len(router.routing_table) for router in simulation.routers.values()),
+        "best_path_computations": selections,
+        "best_paths_per_second": selections / wall_time if wall_time else 0.0,
+    }
+    if memory:
+        # tracemalloc slows everything down, so memory gets a run of its own
+        del simulation
+        tracemalloc.start()
+        simulation = converge(topology, latency)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_memory_bytes"] = peak
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_cases(cases):
+    """Parse "ring:50,ba:200" into [("ring", 50), ("ba", 200)]."""
+    parsed = []
+    for case in cases.split(","):
+        kind, _, routers = case.partition(":")
+        parsed.append((kind.strip(), int(routers)))
+    return parsed
+
+
+def compare(results, baseline):
+    """Print how each case changed against a previous results file."""
+    previous = {(r["topology"], r["routers"], r["seed"]): r for r in baseline["results"]}
+    for result in results:
+        before = previous.get((result["topology"], result["routers"], result["seed"]))
+        if before is None:
+            continue
+        label = f"{result['topology']}:{result['routers']}"
+        for metric in ("wall_time", "messages_total", "peak_memory_bytes"):
+            if metric in result and before.get(metric):
+                print(f"{label:<16} {metric:<20} {before[metric]:>14.4g} -> {result[metric]:>14.4g} ({result[metric] / before[metric] - 1:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default=DEFAULT_CASES, help="comma separated topology:routers pairs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--mrai", type=float, default=None, help="override the topologies' MRAI")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("-o", "--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = []
+    for kind, routers in parse_cases(args.cases):
+        result = run_case(kind, routers, args.seed, args.latency, memory=not args.no_memory, mrai=args.mrai)
+        results.append(result)
+        print(
+            f"{kind + ':' + str(routers):<16} converged at {result['convergence_time']:8.3f}s virtual "
+            f"in {result['wall_time']:8.3f}s, {result['messages_total']:>9} messages, "
+            f"{result['best_paths_per_second']:>10.0f} best paths/s"
+        )
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+""" Route flap damping under a flapping link.
+
+    Converges a generated topology in the in-process simulator, then takes
+    one link down and up again `--flaps` times and counts the UPDATE and
+    WITHDRAW messages sent network-wide while it flaps, once without and
+    once with flap damping. Both runs then settle long enough for every
+    suppressed route to be reused, and their final Loc-RIBs are compared:
+    the same prefixes with the same AS path lengths (which of two equally
+    good paths wins depends on the order they arrived in).
+
+    The link is between the two best connected routers unless --link is
+    given. A failed link is only noticed when the hold timer expires, so
+    --down has to be longer than the topology's hold time.
+
+    Run from the router directory:
+        python -m benchmarks.bench_damping [--topology ba:100] [--flaps 8] [--half-life 60]
+"""
+import argparse
+import time
+
+from benchmarks.topologies import generate
+from simulation import Simulation
+
+ROUTE_MESSAGES = ("UPDATE", "WITHDRAW")
+
+
+def route_messages(simulation):
+    return sum(simulation.messages_sent.get(msg_type, 0) for msg_type in ROUTE_MESSAGES)
+
+
+def busiest_link(topology):
+    routers = sorted(topology['routers'], key=lambda router: len(router['neighbors']), reverse=True)
+    first = routers[0]
+    second = next(router for router in routers[1:] if router['id'] in first['neighbors'])
+    return first['id'], second['id']
+
+
+def flap(topology, link, flaps, down, up, settle, damping):
+    """Run one scenario and return (route messages while flapping, after settling, wall time, simulation)."""
+    topology['bgp_defaults'] = dict(topology['bgp_defaults'], damping=damping)
+    simulation = Simulation(topology, voting=False)
+    simulation.start()
+    simulation.run_until_converged()
+    before = route_messages(simulation)
+    started = time.perf_counter()
+    for _ in range(flaps):
+        simulation.fail_link(*link)
+        simulation.run(simulation.clock.now + down)
+        simulation.restore_link(*link)
+        simulation.run(simulation.clock.now + up)
+    flapping = route_messages(simulation) - before
+    simulation.run(simulation.clock.now + settle)
+    wall_time = time.perf_counter() - started
+    return flapping, route_messages(simulation) - before, wall_time, simulation
+
+
+def loc_ribs(simulation):
+    return {
+        router_id: {key: len(route.as_path) for key, route in router.routing_table.routes.items()}
+        for router_id, router in simulation.routers.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topology", default="ba:100", help="generator:routers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--link", default=None, help="the flapping link as A-B router IDs")
+    parser.add_argument("--flaps", type=int, default=8)
+    parser.add_argument("--down", type=float, default=15.0, help="seconds the link stays down per flap")
+    parser.add_argument("--up", type=float, default=15.0, help="seconds the link stays up per flap")
+    parser.add_argument("--half-life", type=float, default=60.0, help="damping half-life in seconds")
+    parser.add_argument("--max-suppress", type=float, default=240.0, help="longest suppression in seconds")
+    args = parser.parse_args()
+
+    kind, _, routers = args.topology.partition(":")
+    topology = generate(kind, int(routers), args.seed)
+    link = tuple(int(router_id) for router_id in args.link.split("-")) if args.link else busiest_link(topology)
+    damping = {"half_life": args.half_life, "max_suppress_time": args.max_suppress}
+    # Long enough for the longest suppressed route to be reused and its history forgotten
+    settle = args.max_suppress + 4 * args.half_life
+
+    results = {}
+    for label, setting in (("no damping", False), ("damping", damping)):
+        flapping, total, wall_time, simulation = flap(
+            generate(kind, int(routers), args.seed), link, args.flaps, args.down, args.up, settle, setting
+        )
+        results[label] = simulation
+        print(f"{label:<11} link {link[0]}-{link[1]}: {flapping:>7} UPDATE/WITHDRAW while flapping, "
+              f"{total:>7} including settling, {wall_time:6.2f}s wall")
+    same = loc_ribs(results["no damping"]) == loc_ribs(results["damping"])
+    print(f"final Loc-RIBs {'match' if same else 'differ'} after {settle:.0f}s of settling")
+
+
+if __name__ == "__main__":
+    main()
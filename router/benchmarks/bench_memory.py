@@ -0,0 +1,91 @@
+""" Memory per route of the route representations.
+
+    Builds the same synthetic table (distinct /24 prefixes spread over a
+    few neighbors and a few thousand distinct AS paths) three ways and
+    measures the bytes allocated per route with tracemalloc:
+
+      - dict:    the former layout, {"network": "10.0.1.0/24",
+                 "next_hop": "Router2", "as_path": ["AS2", "AS7", ...]}
+      - Route:   __slots__ records with integer fields and interned AS paths
+      - columns: RouteColumns typed arrays
+
+    The RoutingTable indexes (prefix dict and trie) are not included; they
+    are the same for every representation.
+
+    Run from the router directory:
+        python -m benchmarks.bench_memory [--routes 1000000] [--paths 5000]
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+
+from utils.path_attributes import intern_as_path
+from utils.route_store import RouteColumns
+from utils.routing_table import Route
+
+
+def synthetic_routes(count, distinct_paths, neighbors, seed=0):
+    """Yield (prefix as int, prefix length, neighbor ID, AS path as a list of ints)."""
+    rng = random.Random(seed)
+    paths = [
+        [neighbor] + [rng.randint(1, 65000) for _ in range(rng.randint(1, 6))]
+        for neighbor in (rng.randint(1, neighbors) for _ in range(distinct_paths))
+    ]
+    for i in range(count):
+        path = paths[rng.randrange(distinct_paths)]
+        yield ((1 << 24) + (i << 8)) & 0xffffffff, 24, path[0], path
+
+
+def build_dicts(routes):
+    table = []
+    for prefix, prefixlen, next_hop, as_path in routes:
+        network = f"{prefix >> 24}.{(prefix >> 16) & 255}.{(prefix >> 8) & 255}.{prefix & 255}/{prefixlen}"
+        table.append({
+            "network": network,
+            "next_hop": f"Router{next_hop}",
+            "as_path": [f"AS{asn}" for asn in as_path],
+        })
+    return table
+
+
+def build_records(routes):
+    return [
+        Route(prefix, prefixlen, next_hop, intern_as_path(as_path))
+        for prefix, prefixlen, next_hop, as_path in routes
+    ]
+
+
+def build_columns(routes):
+    return RouteColumns.from_routes(build_records(routes))
+
+
+def measure(build, routes):
+    """Bytes still allocated after building, divided by the number of routes."""
+    gc.collect()
+    tracemalloc.start()
+    table = build(routes)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+    return allocated / len(routes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", type=int, default=1_000_000)
+    parser.add_argument("--paths", type=int, default=5000, help="distinct AS paths")
+    parser.add_argument("--neighbors", type=int, default=32)
+    args = parser.parse_args()
+
+    routes = list(synthetic_routes(args.routes, args.paths, args.neighbors))
+    print(f"{args.routes} routes, {args.paths} distinct AS paths, {args.neighbors} neighbors")
+    baseline = None
+    for label, build in (("dict", build_dicts), ("Route", build_records), ("columns", build_columns)):
+        per_route = measure(build, routes)
+        baseline = baseline or per_route
+        print(f"{label:<8} {per_route:8.1f} bytes/route {per_route * args.routes / 2**20:9.1f} MiB {baseline / per_route:6.1f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
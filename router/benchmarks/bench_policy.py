@@ -0,0 +1,143 @@
+""" Import policy throughput at full table scale.
+
+    Builds a route map of --rules clauses, each matching a prefix list of
+    --entries entries and some on AS path attributes as well, then runs
+    --routes generated routes from a few thousand distinct AS paths
+    through it. The compiled engine (prefix lists in a trie, attribute
+    matches remembered per interned attribute set) is compared with the
+    same rules evaluated the straightforward way, reproduced below as the
+    baseline: every entry of every prefix list and every match tried in
+    turn for every route. The baseline only runs over --baseline-routes
+    routes, as it is too slow for a full table; both must reach the same
+    decisions on those.
+
+    Run from the router directory:
+        python -m benchmarks.bench_policy [--routes 1000000] [--rules 24] [--entries 50]
+"""
+import argparse
+import ipaddress
+import random
+import time
+
+from utils.path_attributes import attribute_cache
+from utils.policy import Policy
+
+
+def make_policies(rules, entries, rng):
+    prefix_lists = {}
+    clauses = []
+    for rule in range(rules):
+        name = f"list{rule}"
+        prefix_lists[name] = [
+            {
+                "seq": (entry + 1) * 5,
+                "action": "deny" if rng.random() < 0.1 else "permit",
+                "prefix": f"{rng.randrange(1, 224)}.{rng.randrange(256)}.0.0/{rng.choice((8, 12, 16))}",
+                "le": 24,
+            }
+            for entry in range(entries)
+        ]
+        match = {"prefix_list": name}
+        if rule % 3 == 1:
+            match["as_path_length_max"] = 4
+        if rule % 3 == 2:
+            match["as_path_contains"] = [rng.randrange(1, 2000) for _ in range(8)]
+        clauses.append({
+            "seq": (rule + 1) * 10,
+            "action": "deny" if rule % 5 == 4 else "permit",
+            "match": match,
+            "set": {"local_pref": 100 + rule},
+        })
+    clauses.append({"seq": (rules + 1) * 10, "action": "permit"})
+    return {
+        "prefix_lists": prefix_lists,
+        "route_maps": {"in": clauses},
+        "import": {"*": "in"},
+    }
+
+
+def make_routes(count, paths, rng):
+    as_paths = [tuple(rng.randrange(1, 2000) for _ in range(rng.randrange(1, 8))) for _ in range(paths)]
+    attributes = [attribute_cache.get(2, as_path) for as_path in as_paths]
+    return [
+        (ipaddress.IPv4Network((rng.randrange(1 << 24) << 8, 24)), rng.choice(attributes))
+        for _ in range(count)
+    ]
+
+
+class LinearPolicy:
+    """The same rules evaluated clause by clause and entry by entry for every route."""
+
+    def __init__(self, policies):
+        self.prefix_lists = {
+            name: [
+                (entry["seq"], entry["action"] == "permit", ipaddress.IPv4Network(entry["prefix"], strict=False), entry.get("le", 32))
+                for entry in entries
+            ]
+            for name, entries in policies["prefix_lists"].items()
+        }
+        self.clauses = policies["route_maps"]["in"]
+
+    def permits(self, name, key):
+        for seq, permit, network, le in sorted(self.prefix_lists[name], key=lambda entry: entry[0]):
+            if network.prefixlen <= key.prefixlen <= le and key.subnet_of(network):
+                return permit
+        return False
+
+    def apply(self, key, attributes):
+        for clause in self.clauses:
+            match = clause.get("match", {})
+            if "prefix_list" in match and not self.permits(match["prefix_list"], key):
+                continue
+            if "as_path_length_max" in match and len(attributes.as_path) > match["as_path_length_max"]:
+                continue
+            if "as_path_contains" in match and not set(match["as_path_contains"]) & set(attributes.as_path):
+                continue
+            if clause["action"] == "deny":
+                return None
+            return attribute_cache.replace(attributes, **clause.get("set", {}))
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", type=int, default=1_000_000)
+    parser.add_argument("--paths", type=int, default=5000, help="distinct AS paths among the routes")
+    parser.add_argument("--rules", type=int, default=24, help="route map clauses, each with its own prefix list")
+    parser.add_argument("--entries", type=int, default=50, help="entries per prefix list")
+    parser.add_argument("--baseline-routes", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    policies = make_policies(args.rules, args.entries, rng)
+    routes = make_routes(args.routes, args.paths, rng)
+
+    started = time.perf_counter()
+    policy = Policy.from_config(policies, 1)
+    compile_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = [policy.import_route(2, key, attributes) for key, attributes in routes]
+    compiled_time = time.perf_counter() - started
+    permitted = sum(result is not None for result in results)
+
+    sample = routes[:args.baseline_routes]
+    linear = LinearPolicy(policies)
+    started = time.perf_counter()
+    expected = [linear.apply(key, attributes) for key, attributes in sample]
+    linear_time = time.perf_counter() - started
+    same = expected == results[:len(sample)]
+
+    compiled_rate = len(routes) / compiled_time
+    linear_rate = len(sample) / linear_time
+    print(f"{args.rules} clauses x {args.entries} prefix list entries, compiled in {compile_time * 1000:.1f}ms")
+    print(f"compiled: {len(routes):>9} routes in {compiled_time:6.2f}s, {compiled_rate:>10,.0f} routes/s, "
+          f"{permitted} permitted")
+    print(f"linear:   {len(sample):>9} routes in {linear_time:6.2f}s, {linear_rate:>10,.0f} routes/s "
+          f"({compiled_rate / linear_rate:.0f}x slower)")
+    print(f"decisions {'match' if same else 'DIFFER'} on the {len(sample)} baseline routes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+""" Fan-out cost of sending UPDATEs to many peers.
+
+    Sends --messages UPDATEs to each of --peers peers connected over
+    loopback TCP, the way `propagate_routes` does: one message to every
+    peer in turn. The former `send_message`, reproduced below as the
+    baseline, calls `sendall` once per message from the propagating
+    thread; the per-peer send queues only append to the peer's queue and
+    leave the writing to its writer thread, which coalesces whatever has
+    queued into one `sendmsg`. For both, the time the propagating thread
+    is held up and the time until every peer has received everything are
+    reported, with the number of send calls made.
+
+    Finally one peer stops reading. The baseline then blocks the
+    propagating thread until its socket timeout (--stall-timeout), while
+    with send queues the other peers carry on and the stalled peer is
+    refused once its queue is full.
+
+    Run from the router directory:
+        python -m benchmarks.bench_send_queue [--peers 16] [--messages 30000]
+"""
+import argparse
+import ipaddress
+import socket
+import threading
+import time
+
+from messages.codec import BGP_UPDATE, MessageCodec
+from utils.send_queue import PeerSender
+
+STALLED_BUFFER = 64 << 10
+
+
+def make_frames(count):
+    codec = MessageCodec(1, "10.0.0.1", 90)
+    frames = []
+    for i in range(count):
+        routes = [
+            {"network": str(ipaddress.IPv4Network(((10 << 24) | ((i * 4 + j) << 8), 24))),
+             "next_hop": 1, "as_path": [1, 2 + i % 50, 3]}
+            for j in range(4)
+        ]
+        frames.append(codec.encode(BGP_UPDATE, routes))
+    return frames
+
+
+def connect_peers(count):
+    """[(our end, peer end)] of `count` loopback TCP connections."""
+    server = socket.create_server(("127.0.0.1", 0), backlog=count)
+    pairs = []
+    for _ in range(count):
+        ours = socket.create_connection(server.getsockname())
+        theirs, _ = server.accept()
+        pairs.append((ours, theirs))
+    server.close()
+    return pairs
+
+
+def start_readers(pairs, expected):
+    """A thread per peer reading until it has `expected` bytes."""
+    def read(sock):
+        received = 0
+        while received < expected:
+            data = sock.recv(1 << 16)
+            if not data:
+                return
+            received += len(data)
+
+    threads = [threading.Thread(target=read, args=(theirs,), daemon=True) for _, theirs in pairs]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def stall(pair):
+    """Keep the kernel from buffering megabytes for a peer that does not read, as loopback otherwise does."""
+    ours, theirs = pair
+    ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STALLED_BUFFER)
+    theirs.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, STALLED_BUFFER)
+
+
+def close(pairs):
+    for ours, theirs in pairs:
+        ours.close()
+        theirs.close()
+
+
+def run_sendall(frames, peers):
+    pairs = connect_peers(peers)
+    readers = start_readers(pairs, sum(len(b"".join(message)) for message in frames))
+    started = time.perf_counter()
+    for message in frames:
+        for ours, _ in pairs:
+            ours.sendall(b"".join(message))
+    held = time.perf_counter() - started
+    for thread in readers:
+        thread.join()
+    delivered = time.perf_counter() - started
+    close(pairs)
+    return held, delivered, len(frames) * peers
+
+
+def run_queued(frames, peers):
+    pairs = connect_peers(peers)
+    readers = start_readers(pairs, sum(len(b"".join(message)) for message in frames))
+    senders = [PeerSender(ours, peer, limit=1 << 30) for peer, (ours, _) in enumerate(pairs)]
+    started = time.perf_counter()
+    for message in frames:
+        for sender in senders:
+            sender.put(message)
+    held = time.perf_counter() - started
+    for thread in readers:
+        thread.join()
+    delivered = time.perf_counter() - started
+    writes = sum(sender.writes for sender in senders)
+    for sender in senders:
+        sender.close()
+    close(pairs)
+    return held, delivered, writes
+
+
+def stall_sendall(frames, peers, timeout):
+    pairs = connect_peers(peers)
+    start_readers(pairs[1:], sum(len(b"".join(message)) for message in frames))
+    stall(pairs[0])
+    pairs[0][0].settimeout(timeout)
+    started = time.perf_counter()
+    sent = 0
+    try:
+        for message in frames:
+            for ours, _ in pairs:
+                ours.sendall(b"".join(message))
+            sent += 1
+    except socket.timeout:
+        pass
+    held = time.perf_counter() - started
+    close(pairs)
+    return held, sent
+
+
+def stall_queued(frames, peers, limit):
+    pairs = connect_peers(peers)
+    readers = start_readers(pairs[1:], sum(len(b"".join(message)) for message in frames))
+    stall(pairs[0])
+    senders = [PeerSender(ours, peer, limit=limit) for peer, (ours, _) in enumerate(pairs)]
+    refused_at = None
+    started = time.perf_counter()
+    for i, message in enumerate(frames):
+        for peer, sender in enumerate(senders):
+            if not sender.put(message) and peer == 0 and refused_at is None:
+                refused_at = i
+    held = time.perf_counter() - started
+    for thread in readers:
+        thread.join()
+    for sender in senders:
+        sender.close()
+    close(pairs)
+    return held, refused_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--peers", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=30000, help="UPDATEs sent to every peer")
+    parser.add_argument("--stall-timeout", type=float, default=2.0, help="socket timeout of the stalled baseline peer")
+    parser.add_argument("--limit", type=int, default=256 << 10, help="send queue limit in bytes for the stall run")
+    args = parser.parse_args()
+
+    frames = make_frames(args.messages)
+    size = sum(len(b"".join(message)) for message in frames)
+    print(f"{args.messages} UPDATEs ({size / 1024:.0f} KiB) to each of {args.peers} peers")
+    for label, run in (("sendall per message", run_sendall), ("send queues", run_queued)):
+        held, delivered, calls = run(frames, args.peers)
+        print(f"{label:<20} propagating thread held {held * 1000:8.1f} ms, "
+              f"all delivered in {delivered * 1000:8.1f} ms, {calls:>7} send calls")
+
+    print("one peer stops reading:")
+    held, sent = stall_sendall(frames, args.peers, args.stall_timeout)
+    print(f"{'sendall per message':<20} propagating thread held {held * 1000:8.1f} ms, "
+          f"blocked after {sent} of {args.messages} messages")
+    held, refused_at = stall_queued(frames, args.peers, args.limit)
+    refused = "never" if refused_at is None else f"from message {refused_at}"
+    print(f"{'send queues':<20} propagating thread held {held * 1000:8.1f} ms, "
+          f"every message sent to the others, stalled peer refused {refused}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+""" Topology generators producing configs in the config.json schema.
+
+    Every generator returns an undirected graph as {router ID: set of
+    neighbor IDs}; `to_config` turns a graph into a topology that
+    `Simulation`, `run_sharded` or the router runtimes can load.
+
+    Run from the router directory to write one out:
+        python -m benchmarks.topologies ba 1000 -o topology.json
+"""
+import argparse
+import ipaddress
+import json
+import random
+
+DEFAULT_BGP_DEFAULTS = {"hold_timer": 10, "keepalive_interval": 3, "as_path_limit": 10, "mrai": 1, "wire_format": "binary"}
+
+
+def empty_graph(n):
+    return {router_id: set() for router_id in range(1, n + 1)}
+
+
+def connect(graph, a, b):
+    if a != b:
+        graph[a].add(b)
+        graph[b].add(a)
+
+
+def ring(n):
+    """Every router peers with the next one, and the last with the first."""
+    graph = empty_graph(n)
+    for router_id in range(1, n + 1):
+        connect(graph, router_id, router_id % n + 1)
+    return graph
+
+
+def full_mesh(n):
+    """Every router peers with every other router."""
+    graph = empty_graph(n)
+    for a in range(1, n + 1):
+        for b in range(a + 1, n + 1):
+            connect(graph, a, b)
+    return graph
+
+
+def barabasi_albert(n, m=2, seed=0):
+    """ Preferential attachment: each new router peers with `m` existing
+        routers picked proportionally to their degree, giving the heavy tailed
+        degree distribution of the Internet AS graph."""
+    rng = random.Random(seed)
+    graph = empty_graph(n)
+    # every router appears once per link it has, so a uniform pick is degree weighted
+    endpoints = []
+    for a in range(1, min(m + 1, n) + 1):
+        for b in range(a + 1, min(m + 1, n) + 1):
+            connect(graph, a, b)
+            endpoints += [a, b]
+    for router_id in range(m + 2, n + 1):
+        targets = set()
+        while len(targets) < m:
+            targets.add(rng.choice(endpoints))
+        for target in targets:
+            connect(graph, router_id, target)
+            endpoints += [router_id, target]
+    return graph
+
+
+def tiered(n, seed=0):
+    """ CAIDA-like AS hierarchy: a full mesh of tier-1 transit providers,
+        tier-2 providers multi-homed to tier 1 and peering with each other, and
+        stub ASes hanging off one or two tier-2 providers."""
+    rng = random.Random(seed)
+    graph = empty_graph(n)
+    tier1 = list(range(1, min(max(3, n // 100), n) + 1))
+    tier2 = list(range(len(tier1) + 1, min(len(tier1) + max(1, n // 10), n) + 1))
+    stubs = list(range(len(tier1) + len(tier2) + 1, n + 1))
+
+    for i, a in enumerate(tier1):
+        for b in tier1[i + 1:]:
+            connect(graph, a, b)
+    for router_id in tier2:
+        for provider in rng.sample(tier1, min(2, len(tier1))):
+            connect(graph, router_id, provider)
+        if len(tier2) > 1 and rng.random() < 0.5:
+            connect(graph, router_id, rng.choice(tier2))
+    providers = tier2 or tier1
+    for router_id in stubs:
+        homes = 2 if rng.random() < 0.3 else 1
+        for provider in rng.sample(providers, min(homes, len(providers))):
+            connect(graph, router_id, provider)
+    return graph
+
+
+GENERATORS = {
+    "ring": ring,
+    "mesh": full_mesh,
+    "ba": barabasi_albert,
+    "tiered": tiered,
+}
+
+
+def router_network(router_id):
+    """The /24 originated by a router: 10.0.1.0/24 for router 1, 10.0.2.0/24 for router 2 and so on."""
+    return ipaddress.IPv4Network(((10 << 24) + (router_id << 8), 24))
+
+
+def to_config(graph, bgp_defaults=None, seed=0):
+    """ Build a config.json style topology from a graph.
+
+        Like the hand written config.json, each router starts out with the
+        networks of its direct neighbors in its routing table and is given a
+        random direct trust.
+    """
+    rng = random.Random(seed)
+    routers = []
+    for router_id in sorted(graph):
+        neighbors = sorted(graph[router_id])
+        routers.append({
+            "id": router_id,
+            "ip": str(router_network(router_id).network_address),
+            "neighbors": neighbors,
+            "policies": {"local_pref": 100, "multi_exit_disc": 0},
+            "trust": {"direct_trust": round(rng.uniform(0.5, 1.0), 2)},
+            "routing_table": [
+                {
+                    "network": str(router_network(neighbor_id)),
+                    "next_hop": f"Router{neighbor_id}",
+                    "as_path": [f"AS{router_id}", f"AS{neighbor_id}"],
+                }
+                for neighbor_id in neighbors
+            ],
+        })
+    return {
+        "bgp_defaults": dict(bgp_defaults if bgp_defaults is not None else DEFAULT_BGP_DEFAULTS),
+        "routers": routers,
+    }
+
+
+def generate(kind, n, seed=0):
+    """Generate a topology of `n` routers by generator name."""
+    if kind not in GENERATORS:
+        raise ValueError(f"unknown topology {kind}, expected one of {', '.join(GENERATORS)}")
+    generator = GENERATORS[kind]
+    graph = generator(n) if kind in ("ring", "mesh") else generator(n, seed=seed)
+    return to_config(graph, seed=seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=sorted(GENERATORS))
+    parser.add_argument("routers", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="-", help="file to write, - for stdout")
+    args = parser.parse_args()
+
+    topology = generate(args.kind, args.routers, args.seed)
+    if args.output == "-":
+        print(json.dumps(topology, indent=2))
+    else:
+        with open(args.output, "w") as output:
+            json.dump(topology, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,102 @@
-import json
 import socket
 import threading
 import time
 import os
 
-from utils.routing_table import RoutingTable
+from utils.rib import Rib
+from messages.framing import MessageReader
+from messages.codec import (
+    MessageCodec, BGP_OPEN, BGP_KEEPALIVE, BGP_UPDATE, BGP_WITHDRAW, BGP_VOTE, BGP_END_OF_RIB, WIRE_BINARY,
+)
 from trust.trust_model import TrustModel
 from trust.vote_mechanism import VotingMechanism
-
-with open('config.json') as config_file:
-    config = json.load(config_file)
+from utils import logs
+from utils.damping import FlapDamping
+from utils.metrics import MetricsRegistry, parse_address, serve
+from utils.mrt import MrtError, read_routes
+from utils.profiling import Profiler
+from utils.path_attributes import DEFAULT_LOCAL_PREF
+from utils.policy import Policy
+from utils.route_store import CheckpointError
+from utils.send_queue import SEND_QUEUE_LIMIT, PeerSender, shutdown_socket
+from utils.timer_wheel import TimerWheel
+from utils.topology import get_topology
 
 def get_router_config(router_id):
     """Get router configuration based on its ID."""
-    for router in config['routers']:
-        if router['id'] == router_id:
-            return router
-    return None
-
-BGP_OPEN = "OPEN"
-BGP_KEEPALIVE = "KEEPALIVE"
-BGP_UPDATE = "UPDATE"
-BGP_WITHDRAW = "WITHDRAW"
+    return get_topology().router(router_id)
 
-HOLD_TIMER = config['bgp_defaults']['hold_timer']
-KEEPALIVE_INTERVAL = config['bgp_defaults']['keepalive_interval']
+VOTING_INTERVAL = 30
+# Voted trust fades by TRUST_DECAY_RATE every TRUST_DECAY_INTERVAL seconds unless votes renew it
+TRUST_DECAY_INTERVAL = 60
+TRUST_DECAY_RATE = 0.01
+# Seconds a restarting peer's routes are kept as stale waiting for its End-of-RIB (RFC 4724 restart time)
+GRACEFUL_RESTART_TIME = 120
+CHECKPOINT_INTERVAL = 60
+BGP_PORT = 179
 
 class BGP_Router:
-    def __init__(self, router_id):
-        self.config = get_router_config(router_id)
+    def __init__(self, router_id, router_config=None, bgp_defaults=None):
+        self.config = router_config if router_config is not None else get_router_config(router_id)
+        bgp_defaults = bgp_defaults if bgp_defaults is not None else get_topology().bgp_defaults
+        self.hold_timer = bgp_defaults['hold_timer']
+        self.keepalive_interval = bgp_defaults['keepalive_interval']
+        # Minimum Route Advertisement Interval; 0 sends every change right away
+        self.mrai = bgp_defaults.get('mrai', 0)
+        self.restart_time = bgp_defaults.get('graceful_restart_time', GRACEFUL_RESTART_TIME)
         self.router_id = self.config['id']
+        self.log = logs.router_logger(self.router_id)
         self.ip = self.config['ip']
         self.neighbors = self.config['neighbors']
-        self.routing_table = RoutingTable(self.router_id)
         self.trust_model = TrustModel(self.config['trust']['direct_trust'])
+        self.local_as = f"AS{self.router_id}"
+        policies = self.config.get('policies', {})
+        self.rib = Rib(
+            self.router_id, self.trust_model, self.local_as,
+            policy=Policy.from_config(policies, self.router_id),
+            local_pref=policies.get('local_pref', DEFAULT_LOCAL_PREF),
+            med=policies.get('multi_exit_disc', 0),
+        )
+        if bgp_defaults.get('damping'):
+            # Route flap damping, off unless bgp_defaults has "damping": true or a dict of its settings
+            self.rib.damping = FlapDamping.from_config(
+                bgp_defaults['damping'], clock=self.now, schedule=self.start_timer, on_reuse=self.reuse_route
+            )
+        self.routing_table = self.rib.loc_rib
         self.voting_mechanism = VotingMechanism(self.router_id, self.neighbors)
+        self.rib.listeners.append(self.voting_mechanism.route_changed)
         self.sockets = {}
-        self.keepalive_received = {}
+        # Threaded runtime: session socket -> PeerSender whose writer thread sends on it
+        self.senders = {}
+        # Bytes a neighbor may have waiting to be sent before its session is reset
+        self.send_queue_limit = bgp_defaults.get('send_queue_limit', SEND_QUEUE_LIMIT)
+        self.keepalive_received = {}  # neighbor_id -> when we last heard from it
+        self.keepalive_timers = {}
+        self.hold_timers = {}
         self.down_routers = set()
-
+        self.codec = MessageCodec(
+            self.router_id, self.ip, self.hold_timer, bgp_defaults.get('wire_format', WIRE_BINARY), self.restart_time
+        )
+        self.wire_formats = {}  # neighbor_id -> wire format negotiated in the OPEN exchange
+        self.open_sent = set()
+        self.vote_peers = set()  # neighbors that advertised the VOTE capability
+        self.peer_restart_times = {}  # neighbor_id -> restart time it advertised with Graceful Restart
+        self.stale_timers = {}
+        # Loc-RIB checkpoint restored at startup and rewritten every CHECKPOINT_INTERVAL
+        self.checkpoint_path = self.config.get('checkpoint') or os.getenv("BGP_CHECKPOINT")
+        self.last_advertised = {}  # neighbor_id -> when its MRAI timer last fired
+        self.flush_scheduled = set()
+        # Serializes RIB mutations between the per-neighbor threads of the threaded runtime
+        self.rib_lock = threading.RLock()
+        # Metrics are off unless config.json or BGP_METRICS gives a port or host:port to serve them on
+        self.metrics_address = self.config.get('metrics') or os.getenv("BGP_METRICS")
+        self.metrics = None  # MetricsRegistry the router reports to, see enable_metrics
+        self.metrics_server = None
+        self.send_errors = 0
+        self.profiler = None  # set up by start_profiling
 
         self.initialize_routing_table()
+        self.restore_checkpoint()
 
         self.start_router()
 
@@ -50,12 +106,84 @@ class BGP_Router:
             network = route['network']
             next_hop = route['next_hop']
             as_path = route['as_path']
-            self.routing_table.add_route(network, next_hop, as_path)
+            self.rib.add_static_route(network, next_hop, as_path)
+        if self.config.get('mrt'):
+            self.load_mrt(self.config['mrt'], self.config.get('mrt_peer'))
         self.routing_table.print_routing_table()
 
+    def load_mrt(self, path, peer=None):
+        """Seed the RIB from an MRT TABLE_DUMP_V2 file, optionally with only one peer's routes."""
+        try:
+            changes = self.rib.load_routes(read_routes(path, peer))
+        except (OSError, MrtError) as e:
+            self.log.warning("Router %s could not load all of MRT dump %s, keeping the routes read before: %s", self.router_id, path, e)
+            return
+        self.log.info("Router %s loaded %d routes from %s.", self.router_id, len(changes), path)
+
+    def restore_checkpoint(self):
+        """Warm restart: load the last checkpoint as stale routes, to be swept by each neighbor's End-of-RIB."""
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return
+        try:
+            routes = self.routing_table.read_checkpoint(self.checkpoint_path)
+        except (OSError, CheckpointError) as e:
+            self.log.warning("Router %s ignored checkpoint %s: %s", self.router_id, self.checkpoint_path, e)
+            return
+        self.rib.restore(routes)
+        self.log.info("Router %s restored %d routes from %s.", self.router_id, len(routes), self.checkpoint_path)
+
+    def checkpoint(self):
+        """Write the Loc-RIB to the checkpoint file."""
+        try:
+            self.routing_table.checkpoint(self.checkpoint_path)
+        except OSError as e:
+            self.log.warning("Router %s could not write checkpoint %s: %s", self.router_id, self.checkpoint_path, e)
+
+    def now(self):
+        """Current time, as used for KEEPALIVE and hold timer bookkeeping."""
+        return time.time()
+
+    def start_timer(self, delay, callback, *args):
+        """Run `callback` after `delay` seconds on the timer wheel. Returns a timer with `cancel()`."""
+        return self.timers.schedule(delay, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        """Run `callback` after `delay` seconds, holding the RIB lock like every timer."""
+        self.start_timer(delay, callback, *args)
+
+    def schedule_periodic(self, interval, callback):
+        """Run `callback` every `interval` seconds."""
+        def tick():
+            self.start_timer(interval, tick)
+            callback()
+
+        self.start_timer(interval, tick)
+
+    def start_timers(self):
+        """Start the router wide periodic timers: voting and trust decay."""
+        self.schedule_periodic(VOTING_INTERVAL, self.exchange_votes)
+        self.schedule_periodic(TRUST_DECAY_INTERVAL, self.decay_trust)
+
+    def start_restart_timers(self):
+        """Give restored stale routes their restart timers and start checkpointing."""
+        for neighbor_id in list(self.rib.stale):
+            self.start_stale_timer(neighbor_id)
+        if self.checkpoint_path:
+            self.schedule_periodic(CHECKPOINT_INTERVAL, self.checkpoint)
+
     def start_router(self):
-        """Start all router threads for communication and operations."""
-        
+        """ Start the listener and the timer thread, then connect to the neighbors.
+
+            One thread advances a timer wheel that drives every keepalive,
+            hold timer, MRAI timer and the voting and trust decay rounds.
+        """
+        self.start_metrics()
+        self.start_profiling()
+        self.timers = TimerWheel()
+        timer_thread = threading.Thread(target=self.timers.run, args=(self.rib_lock,))
+        timer_thread.daemon = True
+        timer_thread.start()
+
         listener_thread = threading.Thread(target=self.listen_for_neighbors)
         listener_thread.daemon = True
         listener_thread.start()
@@ -63,44 +191,214 @@ class BGP_Router:
         time.sleep(5) 
         self.connect_to_neighbors()
 
-        keepalive_thread = threading.Thread(target=self.send_keepalive)
-        keepalive_thread.daemon = True
-        keepalive_thread.start()
-
-        voting_thread = threading.Thread(target=self.exchange_votes_with_neighbors)
-        voting_thread.daemon = True
-        voting_thread.start()
-
-        failure_detection_thread = threading.Thread(target=self.check_for_neighbor_failures)
-        failure_detection_thread.daemon = True
-        failure_detection_thread.start()
+        with self.rib_lock:
+            self.start_timers()
+            self.start_restart_timers()
 
         thread_monitor = threading.Thread(target=self.check_threads)
         thread_monitor.daemon = True
         thread_monitor.start()
-        print(f"All threads started for Router {self.router_id}")
+        self.log.info("All threads started for Router %s", self.router_id)
     
+    def start_metrics(self):
+        """Serve the router's metrics on its metrics address, if it has one."""
+        if not self.metrics_address:
+            return
+        registry = MetricsRegistry()
+        try:
+            self.metrics_server = serve(registry, *parse_address(self.metrics_address))
+        except (OSError, ValueError) as e:
+            self.log.warning("Router %s could not serve metrics on %s: %s", self.router_id, self.metrics_address, e)
+            return
+        self.enable_metrics(registry)
+
+    def start_profiling(self, loop=None):
+        """Opt-in profiling (see utils.profiling): SIGUSR1 toggles it, BGP_PROFILE=1 starts it right away."""
+        try:
+            self.profiler = Profiler.from_environment(self)
+        except ValueError as e:
+            self.log.warning("Router %s cannot profile: %s", self.router_id, e)
+            return
+        self.profiler.install_signal(loop=loop)
+        if os.getenv("BGP_PROFILE", "0") not in ("", "0"):
+            self.profiler.start()
+
+    def enable_metrics(self, registry):
+        """ Report to `registry`, labelled with the router ID.
+
+            `process_message`, `send_message`, the codec's `encode` and the
+            RIB's `get_best_route` are replaced on this router by timed and
+            counted versions, so a router that never calls this runs exactly
+            the code it did before. Sizes, session state and trust are read
+            only when the metrics are.
+        """
+        self.metrics = registry
+        router = str(self.router_id)
+        perf_counter = time.perf_counter
+
+        processing = registry.histogram(
+            "bgp_message_processing_seconds", "Time to process a message, including what it sends", ("router", "type")
+        )
+        sent = registry.counter("bgp_messages_sent_total", "Messages sent, by type", ("router", "type"))
+        sent_bytes = registry.counter("bgp_sent_bytes_total", "Bytes of the messages sent, by message type", ("router", "type"))
+        lookups = registry.counter("bgp_best_route_lookups_total", "Best route lookups", ("router",)).labels(router)
+        lookup_time = registry.counter(
+            "bgp_best_route_lookup_seconds_total", "Time spent in best route lookups", ("router",)
+        ).labels(router)
+        processing_by_type = {}
+        sent_by_type = {}
+        bytes_by_type = {}
+
+        process_message = self.process_message
+
+        def timed_process_message(neighbor_id, message):
+            msg_type = message['type']
+            child = processing_by_type.get(msg_type)
+            if child is None:
+                child = processing_by_type[msg_type] = processing.labels(router, msg_type)
+            started = perf_counter()
+            process_message(neighbor_id, message)
+            child.observe(perf_counter() - started)
+
+        send_message = self.send_message
+        # Bytes of the message being sent, encoded inside send_message but only counted once it was accepted
+        encoded = threading.local()
+
+        def counted_send_message(sock, msg_type, *args, **kwargs):
+            encoded.size = 0
+            if not send_message(sock, msg_type, *args, **kwargs):
+                return False
+            child = sent_by_type.get(msg_type)
+            if child is None:
+                child = sent_by_type[msg_type] = sent.labels(router, msg_type)
+            child.value += 1
+            if encoded.size:
+                child = bytes_by_type.get(msg_type)
+                if child is None:
+                    child = bytes_by_type[msg_type] = sent_bytes.labels(router, msg_type)
+                child.value += encoded.size
+            return True
+
+        encode = self.codec.encode
+
+        def counted_encode(msg_type, *args, **kwargs):
+            frames = encode(msg_type, *args, **kwargs)
+            encoded.size = sum(len(data) for data in frames)
+            return frames
+
+        get_best_route = self.rib.get_best_route
+
+        def timed_get_best_route(network):
+            started = perf_counter()
+            route = get_best_route(network)
+            lookup_time.value += perf_counter() - started
+            lookups.value += 1
+            return route
+
+        self.process_message = timed_process_message
+        self.send_message = counted_send_message
+        self.codec.encode = counted_encode
+        self.rib.get_best_route = timed_get_best_route
+
+        owner = self.router_id
+        # The histogram counts every message processed already
+        registry.counter(
+            "bgp_messages_received_total", "Messages processed, by type", ("router", "type"),
+            lambda: {(router, msg_type): child.count for msg_type, child in list(processing_by_type.items())}, owner,
+        )
+        registry.counter(
+            "bgp_send_errors_total", "Messages that could not be sent", ("router",),
+            lambda: {(router,): self.send_errors}, owner,
+        )
+        registry.counter(
+            "bgp_best_path_selections_total", "Best-path selections run", ("router",),
+            lambda: {(router,): self.rib.selections}, owner,
+        )
+        registry.counter(
+            "bgp_routes_rejected_total", "Learned routes rejected, by reason", ("router", "reason"),
+            lambda: {(router, "loop"): self.rib.loops_rejected, (router, "policy"): self.rib.filtered}, owner,
+        )
+        # The gauges below read the RIB, sessions and trust model, so they run
+        # as the router's own threads do (see read_state), never beside them
+        read_state = self.read_state
+        registry.gauge(
+            "bgp_loc_rib_routes", "Routes in the Loc-RIB", ("router",),
+            lambda: read_state(lambda: {(router,): len(self.routing_table)}), owner,
+        )
+        registry.gauge(
+            "bgp_adj_rib_in_routes", "Routes in the Adj-RIB-In, by neighbor", ("router", "neighbor"),
+            lambda: read_state(lambda: {
+                (router, neighbor_id): len(rib_in) for neighbor_id, rib_in in self.rib.adj_rib_in.items()
+            }),
+            owner,
+        )
+        registry.gauge(
+            "bgp_adj_rib_out_routes", "Routes advertised, by peer", ("router", "neighbor"),
+            lambda: read_state(lambda: {
+                (router, peer_id): len(rib_out) for peer_id, rib_out in self.rib.adj_rib_out.items()
+            }),
+            owner,
+        )
+        registry.gauge(
+            "bgp_session_up", "1 while the session to a neighbor is connected and not declared down",
+            ("router", "neighbor"), lambda: read_state(self.session_states), owner,
+        )
+        registry.gauge(
+            "bgp_send_queue_bytes", "Bytes waiting to be sent, by neighbor", ("router", "neighbor"),
+            lambda: read_state(lambda: {
+                (router, neighbor_id): size for neighbor_id, size in self.send_queue_sizes().items()
+            }),
+            owner,
+        )
+        registry.gauge(
+            "bgp_trust_score", "Total trust in a neighbor", ("router", "neighbor"),
+            lambda: read_state(lambda: {
+                (router, neighbor_id): score for neighbor_id, score in self.trust_model.score_map().items()
+            }),
+            owner,
+        )
+
+    def read_state(self, function):
+        """ Call `function` holding rib_lock, for reading router state from
+            another thread, e.g. a metrics scrape. The trust model caches its
+            totals as it computes them, so even reading it unlocked could
+            leave stale scores for best-path selection."""
+        with self.rib_lock:
+            return function()
+
+    def session_states(self):
+        """{(router, neighbor): 1 or 0} for the bgp_session_up gauge."""
+        return {
+            (str(self.router_id), neighbor_id): int(neighbor_id in self.sockets and neighbor_id not in self.down_routers)
+            for neighbor_id in self.neighbors
+        }
+
+    def send_queue_sizes(self):
+        """{neighbor_id: bytes queued for it and not yet sent}."""
+        return {sender.peer_id: sender.queued for sender in list(self.senders.values())}
+
     def check_threads(self):
         """Check if the critical threads are alive."""
         while True:
-            print("Checking threads...")
-            print(f"Keepalive thread is alive: {threading.current_thread().is_alive()}")
+            self.log.debug("Checking threads...")
+            self.log.debug("Keepalive thread is alive: %s", threading.current_thread().is_alive())
             time.sleep(60)
 
     def listen_for_neighbors(self):
         """Listen for connections from neighbor routers."""
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((self.ip, 179))  
+        server_socket.bind((self.ip, BGP_PORT))  
         server_socket.listen(5)
-        print(f"Router {self.router_id} listening for neighbors on {self.ip}...")
+        self.log.info("Router %s listening for neighbors on %s...", self.router_id, self.ip)
 
         while True:
             conn, addr = server_socket.accept()
             neighbor_id = self.get_neighbor_by_ip(addr[0])
             if neighbor_id:
-                print(f"Router {self.router_id} accepted connection from Router {neighbor_id}.")
-                self.sockets[neighbor_id] = conn
-                self.keepalive_received[neighbor_id] = time.time()
+                self.log.info("Router %s accepted connection from Router %s.", self.router_id, neighbor_id)
+                with self.rib_lock:
+                    self.attach_socket(neighbor_id, conn)
+                    self.start_session_timers(neighbor_id)
                 threading.Thread(target=self.handle_neighbor_messages, args=(neighbor_id, conn), daemon=True).start()
 
     def connect_to_neighbors(self):
@@ -111,186 +409,357 @@ class BGP_Router:
                 neighbor_ip = neighbor_config['ip']
                 try:
                     neighbor_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    neighbor_socket.connect((neighbor_ip, 179))
-                    print(f"Router {self.router_id} connected to Router {neighbor_id} at {neighbor_ip}.")
-                    self.sockets[neighbor_id] = neighbor_socket
-                    self.keepalive_received[neighbor_id] = time.time()
+                    neighbor_socket.connect((neighbor_ip, BGP_PORT))
+                    self.log.info("Router %s connected to Router %s at %s.", self.router_id, neighbor_id, neighbor_ip)
+                    with self.rib_lock:
+                        self.attach_socket(neighbor_id, neighbor_socket)
+                        self.start_session_timers(neighbor_id)
+                        # Send BGP OPEN message before reading, so an OPEN from the
+                        # neighbor that arrives first is not answered with a second one.
+                        # Under the lock, as a full send queue resets the session
+                        self.open_sent.add(neighbor_id)
+                        self.send_message(neighbor_socket, BGP_OPEN)
 
                     threading.Thread(target=self.handle_neighbor_messages, args=(neighbor_id, neighbor_socket)).start()
-
-                    # Send BGP OPEN message
-                    self.send_message(neighbor_socket, BGP_OPEN)
                 except Exception as e:
-                    print(f"Router {self.router_id} failed to connect to Router {neighbor_id}: {e}")
+                    self.log.warning("Router %s failed to connect to Router %s: %s", self.router_id, neighbor_id, e)
+
+    def attach_socket(self, neighbor_id, sock):
+        """Register a neighbor's session socket and start the writer thread that sends on it."""
+        previous = self.sockets.get(neighbor_id)
+        if previous is not None and previous is not sock:
+            self.close_sender(previous)
+        self.sockets[neighbor_id] = sock
+        self.senders[sock] = PeerSender(sock, neighbor_id, self.send_failed, self.send_queue_limit)
+
+    def release_socket(self, neighbor_id):
+        """Unregister a neighbor's session socket and stop its writer; returns the socket, if any."""
+        sock = self.sockets.pop(neighbor_id, None)
+        if sock is not None:
+            self.close_sender(sock)
+        return sock
+
+    def close_sender(self, sock):
+        sender = self.senders.pop(sock, None)
+        if sender is not None:
+            sender.close()
+
+    def send_message(self, sock, msg_type, payload=None, wire_format=WIRE_BINARY):
+        """ Queue a BGP message for the writer thread of a neighbor's socket;
+            this never waits on the socket. A neighbor too far behind to take
+            the message has its session reset instead. Returns whether the
+            message was queued."""
+        sender = self.senders.get(sock)
+        if sender is None:
+            self.log.debug("Router %s dropped a message for a session that was reset.", self.router_id)
+            return False
+        if not sender.put(self.codec.encode(msg_type, payload, wire_format)):
+            self.send_errors += 1
+            self.reset_session(sender.peer_id, sock, "it is not keeping up with the messages sent to it")
+            return False
+        return True
+
+    def send_failed(self, neighbor_id, sock, error):
+        """Called from a writer thread when sending to a neighbor failed."""
+        with self.rib_lock:
+            self.send_errors += 1
+            self.reset_session(neighbor_id, sock, error)
+
+    def reset_session(self, neighbor_id, sock, reason):
+        """ Tear down a session that can no longer be sent on, then close its
+            socket so its receive loop ends too. A Graceful Restart capable
+            neighbor keeps its routes as stale, as when its transport closes."""
+        if neighbor_id is None or self.sockets.get(neighbor_id) is not sock:
+            return
+        self.log.warning("Router %s resets its session to Router %s: %s", self.router_id, neighbor_id, reason)
+        if self.peer_restart_times.get(neighbor_id):
+            self.session_closed(neighbor_id)
+        else:
+            self.session_down(neighbor_id)
+        self.close_session_socket(sock)
 
-    def send_message(self, sock, msg_type, payload=None):
-        """Send a BGP message to a neighbor."""
-        message = {"type": msg_type, "payload": payload}
-        try:
-            sock.sendall(json.dumps(message).encode())
-        except BrokenPipeError:
-            print(f"Error: Broken pipe when sending message to a neighbor.")
-        except Exception as e:
-            print(f"Error: {e}")
+    def close_session_socket(self, sock):
+        shutdown_socket(sock)
 
     def handle_neighbor_messages(self, neighbor_id, conn):
         """Handle messages from a connected neighbor."""
-        while True:
-            try:
-                data = conn.recv(1024)
-                if data:
-                    message = json.loads(data.decode())
-                    self.process_message(neighbor_id, message)
-            except Exception as e:
-                print(f"Error receiving data from Router {neighbor_id}: {e}")
-                break
+        try:
+            for frame_type, body in MessageReader(conn):
+                messages = self.codec.decode(frame_type, body)
+                with self.rib_lock:
+                    for message in messages:
+                        self.process_message(neighbor_id, message)
+            self.log.info("Router %s closed the connection.", neighbor_id)
+        except Exception as e:
+            self.log.error("Error receiving data from Router %s: %s", neighbor_id, e)
+        with self.rib_lock:
+            if self.sockets.get(neighbor_id) is conn:
+                self.session_closed(neighbor_id)
+
+    def establish_session(self, neighbor_id, open_payload):
+        """Answer a neighbor's OPEN, settle the session's wire format and send it our routes."""
+        wire_format = self.codec.negotiate(open_payload['capabilities'])
+        self.wire_formats[neighbor_id] = wire_format
+        if self.codec.supports_votes(open_payload['capabilities']):
+            self.vote_peers.add(neighbor_id)
+        else:
+            self.vote_peers.discard(neighbor_id)
+        restart_time = self.codec.peer_restart_time(open_payload['capabilities'])
+        if restart_time:
+            self.peer_restart_times[neighbor_id] = restart_time
+        else:
+            self.peer_restart_times.pop(neighbor_id, None)
+        self.down_routers.discard(neighbor_id)
+        self.log.info("Router %s established session with Router %s using %s encoding.", self.router_id, neighbor_id, wire_format)
+
+        sock = self.sockets.get(neighbor_id)
+        if sock is None:
+            return
+        if neighbor_id not in self.open_sent:
+            self.open_sent.add(neighbor_id)
+            self.send_message(sock, BGP_OPEN)
+        self.send_routing_table(neighbor_id, sock)
+        self.send_message(sock, BGP_END_OF_RIB, None, wire_format)
 
     def process_message(self, neighbor_id, message):
         """Process incoming BGP messages."""
         msg_type = message['type']
-        if msg_type == BGP_KEEPALIVE:
-            self.keepalive_received[neighbor_id] = time.time()
-            print(f"Router {self.router_id} received KEEPALIVE from Router {neighbor_id}.")
+        if neighbor_id in self.hold_timers:
+            self.reset_hold_timer(neighbor_id)
+        if msg_type == BGP_OPEN:
+            self.establish_session(neighbor_id, message['payload'])
+        elif msg_type == BGP_KEEPALIVE:
+            self.log.debug("Router %s received KEEPALIVE from Router %s.", self.router_id, neighbor_id)
         elif msg_type == BGP_UPDATE:
-            if self.find_best_route(message['payload'],neighbor_id):
-                print(f"Router {self.router_id} trusts Router {neighbor_id}, updating routing table.")
-                self.update_routing_table(neighbor_id, message['payload'])
-                self.propagate_routes(neighbor_id, message['payload'])
-            else:
-                print(f"Router {self.router_id} does not trust Router {neighbor_id}, ignoring update.")
+            changes = self.update_routing_table(neighbor_id, message['payload'])
+            self.propagate_routes(neighbor_id, changes)
         elif msg_type == BGP_WITHDRAW:
-            print(f"Router {self.router_id} received route withdrawal from Router {neighbor_id}.")
+            self.log.debug("Router %s received route withdrawal from Router %s.", self.router_id, neighbor_id)
             self.withdraw_routes(neighbor_id, message['payload'])
+        elif msg_type == BGP_VOTE:
+            self.receive_votes(neighbor_id, message['payload'])
+        elif msg_type == BGP_END_OF_RIB:
+            self.end_of_rib(neighbor_id)
 
     def update_routing_table(self, neighbor_id, routes):
-        """Update the routing table based on a neighbor's BGP UPDATE."""
-        for route in routes:
-            network = route['network']
-            next_hop = neighbor_id
-            as_path = route['as_path']
-            best_route=self.find_best_route(network,neighbor_id)
-            if best_route:
-                print(f"Router {self.router_id} updating existing route {network} via Router {neighbor_id}.")
-                self.routing_table.update_route(network, next_hop, as_path)
-            else:
-                print(f"Router {self.router_id} adding new route {network} via Router {neighbor_id}.")
-                self.routing_table.add_route(network, next_hop, as_path)
-
-    def propagate_routes(self, originating_neighbor, routes):
-        """Propagate routes learned from one neighbor to all other neighbors."""
-        for neighbor_id, sock in self.sockets.items():
-            if neighbor_id != originating_neighbor:
-                self.send_message(sock, BGP_UPDATE, routes)
-                print(f"Router {self.router_id} propagated routes to Router {neighbor_id}. Routes: {routes}")
+        """Store a neighbor's BGP UPDATE in its Adj-RIB-In and return the resulting Loc-RIB changes."""
+        changes = self.rib.update(neighbor_id, routes)
+        for network, best_route in changes:
+            self.log.debug("Router %s selected route %s via Router %s.", self.router_id, network, best_route.next_hop)
+        return changes
+
+    def propagate_routes(self, originating_neighbor, changes):
+        """ Advertise Loc-RIB changes to every neighbor whose Adj-RIB-Out differs.
+
+            With an MRAI configured, changes are queued per neighbor and sent
+            at most once per interval, so a prefix that changes several times
+            within it costs one announcement or withdrawal.
+        """
+        if not changes:
+            return
+        for neighbor_id, sock in list(self.sockets.items()):
+            if self.sockets.get(neighbor_id) is not sock:
+                continue  # reset while advertising to an earlier neighbor
+            if self.mrai <= 0:
+                self.advertise(neighbor_id, sock, changes)
+                continue
+            self.rib.enqueue(neighbor_id, changes)
+            if neighbor_id not in self.flush_scheduled:
+                self.flush_scheduled.add(neighbor_id)
+                elapsed = self.now() - self.last_advertised.get(neighbor_id, float("-inf"))
+                self.call_later(max(0.0, self.mrai - elapsed), self.flush_advertisements, neighbor_id)
+
+    def flush_advertisements(self, neighbor_id):
+        """MRAI timer: send a neighbor everything queued for it since the last advertisement."""
+        self.flush_scheduled.discard(neighbor_id)
+        self.last_advertised[neighbor_id] = self.now()
+        changes = self.rib.take_pending(neighbor_id)
+        sock = self.sockets.get(neighbor_id)
+        if changes and sock is not None:
+            self.advertise(neighbor_id, sock, changes)
+
+    def advertise(self, neighbor_id, sock, changes):
+        """Send a neighbor the announcements and withdrawals that Loc-RIB changes mean for it."""
+        announce, withdraw = self.rib.export(neighbor_id, changes)
+        wire_format = self.wire_formats.get(neighbor_id, WIRE_BINARY)
+        if announce:
+            self.send_message(sock, BGP_UPDATE, announce, wire_format)
+            self.log.debug("Router %s propagated routes to Router %s. Routes: %s", self.router_id, neighbor_id, announce)
+        if withdraw:
+            self.send_message(sock, BGP_WITHDRAW, withdraw, wire_format)
+            self.log.debug("Router %s propagated route withdrawal to Router %s.", self.router_id, neighbor_id)
+
+    def send_routing_table(self, neighbor_id, sock):
+        """Advertise the whole Loc-RIB to a newly connected neighbor."""
+        announce, _ = self.rib.export(neighbor_id, self.rib.full_table())
+        if announce:
+            self.send_message(sock, BGP_UPDATE, announce, self.wire_formats.get(neighbor_id, WIRE_BINARY))
 
     def withdraw_routes(self, neighbor_id, routes):
-        """Withdraw routes received from a neighbor."""
-        for route in routes:
-            network = route['network']
-            self.routing_table.remove_route(network)
-            print(f"Router {self.router_id} removed route {network} learned from Router {neighbor_id}.")
-        for neighbor, sock in self.sockets.items():
-            if neighbor != neighbor_id:
-                self.send_message(sock, BGP_WITHDRAW, routes)
-                print(f"Router {self.router_id} propagated route withdrawal to Router {neighbor}.")
-
-    def send_keepalive(self):
-        """Send KEEPALIVE messages to neighbors at regular intervals."""
-        while True: 
-            try:
-                for neighbor_id, sock in self.sockets.items():
-                    self.send_message(sock, BGP_KEEPALIVE)
-                    print(f"Router {self.router_id} sent KEEPALIVE to Router {neighbor_id}.")
-                time.sleep(KEEPALIVE_INTERVAL)
-            except Exception as e:
-                print(f"Error in keepalive thread: {e}")
-
-    def check_for_neighbor_failures(self):
-        """Periodically check if any neighbor has failed to send KEEPALIVE messages within the HOLD TIMER."""
-        while True:
-            try:
-                current_time = time.time()
-                for neighbor_id, last_keepalive_time in list(self.keepalive_received.items()):
-                    if current_time - last_keepalive_time > HOLD_TIMER:
-                        if neighbor_id not in self.down_routers:
-                            print(f"Router {self.router_id} has not received KEEPALIVE from Router {neighbor_id}. Declaring Router {neighbor_id} as down.")
-                            self.remove_neighbor_routes(neighbor_id)
-                            self.down_routers.add(neighbor_id)
-                            self.sockets.pop(neighbor_id, None)
-                time.sleep(HOLD_TIMER)
-            except Exception as e:
-                print(f"Error during neighbor failure check: {e}")
+        """Withdraw routes received from a neighbor, falling back to alternate paths where we have them."""
+        changes = self.rib.withdraw(neighbor_id, [route['network'] for route in routes])
+        for network, best_route in changes:
+            if best_route is None:
+                self.log.debug("Router %s removed route %s learned from Router %s.", self.router_id, network, neighbor_id)
+            else:
+                self.log.debug("Router %s failed over route %s to Router %s.", self.router_id, network, best_route.next_hop)
+        self.propagate_routes(neighbor_id, changes)
+
+    def reuse_route(self, network, neighbor_id):
+        """Flap damping stopped suppressing a neighbor's route: select and advertise it again if it wins."""
+        changes = self.rib.reuse(network, neighbor_id)
+        if changes:
+            self.log.debug("Router %s reused damped route %s from Router %s.", self.router_id, network, neighbor_id)
+        self.propagate_routes(neighbor_id, changes)
+
+    def start_session_timers(self, neighbor_id):
+        """Start sending a neighbor KEEPALIVEs and expecting messages from it within the hold time."""
+        self.stop_session_timers(neighbor_id)
+        self.keepalive_timers[neighbor_id] = self.start_timer(self.keepalive_interval, self.keepalive_due, neighbor_id)
+        self.reset_hold_timer(neighbor_id)
+
+    def stop_session_timers(self, neighbor_id):
+        for timers in (self.keepalive_timers, self.hold_timers):
+            timer = timers.pop(neighbor_id, None)
+            if timer is not None:
+                timer.cancel()
+
+    def keepalive_due(self, neighbor_id):
+        """Send a neighbor its KEEPALIVE and schedule the next one."""
+        sock = self.sockets.get(neighbor_id)
+        if sock is None:
+            self.keepalive_timers.pop(neighbor_id, None)
+            return
+        self.send_message(sock, BGP_KEEPALIVE)
+        self.log.debug("Router %s sent KEEPALIVE to Router %s.", self.router_id, neighbor_id)
+        self.keepalive_timers[neighbor_id] = self.start_timer(self.keepalive_interval, self.keepalive_due, neighbor_id)
+
+    def reset_hold_timer(self, neighbor_id):
+        """Restart a neighbor's hold timer; any message from it shows it is alive."""
+        self.keepalive_received[neighbor_id] = self.now()
+        timer = self.hold_timers.get(neighbor_id)
+        if timer is not None:
+            timer.cancel()
+        self.hold_timers[neighbor_id] = self.start_timer(self.hold_timer, self.hold_expired, neighbor_id)
+
+    def hold_expired(self, neighbor_id):
+        """Declare down a neighbor we have not heard from within the HOLD TIMER."""
+        self.hold_timers.pop(neighbor_id, None)
+        if neighbor_id not in self.down_routers:
+            self.log.warning("Router %s has not received KEEPALIVE from Router %s. Declaring Router %s as down.", self.router_id, neighbor_id, neighbor_id)
+        self.session_down(neighbor_id)
+
+    def session_down(self, neighbor_id):
+        """Drop the session to a neighbor and every route learned from it."""
+        self.stop_session_timers(neighbor_id)
+        self.release_socket(neighbor_id)
+        self.open_sent.discard(neighbor_id)
+        self.down_routers.add(neighbor_id)
+        self.remove_neighbor_routes(neighbor_id)
+
+    def session_closed(self, neighbor_id):
+        """ The transport to a neighbor closed. A Graceful Restart capable
+            neighbor is probably restarting: keep its routes as stale until it
+            is back and sends End-of-RIB, or its restart time runs out. Other
+            neighbors are left to their hold timer as before."""
+        restart_time = self.peer_restart_times.get(neighbor_id)
+        if not restart_time:
+            return
+        self.log.info("Router %s keeps the routes of restarting Router %s for %ss.", self.router_id, neighbor_id, restart_time)
+        self.stop_session_timers(neighbor_id)
+        self.release_socket(neighbor_id)
+        self.open_sent.discard(neighbor_id)
+        self.rib.mark_stale(neighbor_id)
+        self.start_stale_timer(neighbor_id)
+
+    def start_stale_timer(self, neighbor_id):
+        timer = self.stale_timers.get(neighbor_id)
+        if timer is not None:
+            timer.cancel()
+        restart_time = self.peer_restart_times.get(neighbor_id, self.restart_time)
+        self.stale_timers[neighbor_id] = self.start_timer(restart_time, self.sweep_stale_routes, neighbor_id)
+
+    def end_of_rib(self, neighbor_id):
+        """A neighbor finished sending its table: whatever it did not announce again is gone."""
+        self.log.debug("Router %s received End-of-RIB from Router %s.", self.router_id, neighbor_id)
+        self.sweep_stale_routes(neighbor_id)
+
+    def sweep_stale_routes(self, neighbor_id):
+        timer = self.stale_timers.pop(neighbor_id, None)
+        if timer is not None:
+            timer.cancel()
+        changes = self.rib.sweep_stale(neighbor_id)
+        if changes:
+            self.log.info("Router %s swept %d stale routes of Router %s.", self.router_id, len(changes), neighbor_id)
+            self.propagate_routes(neighbor_id, changes)
 
     def remove_neighbor_routes(self, neighbor_id):
-        """Remove routes learned from the failed neighbor."""
-        print(f"Removing routes learned from Router {neighbor_id}.")
-        routes_to_remove = []
-
-        for route in self.routing_table.table[:]:
-            print(f"Checking route: {route['next_hop']} is Router {neighbor_id}")
-            if str(route['next_hop']).lower() == f"router{neighbor_id}".lower():
-                print(f"Removing route for network: {route['network']}")
-                routes_to_remove.append({"network": route['network']})
-                self.routing_table.remove_route(route['network'])
-            else:
-                print(f"Route for network {route['network']} is not from Router {neighbor_id}.")
-        
-        if routes_to_remove:
-            print(f"Propagating route withdrawals: {routes_to_remove}")
-            self.propagate_route_withdrawal(neighbor_id, routes_to_remove)
-        else:
-            print(f"No routes found for removal from Router {neighbor_id}.")
+        """Remove routes learned from the failed neighbor and fail over to cached alternates."""
+        self.log.info("Removing routes learned from Router %s.", neighbor_id)
+        changes = self.rib.drop_neighbor(neighbor_id)
 
-    def propagate_route_withdrawal(self, neighbor_id, routes_to_remove):
-        """Propagate route withdrawal to other neighbors."""
-        for neighbor, sock in self.sockets.items():
-            if neighbor != neighbor_id:
-                self.send_message(sock, BGP_WITHDRAW, routes_to_remove)
-                print(f"Router {self.router_id} propagated route withdrawal to Router {neighbor}.")
+        if changes:
+            self.log.debug("Propagating %d Loc-RIB changes.", len(changes))
+            self.propagate_routes(neighbor_id, changes)
+        else:
+            self.log.info("No routes found for removal from Router %s.", neighbor_id)
 
     def get_neighbor_by_ip(self, ip):
         """Get the neighbor ID by its IP address."""
-        for neighbor_id in self.neighbors:
-            if get_router_config(neighbor_id)['ip'] == ip:
-                return neighbor_id
+        router = get_topology().router_by_ip(ip)
+        if router is not None and router['id'] in self.neighbors:
+            return router['id']
         return None
 
-    def exchange_votes_with_neighbors(self):
-        """Exchange votes with neighbors and update the trust model continuously."""
-        while True:
-            try:
-                print(f"Router {self.router_id} starting to exchange votes with neighbors.")
-                votes = self.voting_mechanism.exchange_votes(self.routing_table)
-
-                for neighbor_id, vote in votes.items():
-                    if neighbor_id not in self.down_routers:
-                        self.trust_model.update_voted_trust(neighbor_id, vote)
-                        print(f"Router {self.router_id} updated voted trust for Router {neighbor_id}: {vote}")
-                    else:
-                        print(f"Router {self.router_id} skipped Router {neighbor_id} because it is down.")
-                time.sleep(30) 
-            except Exception as e:
-                print(f"Error in voting mechanism: {e}")
-
-    def find_best_route(self, routes, neighbor_id):
-        """Find and display the best route for a given network."""
-        for route in routes:
-            if neighbor_id == route['next_hop']:
-                network = route['network']
-                break
-            else:
-                return None
+    def exchange_votes(self):
+        """Run one round of voting: apply our votes to the trust model and send them to every neighbor."""
+        self.log.debug("Router %s starting to exchange votes with neighbors.", self.router_id)
+        votes = self.voting_mechanism.exchange_votes()
 
-        best_route = self.routing_table.get_best_route(network, self.trust_model)
+        accepted = {}
+        for neighbor_id, vote in votes.items():
+            if neighbor_id not in self.down_routers:
+                accepted[neighbor_id] = vote
+                self.log.debug("Router %s updated voted trust for Router %s: %s", self.router_id, neighbor_id, vote)
+            else:
+                self.log.debug("Router %s skipped Router %s because it is down.", self.router_id, neighbor_id)
+        self.trust_model.apply_votes(accepted)
+
+        if accepted:
+            payload = list(accepted.items())
+            for neighbor_id, sock in list(self.sockets.items()):
+                if neighbor_id in self.vote_peers:
+                    self.send_message(sock, BGP_VOTE, payload, self.wire_formats.get(neighbor_id, WIRE_BINARY))
+
+    def receive_votes(self, neighbor_id, votes):
+        """Feed the votes a neighbor cast on our other neighbors into the trust model."""
+        accepted = self.voting_mechanism.receive_votes(neighbor_id, votes)
+        self.trust_model.apply_votes({
+            subject: vote for subject, vote in accepted.items() if subject not in self.down_routers
+        })
+
+    def decay_trust(self):
+        """Periodic trust decay, so neighbors keep their voted trust only while votes renew it."""
+        self.trust_model.decay_all(TRUST_DECAY_RATE)
+
+    def find_best_route(self, network):
+        """Find and display the best route for a given network."""
+        best_route = self.rib.get_best_route(network)
         if best_route:
-            print(f"{self.router_id} has the best route for {network}: {best_route[1][0]} via {best_route[1][1]}")
+            self.log.info("%s has the best route for %s: %s via %s", self.router_id, network, best_route.as_path, best_route.next_hop)
             return best_route
         else:
-            print(f"{self.router_id} has no route for {network}.")
+            self.log.info("%s has no route for %s.", self.router_id, network)
 
 if __name__ == "__main__":
     router_id = int(os.getenv("ROUTER_ID"))
-    bgp_router = BGP_Router(router_id)
+    logs.configure()
+    if os.getenv("BGP_RUNTIME") == "asyncio":
+        import asyncio
+        from async_runtime import AsyncBGPRouter
+        asyncio.run(AsyncBGPRouter(router_id).run())
+    else:
+        bgp_router = BGP_Router(router_id)
     
     # Keep the main process alive
     #! I DONT KNOW WHY IS THISS. JUST DONT TOUCH THISSS
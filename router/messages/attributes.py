@@ -8,6 +8,14 @@ ATTR_TRANSITIVE = 1 << 6
 ATTR_PARTIAL = 1 << 5
 ATTR_EXTENDED = 1 << 4
 
+AS_SET = 1
+AS_SEQUENCE = 2
+# A segment's AS count is one octet; longer paths take several segments
+MAX_SEGMENT_ASNS = 255
+
+# Stands in for a 4-octet AS number in 2-octet fields (RFC 6793)
+AS_TRANS = 23456
+
 class BgpAttributeType(Enum):
         ORIGIN = 1
         AS_PATH = 2
@@ -18,8 +26,8 @@ class BgpAttributeType(Enum):
         AGGREGATOR = 7
 
 class BgpPathAttribute():
-    def __init__(self, attr_type=-1, data={}):
-        if attr_type == -1 or len(data) == 0:
+    def __init__(self, attr_type=-1, data=None):
+        if attr_type == -1 or not data:
             return
 
         match BgpAttributeType(attr_type):
@@ -28,20 +36,29 @@ class BgpPathAttribute():
                 self.length = 1
             case BgpAttributeType.AS_PATH:
                 self.flags = ATTR_TRANSITIVE
-                self.length = 2 + 2 * len(data['asns'])
+                data.setdefault('asn_size', 2)
+                segments = max(1, -(-len(data['asns']) // MAX_SEGMENT_ASNS))
+                self.length = 2 * segments + data['asn_size'] * len(data['asns'])
+                data.setdefault('segment_type', AS_SEQUENCE)
+                data['length'] = len(data['asns'])
             case BgpAttributeType.NEXT_HOP:
                 self.flags = ATTR_TRANSITIVE
                 self.length = 4
             case BgpAttributeType.MULTI_EXIT_DISC:
                 self.flags = ATTR_OPTIONAL
                 self.length = 4
+            case BgpAttributeType.LOCAL_PREF:
+                self.flags = ATTR_TRANSITIVE
+                self.length = 4
             case _:
                 pass
 
+        if self.length > 0xff:
+            self.flags |= ATTR_EXTENDED
         self.type = BgpAttributeType(attr_type)
         self.data = data
 
-    def frombytes(self, path_attr_bytes):
+    def frombytes(self, path_attr_bytes, asn_size=2):
         flags = int(path_attr_bytes[0])
         attr_type = int(path_attr_bytes[1])
 
@@ -54,7 +71,7 @@ class BgpPathAttribute():
         length_idx = 3 if not self.extended else 4
 
         self.type = BgpAttributeType(attr_type)
-        self.length = int(path_attr_bytes[2]) if not self.extended else int(path_attr_bytes[2:4])
+        self.length = int(path_attr_bytes[2]) if not self.extended else struct.unpack("!H", path_attr_bytes[2:4])[0]
 
         attr_bytes = path_attr_bytes[length_idx:]
 
@@ -64,16 +81,23 @@ class BgpPathAttribute():
                     "origin": int(attr_bytes[0])
                 }
             case BgpAttributeType.AS_PATH:
-                len_asn, seg_type = struct.unpack("!2B", attr_bytes[:2])
-                asn_tuple = struct.unpack(f"!{len_asn}H", attr_bytes[2:])
-
+                asn_fmt = "I" if asn_size == 4 else "H"
                 asns = []
-                asns.extend(asn_tuple)
+                seg_type = AS_SEQUENCE
+                offset = 0
+                # The path is the concatenation of every segment in the attribute
+                while offset + 2 <= self.length:
+                    segment_type, len_asn = struct.unpack_from("!2B", attr_bytes, offset)
+                    if offset == 0:
+                        seg_type = segment_type
+                    asns.extend(struct.unpack_from(f"!{len_asn}{asn_fmt}", attr_bytes, offset + 2))
+                    offset += 2 + asn_size * len_asn
 
                 self.data = {
-                    "length": len_asn,
+                    "length": len(asns),
                     "segment_type": seg_type,
                     "asns": asns,
+                    "asn_size": asn_size,
                 }
             case BgpAttributeType.NEXT_HOP:
                 self.data = {
@@ -83,31 +107,55 @@ class BgpPathAttribute():
                 self.data = {
                     "metric": struct.unpack("!I", attr_bytes[0:4])[0]
                 }
+            case BgpAttributeType.LOCAL_PREF:
+                self.data = {
+                    "local_pref": struct.unpack("!I", attr_bytes[0:4])[0]
+                }
             case _:
                 self.data = {}
     
     def pack(self) -> bytes:
-        header = struct.pack("!3B", self.flags, self.type.value, self.length)
-        payload = header
-
-        match BgpAttributeType(self.type):
+        byte_arr = bytearray(self.encoded_length())
+        self.pack_into(byte_arr, 0)
+        return bytes(byte_arr)
+
+    def pack_into(self, buf, offset) -> int:
+        """Write the attribute into `buf` at `offset` and return the offset just past it."""
+        if self.flags & ATTR_EXTENDED:
+            struct.pack_into("!2BH", buf, offset, self.flags, self.type.value, self.length)
+            offset += 4
+        else:
+            struct.pack_into("!3B", buf, offset, self.flags, self.type.value, self.length)
+            offset += 3
+
+        match self.type:
             case BgpAttributeType.ORIGIN:
-                payload += struct.pack("!B", self.data['origin'])
+                struct.pack_into("!B", buf, offset, self.data['origin'])
             case BgpAttributeType.AS_PATH:
-                packed_asns = bytes(0)
-                for _,asn in enumerate(self.data['asns']):
-                    packed_asns += struct.pack("!H", asn)
-
-                payload += struct.pack(f"!2B", self.data['length'], self.data['segment_type'])
-                payload += packed_asns
+                asns = self.data['asns']
+                asn_size = self.data['asn_size']
+                asn_fmt = "I" if asn_size == 4 else "H"
+                segment_offset = offset
+                for start in range(0, max(len(asns), 1), MAX_SEGMENT_ASNS):
+                    chunk = asns[start:start + MAX_SEGMENT_ASNS]
+                    struct.pack_into(f"!2B{len(chunk)}{asn_fmt}", buf, segment_offset, self.data['segment_type'], len(chunk), *chunk)
+                    segment_offset += 2 + asn_size * len(chunk)
             case BgpAttributeType.NEXT_HOP:
-                payload += struct.pack("!4s", self.data['ip_addr'].packed)
+                struct.pack_into("!4s", buf, offset, self.data['ip_addr'].packed)
             case BgpAttributeType.MULTI_EXIT_DISC:
-                payload += struct.pack("!I", self.data['metric'])
+                struct.pack_into("!I", buf, offset, self.data['metric'])
+            case BgpAttributeType.LOCAL_PREF:
+                struct.pack_into("!I", buf, offset, self.data['local_pref'])
             case _:
                 pass
 
-        return payload
+        return offset + self.length
+
+    def header_length(self):
+        return 4 if self.flags & ATTR_EXTENDED else 3
+
+    def encoded_length(self):
+        return self.header_length() + self.length
 
     def __str__(self):
         return f"<BgpAttribute flags={self.flags} type={self.type} length={self.length} data={self.data} />"
\ No newline at end of file
@@ -0,0 +1,216 @@
+import json
+import ipaddress
+import struct
+
+from messages.framing import frame
+from messages.message_base import *
+from utils.path_attributes import as_number
+
+BGP_OPEN = "OPEN"
+BGP_KEEPALIVE = "KEEPALIVE"
+BGP_UPDATE = "UPDATE"
+BGP_WITHDRAW = "WITHDRAW"
+BGP_VOTE = "VOTE"
+BGP_END_OF_RIB = "END_OF_RIB"
+
+VOTE_TRUSTED = "trusted"
+VOTE_UNTRUSTED = "untrusted"
+
+WIRE_BINARY = "binary"
+WIRE_JSON = "json"
+
+ORIGIN_IGP = 0
+AFI_IPV4 = 1
+SAFI_UNICAST = 1
+# Graceful Restart per address family flag: forwarding state was preserved
+GR_FORWARDING_PRESERVED = 0x80
+# prefix length byte + up to 4 address bytes
+MAX_PREFIX_LEN = 5
+
+
+class MessageCodec:
+    """ Converts the router's message dicts to and from framed wire messages.
+
+        OPEN and KEEPALIVE always use the binary RFC 4271 encoding. Routes are
+        sent as binary UPDATEs unless both ends of a session advertised the
+        JSON capability, which is kept as a debug fallback. Every router
+        advertises the 4-octet AS capability, so AS_PATHs always carry 4-octet
+        AS numbers and topologies may have more than 65535 routers.
+
+        VOTE is a private message type carrying a router's votes on its
+        neighbors as [(neighbor ID, "trusted" or "untrusted")]. It is only
+        sent to peers that advertised the VOTE capability.
+
+        With a `restart_time` the Graceful Restart capability is advertised,
+        and END_OF_RIB is sent as the empty UPDATE that marks the end of the
+        initial table (RFC 4724).
+    """
+    def __init__(self, as_num, ip, hold_time, wire_format=WIRE_BINARY, restart_time=0):
+        if wire_format not in (WIRE_BINARY, WIRE_JSON):
+            raise ValueError(f"unknown wire format {wire_format}")
+        self.as_num = as_num
+        self.ip = ipaddress.IPv4Address(ip)
+        self.hold_time = hold_time
+        self.wire_format = wire_format
+        self.restart_time = restart_time
+
+    def capabilities(self):
+        """Capabilities advertised in our OPEN."""
+        capabilities = {CAPABILITY_FOUR_OCTET_AS: struct.pack("!I", self.as_num), CAPABILITY_VOTE: bytes(0)}
+        if self.wire_format == WIRE_JSON:
+            capabilities[CAPABILITY_JSON_WIRE_FORMAT] = bytes(0)
+        if self.restart_time:
+            # restart flags (none) and the 12-bit restart time, then IPv4 unicast with its forwarding state kept
+            capabilities[CAPABILITY_GRACEFUL_RESTART] = struct.pack(
+                "!HHBB", min(self.restart_time, 0xfff), AFI_IPV4, SAFI_UNICAST, GR_FORWARDING_PRESERVED
+            )
+        return capabilities
+
+    def negotiate(self, peer_capabilities):
+        """Pick the wire format of a session from the capabilities in the peer's OPEN."""
+        if self.wire_format == WIRE_JSON and CAPABILITY_JSON_WIRE_FORMAT in peer_capabilities:
+            return WIRE_JSON
+        return WIRE_BINARY
+
+    def supports_votes(self, peer_capabilities):
+        """Whether a peer can receive VOTE messages."""
+        return CAPABILITY_VOTE in peer_capabilities
+
+    def peer_restart_time(self, peer_capabilities):
+        """The restart time a peer advertised with Graceful Restart, or None if it did not."""
+        value = peer_capabilities.get(CAPABILITY_GRACEFUL_RESTART)
+        if value is None or len(value) < 2:
+            return None
+        return struct.unpack_from("!H", value)[0] & 0xfff
+
+    def encode(self, msg_type, payload=None, wire_format=WIRE_BINARY):
+        """Encode a message as a list of frames ready to be sent."""
+        if msg_type == BGP_OPEN:
+            open_msg = BgpMessageOpen(
+                ip=self.ip, hold_time=self.hold_time, as_num=self.as_num, capabilities=self.capabilities()
+            )
+            return [open_msg.pack()]
+        if msg_type == BGP_KEEPALIVE:
+            return [BgpMessageKeepAlive().pack()]
+        if wire_format == WIRE_JSON:
+            return self.encode_json(msg_type, payload)
+        if msg_type == BGP_END_OF_RIB:
+            return [BgpMessageUpdate().pack()]
+        if msg_type == BGP_VOTE:
+            return [BgpMessageVote([(neighbor_id, vote == VOTE_TRUSTED) for neighbor_id, vote in payload]).pack()]
+        if msg_type == BGP_UPDATE:
+            return self.encode_updates(payload)
+        if msg_type == BGP_WITHDRAW:
+            return self.encode_withdrawals(payload)
+        raise ValueError(f"cannot encode {msg_type} message")
+
+    def encode_json(self, msg_type, payload=None):
+        """Encode a message as JSON frames, splitting route lists too large for a single frame."""
+        body = json.dumps({"type": msg_type, "payload": payload}).encode()
+        if BGP_HEADER_LEN + len(body) <= BGP_MAX_LENGTH or not isinstance(payload, list) or len(payload) < 2:
+            return [frame(BgpMessageType.JSON.value, body)]
+        half = len(payload) // 2
+        return self.encode_json(msg_type, payload[:half]) + self.encode_json(msg_type, payload[half:])
+
+    def encode_updates(self, routes):
+        """ Encode announcements, packing every prefix that shares an AS path,
+            MED and ORIGIN into multi-NLRI UPDATEs. MULTI_EXIT_DISC is only
+            sent when a route has one."""
+        groups = {}
+        for route in routes:
+            as_path = route['as_path']
+            if type(as_path) is not tuple:
+                as_path = tuple(as_number(asn) for asn in as_path)
+            group = (as_path, route.get('med', 0), route.get('origin', ORIGIN_IGP))
+            groups.setdefault(group, []).append(prefix_pair(route['network']))
+
+        updates = []
+        for (as_path, med, origin), prefixes in groups.items():
+            attrs = [
+                BgpPathAttribute(BgpAttributeType.ORIGIN.value, {"origin": origin}),
+                BgpPathAttribute(BgpAttributeType.AS_PATH.value, {"asns": list(as_path), "asn_size": 4}),
+                BgpPathAttribute(BgpAttributeType.NEXT_HOP.value, {"ip_addr": self.ip}),
+            ]
+            if med:
+                attrs.append(BgpPathAttribute(BgpAttributeType.MULTI_EXIT_DISC.value, {"metric": med}))
+            attrs_len = sum(attr.encoded_length() for attr in attrs)
+            per_message = (BGP_MAX_LENGTH - BGP_HEADER_LEN - UPDATE_FIXED_LEN - attrs_len) // MAX_PREFIX_LEN
+            for i in range(0, len(prefixes), per_message):
+                updates.append(BgpMessageUpdate(path_attributes=attrs, nlri=prefixes[i:i + per_message]))
+        return [pack_messages(updates)]
+
+    def encode_withdrawals(self, routes):
+        """Encode withdrawals as UPDATEs carrying only withdrawn routes."""
+        prefixes = [prefix_pair(route['network']) for route in routes]
+        per_message = (BGP_MAX_LENGTH - BGP_HEADER_LEN - UPDATE_FIXED_LEN) // MAX_PREFIX_LEN
+        return [pack_messages([
+            BgpMessageUpdate(withdrawn_routes=prefixes[i:i + per_message])
+            for i in range(0, len(prefixes), per_message)
+        ])]
+
+    def decode(self, frame_type, body):
+        """ Decode one frame into the list of message dicts it carries.
+
+            `body` may be a memoryview over a receive buffer; it is parsed in
+            place and nothing returned keeps a reference to it.
+        """
+        if frame_type == BgpMessageType.JSON.value:
+            return [json.loads(bytes(body))]
+
+        match BgpMessageType(frame_type):
+            case BgpMessageType.KEEPALIVE:
+                return [{"type": BGP_KEEPALIVE, "payload": None}]
+            case BgpMessageType.OPEN:
+                open_msg = BgpMessageOpen()
+                open_msg.unpack_payload(body)
+                return [{"type": BGP_OPEN, "payload": {
+                    "as": open_msg.as_number,
+                    "hold_time": open_msg.hold_time,
+                    "ip": str(open_msg.ip_addr),
+                    "capabilities": open_msg.capabilities,
+                }}]
+            case BgpMessageType.UPDATE:
+                update = BgpMessageUpdate(asn_size=4)
+                update.unpack_payload(body)
+                return self.update_to_messages(update)
+            case BgpMessageType.VOTE:
+                vote_msg = BgpMessageVote()
+                vote_msg.unpack_payload(body)
+                return [{"type": BGP_VOTE, "payload": [
+                    (neighbor_id, VOTE_TRUSTED if trusted else VOTE_UNTRUSTED) for neighbor_id, trusted in vote_msg.votes
+                ]}]
+            case _:
+                raise ValueError(f"cannot decode message type {frame_type}")
+
+    def update_to_messages(self, update):
+        """ Split a decoded UPDATE into WITHDRAW and UPDATE message dicts.
+
+            Networks stay as (network as int, prefix length) pairs and AS paths
+            as tuples of AS numbers, which the RIB accepts directly. MED and
+            ORIGIN are only added to the dicts when they are set.
+        """
+        if not update.withdrawn_routes and not update.nlri:
+            return [{"type": BGP_END_OF_RIB, "payload": None}]
+        messages = []
+        if update.withdrawn_routes:
+            messages.append({
+                "type": BGP_WITHDRAW,
+                "payload": [{"network": prefix} for prefix in update.withdrawn_routes],
+            })
+        if update.nlri:
+            as_path_attr = update.attribute(BgpAttributeType.AS_PATH)
+            next_hop_attr = update.attribute(BgpAttributeType.NEXT_HOP)
+            as_path = tuple(as_path_attr.data['asns']) if as_path_attr else ()
+            next_hop = str(next_hop_attr.data['ip_addr']) if next_hop_attr else None
+            route = {"next_hop": next_hop, "as_path": as_path}
+            med_attr = update.attribute(BgpAttributeType.MULTI_EXIT_DISC)
+            if med_attr and med_attr.data['metric']:
+                route["med"] = med_attr.data['metric']
+            origin_attr = update.attribute(BgpAttributeType.ORIGIN)
+            if origin_attr and origin_attr.data['origin'] != ORIGIN_IGP:
+                route["origin"] = origin_attr.data['origin']
+            messages.append({
+                "type": BGP_UPDATE,
+                "payload": [dict(route, network=prefix) for prefix in update.nlri],
+            })
+        return messages
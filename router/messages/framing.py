@@ -0,0 +1,77 @@
+from messages.message_base import BGP_MARKER, BGP_HEADER, BGP_HEADER_LEN, BGP_MAX_LENGTH
+
+
+class FramingError(Exception):
+    """Raised when the byte stream from a neighbor does not contain valid BGP framing."""
+
+
+def unpack_header(buf, offset=0):
+    """Validate the BGP header at `offset` and return (total length, msg_type)."""
+    marker, length, msg_type = BGP_HEADER.unpack_from(buf, offset)
+    if marker != BGP_MARKER:
+        raise FramingError("connection not synchronized: bad marker")
+    if length < BGP_HEADER_LEN:
+        raise FramingError(f"bad message length {length}")
+    return length, msg_type
+
+
+def frame(msg_type, body):
+    """Prefix a message body with the 19-byte BGP header."""
+    length = BGP_HEADER_LEN + len(body)
+    if length > BGP_MAX_LENGTH:
+        raise FramingError(f"message of {length} bytes does not fit in one frame")
+    return BGP_HEADER.pack(BGP_MARKER, length, msg_type) + body
+
+
+class MessageReader:
+    """ Reads length-prefixed BGP messages from a stream socket.
+
+        Data is received with `recv_into` straight into one reusable buffer,
+        and every complete message is yielded as a `memoryview` over that
+        buffer, so partial reads and many messages per read cost no copies.
+        A yielded body is only valid until the generator is resumed.
+    """
+    def __init__(self, sock, bufsize=BGP_MAX_LENGTH + 1):
+        if bufsize <= BGP_MAX_LENGTH:
+            raise ValueError("buffer must be able to hold a maximum size message")
+        self.sock = sock
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not yet handed out
+        self.end = 0  # end of the received data
+
+    def __iter__(self):
+        return self.messages()
+
+    def _next_frame(self):
+        """Return (msg_type, body) for the next complete frame, or the number of bytes still missing."""
+        available = self.end - self.start
+        if available < BGP_HEADER_LEN:
+            return BGP_HEADER_LEN - available
+        length, msg_type = unpack_header(self.buffer, self.start)
+        if available < length:
+            return length - available
+        body = self.view[self.start + BGP_HEADER_LEN:self.start + length]
+        self.start += length
+        return msg_type, body
+
+    def messages(self):
+        """Yield (msg_type, body) for every complete message until the neighbor closes the connection."""
+        while True:
+            result = self._next_frame()
+            while not isinstance(result, int):
+                yield result
+                result = self._next_frame()
+
+            # Only the tail of a partial message is ever moved, and only when it would not fit
+            if self.start == self.end:
+                self.start = self.end = 0
+            elif self.end + result > len(self.buffer):
+                pending = self.end - self.start
+                self.buffer[:pending] = bytes(self.view[self.start:self.end])
+                self.start, self.end = 0, pending
+
+            received = self.sock.recv_into(self.view[self.end:])
+            if received == 0:
+                return
+            self.end += received
@@ -2,7 +2,24 @@ import struct
 import ipaddress
 from enum import Enum
 
-from router.messages.attributes import *
+from messages.attributes import *
+
+BGP_MARKER = b'\xff' * 16
+# marker, total message length (header included), message type
+BGP_HEADER = struct.Struct("!16sHB")
+BGP_HEADER_LEN = BGP_HEADER.size
+BGP_MAX_LENGTH = 65535
+# withdrawn routes length + total path attribute length fields of an UPDATE
+UPDATE_FIXED_LEN = 4
+
+def prefix_pair(network):
+    """Normalize a prefix given as a string, an IPv4Network or a pair to (network as int, prefix length)."""
+    if isinstance(network, (tuple, list)):
+        return int(network[0]), int(network[1])
+    if not isinstance(network, ipaddress.IPv4Network):
+        network = ipaddress.IPv4Network(network, strict=False)
+    return int(network.network_address), network.prefixlen
+
 
 class BgpMessageType(Enum):
     OPEN = 1
@@ -10,6 +27,21 @@ class BgpMessageType(Enum):
     NOTIFICATION = 3
     KEEPALIVE = 4
     ROUTE_REFRESH = 5
+    # Private use: trust votes exchanged by the simulated routers
+    VOTE = 254
+    # Private use: the simulator's JSON debug encoding, framed with the same header
+    JSON = 255
+
+# OPEN optional parameter carrying capabilities (RFC 5492)
+OPT_PARAM_CAPABILITIES = 2
+# The speaker supports 4-octet AS numbers (RFC 6793); the value is its AS number
+CAPABILITY_FOUR_OCTET_AS = 65
+# Graceful Restart (RFC 4724); the value carries the speaker's restart time
+CAPABILITY_GRACEFUL_RESTART = 64
+# Private use capability: the speaker can exchange JSON encoded messages
+CAPABILITY_JSON_WIRE_FORMAT = 0xf0
+# Private use capability: the speaker sends and understands VOTE messages
+CAPABILITY_VOTE = 0xf1
 
 class BgpMessageBase():
     def __init__(self, msg_type=BgpMessageType.KEEPALIVE):
@@ -20,7 +52,12 @@ class BgpMessageBase():
         as the header (19 bytes).
     """
     def length(self):
-        return 19 + (len(self.payload()) if self.payload() else 0)
+        return BGP_HEADER_LEN + self.payload_length()
+
+    """ Returns the length of the payload alone. Message types that can
+        compute it without encoding the payload override this."""
+    def payload_length(self):
+        return len(self.payload())
     
     """ Returns the header of the BGP message encoded as bytes.
         The header consists of
@@ -29,68 +66,103 @@ class BgpMessageBase():
             - the message type
     """
     def header(self):
-        print(self.length(), self.msg_type, self.msg_type.value)
-        return struct.pack(
-            "!16BhB",
-            0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff,
-            0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff,
-            self.length(),
-            self.msg_type.value,
-        )
+        return BGP_HEADER.pack(BGP_MARKER, self.length(), self.msg_type.value)
     
     """ Returns the information contained on the BGP message, encoded as bytes."""
     def payload(self):
-        pass
+        return bytes(0)
 
     """ Retrieves information from a bytes object and converts it to a BGP
         message type.
-        Each message type implements the unpack method and calls `unpack` on
-        `BGPMessageBase` to parse the message header."""
+        `unpack` parses the message header and hands the rest of the message
+        to `unpack_payload`, which each message type implements."""
     def unpack(self, byte_str):
-        length, msg_type = struct.unpack("!hB", byte_str[16:19])
+        view = memoryview(byte_str)
+        _, length, msg_type = BGP_HEADER.unpack_from(view)
         self.msg_type = BgpMessageType(msg_type)
         self.raw_length = length
+        self.unpack_payload(view[BGP_HEADER_LEN:length])
+
+    """ Parses the message payload (everything after the header). `payload`
+        is a memoryview; it can come straight from the receive buffer."""
+    def unpack_payload(self, payload):
+        pass
     
     """ Converts the BGP message to a bytes object, ready to be transmitted
         over the network. """
     def pack(self):
-        byte_arr = bytearray()
-        byte_arr.extend(self.header())
-        byte_arr.extend(self.payload())
+        byte_arr = bytearray(self.length())
+        self.pack_into(byte_arr, 0)
         return bytes(byte_arr)
+
+    """ Writes the whole message into a preallocated buffer at `offset` and
+        returns the offset just past it. `length` may be passed when the
+        caller already computed it."""
+    def pack_into(self, buf, offset, length=None):
+        payload = self.payload()
+        length = BGP_HEADER_LEN + len(payload)
+        BGP_HEADER.pack_into(buf, offset, BGP_MARKER, length, self.msg_type.value)
+        buf[offset + BGP_HEADER_LEN:offset + length] = payload
+        return offset + length
     
     def __str__(self):
         return f"<BGPMessage type={self.msg_type} length={self.length()}>"
 
 
 class BgpMessageOpen(BgpMessageBase):
-    def __init__(self, ip="192.168.0.1", version=4, hold_time=0, as_num=0):
+    payload_fmt = "!BHHIB"
+
+    def __init__(self, ip="192.168.0.1", version=4, hold_time=0, as_num=0, capabilities=None):
         super().__init__(msg_type=BgpMessageType.OPEN)
         self.ip_addr = ipaddress.IPv4Address(ip)
         self.version = version
         self.hold_time = hold_time
         self.as_number = as_num
+        # capability code -> capability value (bytes)
+        self.capabilities = capabilities if capabilities is not None else {}
 
     def payload(self):
+        opt_params = bytes(0)
+        if self.capabilities:
+            caps = b"".join(
+                struct.pack(f"!BB{len(value)}s", code, len(value), value)
+                for code, value in self.capabilities.items()
+            )
+            opt_params = struct.pack("!BB", OPT_PARAM_CAPABILITIES, len(caps)) + caps
+
         return struct.pack(
-            "!BHHIB",
+            self.payload_fmt,
             self.version,
-            self.as_number,
+            self.as_number if self.as_number <= 0xffff else AS_TRANS,
             self.hold_time,
             int(self.ip_addr),
-            0
-        )
+            len(opt_params)
+        ) + opt_params
 
-    def unpack(self, byte_str):
-        super().unpack(byte_str)
-        byte_str = byte_str[19:]
-        version, as_num, hold_time, ip_addr, opt_params_size = struct.unpack(self.payload_fmt, byte_str)
-        print(version, as_num, hold_time, ip_addr, opt_params_size)
+    def unpack_payload(self, byte_str):
+        fixed_len = struct.calcsize(self.payload_fmt)
+        version, as_num, hold_time, ip_addr, opt_params_size = struct.unpack_from(self.payload_fmt, byte_str)
 
         self.version = version
         self.as_number = as_num
         self.hold_time = hold_time
         self.ip_addr = ipaddress.IPv4Address(ip_addr)
+        self.capabilities = {}
+
+        i = fixed_len
+        end = fixed_len + opt_params_size
+        while i < end:
+            param_type, param_len = struct.unpack_from("!BB", byte_str, i)
+            if param_type == OPT_PARAM_CAPABILITIES:
+                j = i + 2
+                while j < i + 2 + param_len:
+                    code, cap_len = struct.unpack_from("!BB", byte_str, j)
+                    self.capabilities[code] = bytes(byte_str[j + 2:j + 2 + cap_len])
+                    j += 2 + cap_len
+            i += 2 + param_len
+
+        if CAPABILITY_FOUR_OCTET_AS in self.capabilities:
+            self.as_number = struct.unpack("!I", self.capabilities[CAPABILITY_FOUR_OCTET_AS])[0]
 
     def __str__(self):
         return f"<BGPMessage type={self.msg_type} length={self.length()} version={self.version} as_number={self.as_number} hold_time={self.hold_time} ip={self.ip_addr}>"
@@ -102,7 +174,7 @@ class BgpMessageKeepAlive(BgpMessageBase):
 
 
 class BgpMessageNotification(BgpMessageBase):
-    def __init__(self, major, minor, data):
+    def __init__(self, major=0, minor=0, data=bytes(0)):
         super().__init__(msg_type=BgpMessageType.NOTIFICATION)
 
         self.major_code = major
@@ -117,124 +189,191 @@ class BgpMessageNotification(BgpMessageBase):
             self.data
         )
 
-    def unpack(self, byte_str):
-        super().unpack(byte_str)
-        byte_str = byte_str[19:]
-        major, minor = struct.unpack("!BB", byte_str[0:2])
-        data = struct.unpack(f"!{self.raw_length - 21}s", byte_str[2:])
+    def unpack_payload(self, byte_str):
+        major, minor = struct.unpack_from("!BB", byte_str)
 
         self.major_code = major
         self.minor_code = minor
-        self.data = data[0]
+        self.data = bytes(byte_str[2:])
 
     def __str__(self):
         return f"<BGPMessage type={self.msg_type} length={self.length()} error_code={self.major_code} suberror_code={self.minor_code} data={self.data}>"
 
 
-class BgpMessageUpdate(BgpMessageBase):
-    def __init__(self, withdrawn_routes=[], path_attributes=[], nlri=[]):
-        super().__init__(msg_type=BgpMessageType.UPDATE)
+class BgpMessageVote(BgpMessageBase):
+    """ A router's votes on its neighbors: one record per neighbor with the
+        neighbor's 4-octet ID and 1 for trusted or 0 for untrusted."""
+    record = struct.Struct("!IB")
+
+    def __init__(self, votes=None):
+        super().__init__(msg_type=BgpMessageType.VOTE)
+
+        self.votes = votes if votes is not None else []  # [(neighbor ID, trusted)]
 
-        self.withdrawn_routes = withdrawn_routes
-        self.path_attributes = path_attributes
-        self.nlri = nlri
+    def payload_length(self):
+        return self.record.size * len(self.votes)
 
     def payload(self):
-        def pack_attrs():
-            results = bytes(0)
-            count = 0
-            packed_attr = bytes(0)
-            packed_nlri = bytes(0)
-            for _, attr in enumerate(self.path_attributes):
-                count += 3
-                count += attr.length
-                packed_attr += attr.pack()
-
-            for _, nlri in enumerate(self.nlri):
-                nlri_addr_len = int(4 - (32 -  nlri.prefixlen) / 8)
-
-                nlri_bytes = bytes(nlri.network_address.packed[0:nlri_addr_len])
-                packed_nlri += struct.pack(f"!B{nlri_addr_len}s", nlri.prefixlen, nlri_bytes)
-
-            results += struct.pack("!H", count)
-            results += packed_attr
-            results += packed_nlri
-            return results
+        return b"".join(self.record.pack(neighbor_id, int(trusted)) for neighbor_id, trusted in self.votes)
 
-        return struct.pack(
-            f"!H{len(self.withdrawn_routes)}s",
-            len(self.withdrawn_routes),
-            self.withdrawn_routes if len(self.withdrawn_routes) else bytes(0),
-        ) + pack_attrs()
+    def unpack_payload(self, byte_str):
+        if len(byte_str) % self.record.size:
+            raise ValueError(f"VOTE payload of {len(byte_str)} bytes is not a whole number of records")
+        self.votes = [(neighbor_id, bool(trusted)) for neighbor_id, trusted in self.record.iter_unpack(byte_str)]
 
-    def unpack(self, byte_str):
-        super().unpack(byte_str)
-        byte_str = byte_str[19:]
-        len_withdrawn_routes = struct.unpack("!H", byte_str[0:2])[0]
-
-        if len_withdrawn_routes > 0:
-            raise NotImplementedError("path withdrawal is not implemented")
-
-        byte_str = byte_str[2:]
-        len_path_attr = struct.unpack("!H", byte_str[0:2])[0]
-
-        if len_path_attr > 0:
-            byte_str = byte_str[2:]
-            i = 0
-            while True:
-                if i >= len_path_attr:
-                    break
-
-                path_bytes = byte_str[i:]
-
-                flags = byte_str[i]
-                attr_type = int(byte_str[i + 1])
-                attr_len = int(byte_str[i + 2])
-
-                print("attr flags:", flags, attr_type, attr_len)
-
-                match BgpAttributeType(attr_type):
-                    case BgpAttributeType.ORIGIN:
-                        path_bytes = path_bytes[:4]
-                        i += 4
-                    case BgpAttributeType.AS_PATH:
-                        num_asns = int(byte_str[i + 4])
-                        path_bytes = path_bytes[:5 + (num_asns * 2)]
-                        i += 5 + (num_asns * 2)
-                    case BgpAttributeType.NEXT_HOP | BgpAttributeType.MULTI_EXIT_DISC:
-                        path_bytes = path_bytes[:7]
-                        i += 7
-                    case _:
-                        break
-
-                path_attr = BgpPathAttribute()
-                path_attr.frombytes(path_bytes)
-                self.path_attributes.append(path_attr)
-
-        # NLRI length is 23 - total path attrs length - withdrawn routes length
-        len_nlri = self.raw_length - 23 - len_path_attr - len_withdrawn_routes
-        byte_str = byte_str[len_path_attr:]
-
-        hex_str = byte_str.hex().upper()
-        print(' '.join(hex_str[i:i+2] for i in range(0, len(hex_str), 2)))
+    def __str__(self):
+        return f"<BGPMessage type={self.msg_type} length={self.length()} votes={self.votes}>"
 
-        i = 0
-        while True:
-            if i >= len_nlri:
-                break
-            # NLRI is a tuple with prefix, addr
-            nlri_prefix = struct.unpack(f"!B", byte_str[i:1])[0]
-            nlri_addr_len = int(4 - (32 -  nlri_prefix) / 8)
 
-            nlri_addr = struct.unpack(f"!{nlri_addr_len}s", byte_str[i + 1:nlri_addr_len + 1])[0]
-            host_bits = 4 - nlri_addr_len
-            # add trailing zeroes to correspond to hostmask
-            nlri_addr += host_bits * b'\x00'
+class BgpMessageUpdate(BgpMessageBase):
+    """ Prefixes (withdrawn routes and NLRI) may be given as IPv4Network
+        objects or as (network as int, prefix length) pairs. Decoded messages
+        always use the pairs, and their path attributes are only parsed the
+        first time they are accessed. `asn_size` is the width of the AS
+        numbers in a received AS_PATH: 4 once both speakers advertised the
+        4-octet AS capability."""
+    def __init__(self, withdrawn_routes=None, path_attributes=None, nlri=None, asn_size=2):
+        super().__init__(msg_type=BgpMessageType.UPDATE)
 
-            self.nlri.append(ipaddress.IPv4Network((nlri_addr, nlri_prefix)))
+        self.asn_size = asn_size
+        self.withdrawn_routes = withdrawn_routes if withdrawn_routes is not None else []
+        self.path_attributes = path_attributes if path_attributes is not None else []
+        self.nlri = nlri if nlri is not None else []
+
+    @property
+    def path_attributes(self):
+        if self._path_attributes is None:
+            self._path_attributes = self.unpack_path_attributes(self._attrs_view, self.asn_size)
+            self._attrs_view = None
+        return self._path_attributes
+
+    @path_attributes.setter
+    def path_attributes(self, path_attributes):
+        self._path_attributes = path_attributes
+        self._attrs_view = None
+
+    """ Returns the first path attribute of the given type, or None."""
+    def attribute(self, attr_type):
+        for attr in self.path_attributes:
+            if attr.type == attr_type:
+                return attr
+        return None
+
+    @staticmethod
+    def prefixes_length(prefixes):
+        length = 0
+        for prefix in prefixes:
+            prefix_len = prefix[1] if isinstance(prefix, tuple) else prefix.prefixlen
+            length += 1 + ((prefix_len + 7) >> 3)
+        return length
+
+    """ Writes (prefix length, prefix) tuples, as used for both the withdrawn
+        routes and the NLRI fields, and returns the offset past them."""
+    @staticmethod
+    def pack_prefixes_into(buf, offset, prefixes):
+        for prefix in prefixes:
+            if isinstance(prefix, tuple):
+                addr, prefix_len = prefix
+            else:
+                addr, prefix_len = int(prefix.network_address), prefix.prefixlen
+            addr_len = (prefix_len + 7) >> 3
+            buf[offset] = prefix_len
+            buf[offset + 1:offset + 1 + addr_len] = addr.to_bytes(4, "big")[:addr_len]
+            offset += 1 + addr_len
+        return offset
+
+    def payload_length(self):
+        return (
+            UPDATE_FIXED_LEN
+            + self.prefixes_length(self.withdrawn_routes)
+            + sum(attr.encoded_length() for attr in self.path_attributes)
+            + self.prefixes_length(self.nlri)
+        )
 
-            i += nlri_addr_len + 1
-            byte_str = byte_str[i:]
+    def payload(self):
+        return self.pack()[BGP_HEADER_LEN:]
+
+    """ Single pass encoder: every field is written in place with
+        `struct.pack_into`, and each length is computed exactly once."""
+    def pack_into(self, buf, offset, length=None):
+        withdrawn_len = self.prefixes_length(self.withdrawn_routes)
+        attrs_len = sum(attr.encoded_length() for attr in self.path_attributes)
+        if length is None:
+            length = BGP_HEADER_LEN + UPDATE_FIXED_LEN + withdrawn_len + attrs_len + self.prefixes_length(self.nlri)
+
+        BGP_HEADER.pack_into(buf, offset, BGP_MARKER, length, self.msg_type.value)
+        offset += BGP_HEADER_LEN
+        struct.pack_into("!H", buf, offset, withdrawn_len)
+        offset = self.pack_prefixes_into(buf, offset + 2, self.withdrawn_routes)
+        struct.pack_into("!H", buf, offset, attrs_len)
+        offset += 2
+        for attr in self.path_attributes:
+            offset = attr.pack_into(buf, offset)
+        return self.pack_prefixes_into(buf, offset, self.nlri)
+
+    """ Parses a run of (prefix length, prefix) tuples into
+        (network as int, prefix length) pairs, reading the bytes in place."""
+    @staticmethod
+    def unpack_prefixes(byte_str):
+        prefixes = []
+        append = prefixes.append
+        i = 0
+        end = len(byte_str)
+        while i < end:
+            prefix_len = byte_str[i]
+            addr_len = (prefix_len + 7) >> 3
+            # shift in the trailing zeroes that correspond to the hostmask
+            addr = int.from_bytes(byte_str[i + 1:i + 1 + addr_len], "big") << (32 - 8 * addr_len)
+            append((addr, prefix_len))
+            i += 1 + addr_len
+        return prefixes
+
+    @staticmethod
+    def unpack_path_attributes(byte_str, asn_size=2):
+        path_attributes = []
+        i = 0
+        while i < len(byte_str):
+            flags = byte_str[i]
+            if flags & ATTR_EXTENDED:
+                attr_end = i + 4 + struct.unpack_from("!H", byte_str, i + 2)[0]
+            else:
+                attr_end = i + 3 + byte_str[i + 2]
+
+            path_attr = BgpPathAttribute()
+            try:
+                path_attr.frombytes(byte_str[i:attr_end], asn_size)
+            except ValueError:
+                # unrecognized attribute type, skip it
+                path_attr = None
+            if path_attr is not None:
+                path_attributes.append(path_attr)
+            i = attr_end
+        return path_attributes
+
+    """ Splits the payload into its three sections without copying. The
+        prefixes are decoded right away as compact pairs; the path attribute
+        section is kept as a view and parsed on first access."""
+    def unpack_payload(self, byte_str):
+        len_withdrawn_routes = struct.unpack_from("!H", byte_str)[0]
+        attrs_start = 4 + len_withdrawn_routes
+        len_path_attr = struct.unpack_from("!H", byte_str, 2 + len_withdrawn_routes)[0]
+
+        self.withdrawn_routes = self.unpack_prefixes(byte_str[2:2 + len_withdrawn_routes])
+        self._path_attributes = None
+        self._attrs_view = byte_str[attrs_start:attrs_start + len_path_attr]
+        self.nlri = self.unpack_prefixes(byte_str[attrs_start + len_path_attr:])
 
     def __str__(self):
-        return f"<BGPMessage type={self.msg_type} length={self.length()} withdrawn_routes={self.withdrawn_routes} path_attributes={self.path_attributes} nlri={self.nlri}>"
\ No newline at end of file
+        return f"<BGPMessage type={self.msg_type} length={self.length()} withdrawn_routes={self.withdrawn_routes} path_attributes={self.path_attributes} nlri={self.nlri}>"
+
+
+""" Packs many messages back to back into one send buffer. Each message
+    length is computed once and used both to size the buffer and to write
+    the header."""
+def pack_messages(messages):
+    lengths = [message.length() for message in messages]
+    byte_arr = bytearray(sum(lengths))
+    offset = 0
+    for message, length in zip(messages, lengths):
+        offset = message.pack_into(byte_arr, offset, length)
+    return byte_arr
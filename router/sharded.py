@@ -0,0 +1,250 @@
+""" Multi-process simulation: the topology is partitioned across worker processes.
+
+    Each shard is a `Simulation` of its own routers. Messages between routers
+    of different shards are encoded with the binary wire codec and exchanged
+    once per window of the conservative, barrier-synchronized virtual clock:
+    a window is as long as the link latency (the lookahead), so nothing sent
+    inside a window can arrive inside the same window.
+
+    Run from the router directory:
+        python sharded.py [config.json] [--shards N] [--until SECONDS]
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import struct
+import time
+from collections import deque
+
+from messages.codec import BGP_OPEN, BGP_KEEPALIVE, BGP_UPDATE, BGP_WITHDRAW, BGP_VOTE, BGP_END_OF_RIB
+from simulation import Simulation, Channel, BACKGROUND_MESSAGES
+from utils import logs
+from utils.topology import Topology
+
+# delivery time, source router, destination router, message type, frames length
+RECORD = struct.Struct("!dIIBI")
+MESSAGE_TYPES = (BGP_OPEN, BGP_KEEPALIVE, BGP_UPDATE, BGP_WITHDRAW, BGP_VOTE, BGP_END_OF_RIB)
+
+
+def adjacency(topology):
+    """Undirected neighbor sets of every router in the topology."""
+    graph = {router['id']: set() for router in topology['routers']}
+    for router in topology['routers']:
+        for neighbor_id in router['neighbors']:
+            if neighbor_id in graph and neighbor_id != router['id']:
+                graph[router['id']].add(neighbor_id)
+                graph[neighbor_id].add(router['id'])
+    return graph
+
+
+def cut_edges(graph, assignment):
+    """Number of links whose two routers live in different shards."""
+    return sum(
+        1 for router_id, neighbors in graph.items() for neighbor_id in neighbors
+        if router_id < neighbor_id and assignment[router_id] != assignment[neighbor_id]
+    )
+
+
+def partition(graph, shards, imbalance=0.05, passes=10):
+    """ Assign every router to a shard, keeping shards balanced and cutting few links.
+
+        Shards are first grown breadth first so each one is a connected
+        region, then refined by label propagation: a router moves to the shard
+        most of its neighbors are in, as long as that shard stays within
+        `imbalance` of the average size.
+    """
+    capacity = math.ceil(len(graph) / shards)
+    limit = math.ceil(capacity * (1 + imbalance))
+    assignment = {}
+    sizes = [0] * shards
+
+    unassigned = iter(sorted(graph))
+    shard = 0
+    frontier = deque()
+    while len(assignment) < len(graph):
+        if sizes[shard] >= capacity:
+            shard += 1
+            frontier.clear()
+        if not frontier:
+            seed = next(router_id for router_id in unassigned if router_id not in assignment)
+            assignment[seed] = shard
+            sizes[shard] += 1
+            frontier.append(seed)
+        router_id = frontier.popleft()
+        for neighbor_id in sorted(graph[router_id]):
+            if neighbor_id not in assignment and sizes[shard] < capacity:
+                assignment[neighbor_id] = shard
+                sizes[shard] += 1
+                frontier.append(neighbor_id)
+
+    for _ in range(passes):
+        moved = 0
+        for router_id, neighbors in graph.items():
+            current = assignment[router_id]
+            counts = {}
+            for neighbor_id in neighbors:
+                counts[assignment[neighbor_id]] = counts.get(assignment[neighbor_id], 0) + 1
+            best = max(counts, key=counts.get, default=current)
+            if counts.get(best, 0) > counts.get(current, 0) and sizes[best] < limit:
+                assignment[router_id] = best
+                sizes[current] -= 1
+                sizes[best] += 1
+                moved += 1
+        if not moved:
+            break
+    return assignment
+
+
+class ShardSimulation(Simulation):
+    """The part of a topology owned by one worker; links to other shards go through the outboxes."""
+
+    def __init__(self, topology, shard, assignment, latency=0.01, voting=True):
+        local = [router for router in topology['routers'] if assignment[router['id']] == shard]
+        super().__init__(
+            {"bgp_defaults": topology['bgp_defaults'], "routers": local},
+            latency=latency, voting=voting,
+        )
+        self.shard = shard
+        self.assignment = assignment
+        self.outboxes = {}  # shard -> bytearray of RECORD + frames
+        for router_id, router in self.routers.items():
+            for neighbor_id in router.neighbors:
+                if neighbor_id not in self.routers and neighbor_id in assignment:
+                    self.channels[(router_id, neighbor_id)] = Channel(router_id, neighbor_id, latency)
+                    self.channels[(neighbor_id, router_id)] = Channel(neighbor_id, router_id, latency)
+
+    def transmit(self, channel, msg_type, payload, wire_format):
+        if channel.dst in self.routers:
+            return super().transmit(channel, msg_type, payload, wire_format)
+        # The receiving shard counts the delivery, so in_flight only balances out across all shards
+        self.messages_sent[msg_type] = self.messages_sent.get(msg_type, 0) + 1
+        if msg_type not in BACKGROUND_MESSAGES:
+            self.in_flight += 1
+        frames = b"".join(self.routers[channel.src].codec.encode(msg_type, payload, wire_format))
+        outbox = self.outboxes.setdefault(self.assignment[channel.dst], bytearray())
+        outbox += RECORD.pack(
+            self.clock.now + channel.latency, channel.src, channel.dst, MESSAGE_TYPES.index(msg_type), len(frames)
+        )
+        outbox += frames
+
+    def receive(self, batch):
+        """Schedule the messages another shard sent to our routers during the last window."""
+        offset = 0
+        while offset < len(batch):
+            when, src, dst, type_index, length = RECORD.unpack_from(batch, offset)
+            offset += RECORD.size
+            self.clock.call_at(
+                when, self.deliver, self.channels[(src, dst)], MESSAGE_TYPES[type_index],
+                batch[offset:offset + length], True,
+            )
+            offset += length
+
+    def run_window(self, end):
+        """Run every event scheduled before `end`."""
+        while self.clock.events and self.clock.next_time() < end:
+            self.clock.step()
+
+    def take_outbox(self, shard):
+        return bytes(self.outboxes.pop(shard, b""))
+
+
+def run_shard(topology, shard, assignment, options, inboxes, barrier, next_times, in_flight, results):
+    """Worker process: simulate one shard in lockstep with the others."""
+    shards = len(inboxes)
+    logs.configure(options['log_level'])
+    simulation = ShardSimulation(topology, shard, assignment, options['latency'], options['voting'])
+    simulation.start()
+    until = options['until']
+    deadline = until if until is not None else options['max_time']
+    window = 0.0
+    round_number = 0
+
+    while True:
+        simulation.run_window(min(window + options['latency'], deadline))
+        for other in range(shards):
+            if other != shard:
+                inboxes[other].put(simulation.take_outbox(other))
+        for _ in range(shards - 1):
+            simulation.receive(inboxes[shard].get())
+
+        # Two slots per shard, alternating every round, so a shard that is
+        # already writing the next round never overwrites what others still read
+        base = (round_number % 2) * shards
+        next_time = simulation.clock.next_time()
+        next_times[base + shard] = next_time if next_time is not None else math.inf
+        in_flight[base + shard] = simulation.in_flight
+        barrier.wait()
+        window = min(next_times[base:base + shards])
+        pending = sum(in_flight[base:base + shards])
+        round_number += 1
+        if (until is None and pending == 0) or window >= deadline:
+            break
+
+    summary = simulation.summary()
+    summary["virtual_time"] = min(window, deadline) if until is not None else summary["converged_at"]
+    summary["rounds"] = round_number
+    results.put(summary)
+
+
+def run_sharded(topology, shards, latency=0.01, voting=True, until=None, max_time=3600.0, log_level="WARNING"):
+    """Partition the topology, simulate it on `shards` processes and return the merged summary."""
+    graph = adjacency(topology)
+    assignment = partition(graph, shards)
+    options = {"latency": latency, "voting": voting, "until": until, "max_time": max_time, "log_level": log_level}
+
+    context = multiprocessing.get_context()
+    inboxes = [context.Queue() for _ in range(shards)]
+    barrier = context.Barrier(shards)
+    next_times = context.Array('d', 2 * shards, lock=False)
+    in_flight = context.Array('q', 2 * shards, lock=False)
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=run_shard,
+            args=(topology, shard, assignment, options, inboxes, barrier, next_times, in_flight, results),
+        )
+        for shard in range(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    summaries = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    messages_sent = {}
+    for summary in summaries:
+        for msg_type, count in summary["messages_sent"].items():
+            messages_sent[msg_type] = messages_sent.get(msg_type, 0) + count
+    return {
+        "routers": sum(summary["routers"] for summary in summaries),
+        "shards": shards,
+        "cut_edges": cut_edges(graph, assignment),
+        "links": sum(len(neighbors) for neighbors in graph.values()) // 2,
+        "virtual_time": max(summary["virtual_time"] for summary in summaries),
+        "converged_at": max(summary["converged_at"] for summary in summaries),
+        "rounds": summaries[0]["rounds"],
+        "messages_sent": messages_sent,
+        "routes": sum(summary["routes"] for summary in summaries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("config", nargs="?", default="config.json")
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--until", type=float, default=None, help="run to this virtual time instead of convergence")
+    parser.add_argument("--latency", type=float, default=0.01, help="link latency, also the synchronization window")
+    parser.add_argument("--no-voting", action="store_true")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    topology = Topology.load(args.config).config
+    started = time.perf_counter()
+    summary = run_sharded(topology, args.shards, args.latency, not args.no_voting, args.until, log_level=args.log_level)
+    summary["wall_time"] = time.perf_counter() - started
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+""" In-process discrete-event simulation of a whole BGP topology.
+
+    Every router from the topology is a `SimRouter` living in this process,
+    sessions are in-memory channels with a fixed latency, and a virtual clock
+    replaces the timer wheel of the real runtimes for the keepalive, hold,
+    MRAI, voting and trust decay timers, so simulated time only advances
+    when there is something to do.
+
+    The routers' final Loc-RIBs can be written as MRT TABLE_DUMP_V2 files
+    and every UPDATE delivered recorded as a BGP4MP trace (timestamps are
+    virtual seconds), for replay and analysis with standard MRT tools.
+    With metrics on, every router reports to one shared registry, read
+    through `metrics_snapshot`. --profile writes a flamegraph-ready
+    collapsed stack file and per-subsystem times of the whole run.
+
+    Run from the router directory:
+        python simulation.py [config.json] [--until SECONDS] [--mrt-dump DIR] [--mrt-updates FILE] [--metrics]
+                             [--profile DIR [--profile-mode sample|cprofile]]
+"""
+import argparse
+import heapq
+import itertools
+import json
+import os
+import time
+
+from bgp_simulation import BGP_Router
+from messages.codec import BGP_KEEPALIVE, BGP_VOTE, WIRE_BINARY, BGP_OPEN, BGP_UPDATE, BGP_WITHDRAW
+from messages.framing import unpack_header
+from messages.message_base import BGP_HEADER_LEN
+from utils import logs
+from utils.metrics import MetricsRegistry
+from utils.profiling import Profiler, SAMPLE, CPROFILE
+from utils.mrt import MrtWriter, dump_routing_table, open_dump
+from utils.routing_table import parse_network
+from utils.topology import Topology
+
+# Periodic messages that neither carry routes nor keep the simulation from converging
+BACKGROUND_MESSAGES = (BGP_KEEPALIVE, BGP_VOTE)
+
+
+class ScheduledCall:
+    """An event on the virtual clock; a cancelled one is skipped when its time comes."""
+    __slots__ = ("callback", "args", "cancelled")
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock:
+    """Event queue ordered by virtual time; time jumps straight to the next event."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()  # keeps events at the same instant in FIFO order
+
+    def __len__(self):
+        return len(self.events)
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        call = ScheduledCall(callback, args)
+        heapq.heappush(self.events, (when, next(self.sequence), call))
+        return call
+
+    def next_time(self):
+        return self.events[0][0] if self.events else None
+
+    def step(self):
+        """Run the next event. Returns False when nothing is scheduled."""
+        if not self.events:
+            return False
+        self.now, _, call = heapq.heappop(self.events)
+        if not call.cancelled:
+            call.callback(*call.args)
+        return True
+
+
+class Channel:
+    """One direction of an in-memory session between two simulated routers."""
+
+    def __init__(self, src, dst, latency):
+        self.src = src
+        self.dst = dst
+        self.latency = latency
+        self.up = True
+
+
+class SimRouter(BGP_Router):
+    """BGP_Router whose sockets are channels and whose timers run on the simulation clock."""
+
+    def __init__(self, router_id, simulation, router_config, bgp_defaults):
+        self.simulation = simulation
+        self.running = False
+        super().__init__(router_id, router_config, bgp_defaults)
+
+    def now(self):
+        return self.simulation.clock.now
+
+    def start_router(self):
+        """Sessions are brought up by `Simulation.start` once every router exists."""
+
+    def start(self):
+        self.running = True
+        for neighbor_id in self.neighbors:
+            self.open_session(neighbor_id)
+        if self.simulation.voting:
+            self.start_timers()
+        self.start_restart_timers()
+
+    def stop(self):
+        self.running = False
+
+    def open_session(self, neighbor_id):
+        """Attach the channel to a neighbor; the lower router ID sends the OPEN."""
+        channel = self.simulation.channels.get((self.router_id, neighbor_id))
+        if channel is None or not channel.up:
+            return
+        self.sockets[neighbor_id] = channel
+        self.start_session_timers(neighbor_id)
+        if self.router_id < neighbor_id:
+            self.open_sent.add(neighbor_id)
+            self.send_message(channel, BGP_OPEN)
+
+    def start_timer(self, delay, callback, *args):
+        """Timers are events on the simulation clock; they stop firing once the router is stopped."""
+        def fire():
+            if self.running:
+                callback(*args)
+
+        return self.simulation.clock.call_later(delay, fire)
+
+    def call_later(self, delay, callback, *args):
+        """Timers such as MRAI count as work in flight, so the simulation does not stop before they fire."""
+        def fire():
+            self.simulation.in_flight -= 1
+            if self.running:
+                callback(*args)
+
+        self.simulation.in_flight += 1
+        self.simulation.clock.call_later(delay, fire)
+
+    def send_message(self, channel, msg_type, payload=None, wire_format=WIRE_BINARY):
+        if msg_type == BGP_OPEN and payload is None:
+            # What the codec would decode from our OPEN when messages are not encoded
+            payload = {"as": self.codec.as_num, "hold_time": self.hold_timer, "ip": self.ip, "capabilities": self.codec.capabilities()}
+        self.simulation.transmit(channel, msg_type, payload, wire_format)
+        return True
+
+
+class Simulation:
+    def __init__(self, topology, latency=0.01, encode=False, voting=True, metrics=False):
+        """ Build one SimRouter per router in a config.json style topology.
+
+            `encode` sends every message through the wire codec instead of
+            handing the message dicts over directly. The routers log through
+            `utils.logs`, so how much they say is set by its log level.
+            `metrics` instruments every router into one MetricsRegistry.
+        """
+        self.clock = VirtualClock()
+        self.encode = encode
+        self.voting = voting
+        self.bgp_defaults = topology['bgp_defaults']
+        self.messages_sent = {}
+        self.in_flight = 0  # OPEN/UPDATE/WITHDRAW messages not delivered yet, plus pending router timers
+        self.last_route_change = 0.0
+        self.mrt = None  # MrtWriter recording delivered UPDATEs, see record_updates
+        self._mrt_file = None
+        self.metrics = MetricsRegistry() if metrics else None
+
+        router_configs = {router['id']: router for router in topology['routers']}
+        self.channels = {}
+        for router_id, router_config in router_configs.items():
+            for neighbor_id in router_config['neighbors']:
+                if neighbor_id in router_configs:
+                    self.channels[(router_id, neighbor_id)] = Channel(router_id, neighbor_id, latency)
+
+        self.routers = {
+            router_id: SimRouter(router_id, self, router_config, self.bgp_defaults)
+            for router_id, router_config in router_configs.items()
+        }
+        if self.metrics is not None:
+            for router in self.routers.values():
+                router.enable_metrics(self.metrics)
+
+    @classmethod
+    def from_config(cls, path="config.json", **kwargs):
+        return cls(Topology.load(path).config, **kwargs)
+
+    def transmit(self, channel, msg_type, payload, wire_format):
+        self.messages_sent[msg_type] = self.messages_sent.get(msg_type, 0) + 1
+        if msg_type not in BACKGROUND_MESSAGES:
+            self.in_flight += 1
+        item = b"".join(self.routers[channel.src].codec.encode(msg_type, payload, wire_format)) if self.encode else payload
+        self.clock.call_later(channel.latency, self.deliver, channel, msg_type, item, self.encode)
+
+    def deliver(self, channel, msg_type, item, encoded=False):
+        """Hand a message to the receiving router. An `encoded` item is the framed bytes of the message."""
+        if msg_type not in BACKGROUND_MESSAGES:
+            self.in_flight -= 1
+            self.last_route_change = self.clock.now
+        router = self.routers[channel.dst]
+        if not channel.up or not router.running:
+            return
+        if encoded:
+            messages = []
+            offset = 0
+            while offset < len(item):
+                length, frame_type = unpack_header(item, offset)
+                messages.extend(router.codec.decode(frame_type, memoryview(item)[offset + BGP_HEADER_LEN:offset + length]))
+                offset += length
+        else:
+            messages = [{"type": msg_type, "payload": item}]
+        for message in messages:
+            if self.mrt is not None and message['type'] in (BGP_UPDATE, BGP_WITHDRAW):
+                self.record_update(channel, message)
+            router.process_message(channel.src, message)
+
+    def record_updates(self, path):
+        """Record every UPDATE and withdrawal delivered from now on to a BGP4MP file."""
+        self._mrt_file = open_dump(path, "wb")
+        self.mrt = MrtWriter(self._mrt_file)
+
+    def stop_recording(self):
+        if self._mrt_file is not None:
+            self._mrt_file.close()
+        self.mrt = self._mrt_file = None
+
+    def record_update(self, channel, message):
+        peer = self.routers[channel.src]
+        local = self.routers[channel.dst]
+        header = (self.clock.now, channel.src, channel.dst, peer.ip, local.ip)
+        if message['type'] == BGP_WITHDRAW:
+            withdrawn = [parse_network(route['network']) for route in message['payload']]
+            self.mrt.update(*header, withdrawn=[(int(key.network_address), key.prefixlen) for key in withdrawn])
+            return
+        by_path = {}
+        for route in message['payload']:
+            key = parse_network(route['network'])
+            by_path.setdefault(tuple(route['as_path']), []).append((int(key.network_address), key.prefixlen))
+        for as_path, announced in by_path.items():
+            self.mrt.update(*header, announced=announced, as_path=as_path, next_hop=peer.ip)
+
+    def dump_mrt(self, directory):
+        """Write the Loc-RIB of every router to <directory>/Router<ID>.mrt. Returns the file names."""
+        os.makedirs(directory, exist_ok=True)
+        peer_ips = {router_id: router.ip for router_id, router in self.routers.items()}
+        paths = []
+        for router_id, router in self.routers.items():
+            path = os.path.join(directory, f"Router{router_id}.mrt")
+            dump_routing_table(path, router.routing_table, peer_ips, router.ip, self.clock.now)
+            paths.append(path)
+        return paths
+
+    def start(self):
+        for router in self.routers.values():
+            router.start()
+
+    def run(self, until):
+        """Advance the simulation up to virtual time `until`."""
+        while self.clock.events and self.clock.next_time() <= until:
+            self.clock.step()
+        self.clock.now = max(self.clock.now, until)
+
+    def run_until_converged(self, max_time=3600.0):
+        """Run until no OPEN/UPDATE/WITHDRAW or MRAI timer is pending. Returns the virtual time of the last one delivered."""
+        deadline = self.clock.now + max_time
+        while self.in_flight and self.clock.events and self.clock.next_time() <= deadline:
+            self.clock.step()
+        return self.last_route_change
+
+    def fail_link(self, a, b):
+        """Silently drop everything between two routers; their hold timers notice."""
+        self.channels[(a, b)].up = False
+        self.channels[(b, a)].up = False
+
+    def restore_link(self, a, b):
+        self.channels[(a, b)].up = True
+        self.channels[(b, a)].up = True
+        self.routers[a].open_session(b)
+        self.routers[b].open_session(a)
+
+    def fail_router(self, router_id):
+        self.routers[router_id].stop()
+
+    def restart_router(self, router_id):
+        """ Bounce a router: its sessions close and a fresh router with the same
+            config starts in its place, warm if the config names a checkpoint."""
+        old = self.routers[router_id]
+        if old.checkpoint_path:
+            old.checkpoint()
+        old.stop()
+        for neighbor_id in old.neighbors:
+            neighbor = self.routers.get(neighbor_id)
+            if neighbor is not None and neighbor.running and router_id in neighbor.sockets:
+                neighbor.session_closed(router_id)
+        router = self.routers[router_id] = SimRouter(router_id, self, old.config, self.bgp_defaults)
+        if self.metrics is not None:
+            router.enable_metrics(self.metrics)
+        router.start()
+        for neighbor_id in router.neighbors:
+            neighbor = self.routers.get(neighbor_id)
+            if neighbor is not None and neighbor.running:
+                neighbor.open_session(router_id)
+        return router
+
+    def metrics_snapshot(self):
+        """Every router's metrics as plain data (see `MetricsRegistry.snapshot`), or None with metrics off."""
+        return self.metrics.snapshot() if self.metrics is not None else None
+
+    def summary(self):
+        return {
+            "routers": len(self.routers),
+            "virtual_time": self.clock.now,
+            "converged_at": self.last_route_change,
+            "messages_sent": dict(self.messages_sent),
+            "routes": sum(len(router.routing_table) for router in self.routers.values()),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("config", nargs="?", default="config.json")
+    parser.add_argument("--until", type=float, default=None, help="run to this virtual time instead of convergence")
+    parser.add_argument("--encode", action="store_true", help="send messages through the wire codec")
+    parser.add_argument("--no-voting", action="store_true")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--mrt-dump", metavar="DIR", help="write every router's Loc-RIB as TABLE_DUMP_V2 into DIR")
+    parser.add_argument("--mrt-updates", metavar="FILE", help="record the delivered UPDATEs as BGP4MP")
+    parser.add_argument("--metrics", action="store_true", help="instrument the routers and add their metrics to the summary")
+    parser.add_argument("--profile", metavar="DIR", help="profile the run and write the results into DIR")
+    parser.add_argument("--profile-mode", choices=(SAMPLE, CPROFILE), default=SAMPLE)
+    args = parser.parse_args()
+
+    logs.configure(args.log_level)
+    started = time.perf_counter()
+    simulation = Simulation.from_config(
+        args.config, encode=args.encode, voting=not args.no_voting, metrics=args.metrics
+    )
+    if args.mrt_updates:
+        simulation.record_updates(args.mrt_updates)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(list(simulation.routers.values()), args.profile, args.profile_mode)
+        profiler.start()
+    simulation.start()
+    if args.until is None:
+        simulation.run_until_converged()
+    else:
+        simulation.run(args.until)
+    if profiler is not None:
+        profiler.stop()
+    simulation.stop_recording()
+    if args.mrt_dump:
+        simulation.dump_mrt(args.mrt_dump)
+    summary = simulation.summary()
+    summary["wall_time"] = time.perf_counter() - started
+    if args.metrics:
+        summary["metrics"] = simulation.metrics_snapshot()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
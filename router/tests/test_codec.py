@@ -0,0 +1,228 @@
+""" Round trips through MessageCodec: every message type is encoded to
+    frames and decoded back to the message dicts the router works with.
+
+    Run from the router directory:
+        python -m pytest tests    (or python -m unittest discover tests)
+"""
+import json
+import socket
+import unittest
+
+from messages.attributes import ATTR_EXTENDED, BgpAttributeType, MAX_SEGMENT_ASNS
+from messages.codec import (
+    BGP_END_OF_RIB, BGP_KEEPALIVE, BGP_OPEN, BGP_UPDATE, BGP_VOTE, BGP_WITHDRAW,
+    VOTE_TRUSTED, VOTE_UNTRUSTED, WIRE_JSON, MessageCodec,
+)
+from messages.framing import MessageReader, unpack_header
+from messages.message_base import (
+    BGP_HEADER_LEN, BGP_MAX_LENGTH, CAPABILITY_FOUR_OCTET_AS, CAPABILITY_GRACEFUL_RESTART,
+    CAPABILITY_JSON_WIRE_FORMAT, CAPABILITY_VOTE, BgpMessageType, BgpMessageUpdate,
+)
+
+
+def split_frames(frames):
+    """[(frame type, body)] of every BGP message in a list of encoded buffers."""
+    data = b"".join(frames)
+    messages = []
+    offset = 0
+    while offset < len(data):
+        length, frame_type = unpack_header(data, offset)
+        messages.append((frame_type, data[offset + BGP_HEADER_LEN:offset + length]))
+        offset += length
+    return messages
+
+
+def network(i):
+    """The i-th /24 under 10.0.0.0/8, as the (network, prefix length) pair decoding yields."""
+    return (10 << 24) | (i << 8), 24
+
+
+class CodecTestCase(unittest.TestCase):
+    def setUp(self):
+        self.codec = MessageCodec(70000, "10.0.0.1", 90, restart_time=120)
+
+    def round_trip(self, msg_type, payload=None, wire_format=None):
+        kwargs = {} if wire_format is None else {"wire_format": wire_format}
+        decoded = []
+        for frame_type, body in split_frames(self.codec.encode(msg_type, payload, **kwargs)):
+            decoded.extend(self.codec.decode(frame_type, body))
+        return decoded
+
+    def announced(self, decoded):
+        """{network: route} of the UPDATE messages in `decoded`."""
+        return {route["network"]: route for message in decoded if message["type"] == BGP_UPDATE
+                for route in message["payload"]}
+
+
+class TestOpen(CodecTestCase):
+    def test_open_carries_capabilities(self):
+        [message] = self.round_trip(BGP_OPEN)
+        self.assertEqual(message["type"], BGP_OPEN)
+        payload = message["payload"]
+        self.assertEqual(payload["ip"], "10.0.0.1")
+        self.assertEqual(payload["hold_time"], 90)
+        capabilities = payload["capabilities"]
+        self.assertEqual(capabilities, self.codec.capabilities())
+        self.assertIn(CAPABILITY_VOTE, capabilities)
+        self.assertNotIn(CAPABILITY_JSON_WIRE_FORMAT, capabilities)
+        self.assertTrue(self.codec.supports_votes(capabilities))
+        self.assertEqual(self.codec.peer_restart_time(capabilities), 120)
+
+    def test_four_octet_as(self):
+        [message] = self.round_trip(BGP_OPEN)
+        capabilities = message["payload"]["capabilities"]
+        self.assertEqual(int.from_bytes(capabilities[CAPABILITY_FOUR_OCTET_AS], "big"), 70000)
+
+    def test_json_capability_negotiation(self):
+        json_codec = MessageCodec(2, "10.0.0.2", 90, wire_format=WIRE_JSON)
+        capabilities = json_codec.capabilities()
+        self.assertIn(CAPABILITY_JSON_WIRE_FORMAT, capabilities)
+        self.assertNotIn(CAPABILITY_GRACEFUL_RESTART, capabilities)
+        self.assertEqual(json_codec.negotiate(capabilities), WIRE_JSON)
+        self.assertNotEqual(json_codec.negotiate(self.codec.capabilities()), WIRE_JSON)
+        self.assertNotEqual(self.codec.negotiate(capabilities), WIRE_JSON)
+
+
+class TestKeepaliveAndEndOfRib(CodecTestCase):
+    def test_keepalive(self):
+        self.assertEqual(self.round_trip(BGP_KEEPALIVE), [{"type": BGP_KEEPALIVE, "payload": None}])
+
+    def test_end_of_rib(self):
+        self.assertEqual(self.round_trip(BGP_END_OF_RIB), [{"type": BGP_END_OF_RIB, "payload": None}])
+
+
+class TestUpdate(CodecTestCase):
+    def assert_path_round_trips(self, length):
+        as_path = tuple(range(65530, 65530 + length))  # crosses 65535, so needs 4-octet AS numbers
+        routes = [{"network": "10.0.0.0/8", "next_hop": 1, "as_path": list(as_path)}]
+        [route] = self.announced(self.round_trip(BGP_UPDATE, routes)).values()
+        self.assertEqual(route["as_path"], as_path)
+        self.assertEqual(route["network"], (10 << 24, 8))
+        self.assertEqual(route["next_hop"], "10.0.0.1")
+
+    def test_single_as_path(self):
+        self.assert_path_round_trips(1)
+
+    def test_full_segment(self):
+        self.assert_path_round_trips(MAX_SEGMENT_ASNS)
+
+    def test_multi_segment_paths(self):
+        for length in (MAX_SEGMENT_ASNS + 1, 299, 3 * MAX_SEGMENT_ASNS + 7):
+            with self.subTest(length=length):
+                self.assert_path_round_trips(length)
+
+    def test_long_path_uses_segments_and_extended_length(self):
+        routes = [{"network": "10.0.0.0/8", "next_hop": 1, "as_path": list(range(1, 300))}]
+        [(frame_type, body)] = split_frames(self.codec.encode(BGP_UPDATE, routes))
+        update = BgpMessageUpdate(asn_size=4)
+        update.unpack_payload(body)
+        as_path = update.attribute(BgpAttributeType.AS_PATH)
+        self.assertTrue(as_path.flags & ATTR_EXTENDED)
+        # Two segment headers, then 299 four-octet AS numbers
+        self.assertEqual(as_path.length, 2 * 2 + 4 * 299)
+        self.assertEqual(as_path.data["asns"], list(range(1, 300)))
+
+    def test_med_and_origin(self):
+        routes = [
+            {"network": "10.1.0.0/16", "next_hop": 1, "as_path": [1, 2], "med": 50, "origin": 2},
+            {"network": "10.2.0.0/16", "next_hop": 1, "as_path": [1, 2]},
+        ]
+        announced = self.announced(self.round_trip(BGP_UPDATE, routes))
+        with_attributes, without = announced[(10 << 24 | 1 << 16, 16)], announced[(10 << 24 | 2 << 16, 16)]
+        self.assertEqual(with_attributes["med"], 50)
+        self.assertEqual(with_attributes["origin"], 2)
+        self.assertNotIn("med", without)
+        self.assertNotIn("origin", without)
+
+    def test_routes_grouped_by_path(self):
+        routes = [{"network": f"10.0.{i}.0/24", "next_hop": 1, "as_path": [1, 2 + i % 3]} for i in range(30)]
+        frames = split_frames(self.codec.encode(BGP_UPDATE, routes))
+        self.assertEqual(len(frames), 3)
+        announced = self.announced(self.round_trip(BGP_UPDATE, routes))
+        self.assertEqual(len(announced), 30)
+        for i in range(30):
+            self.assertEqual(announced[network(i)]["as_path"], (1, 2 + i % 3))
+
+    def test_many_prefixes_split_across_messages(self):
+        routes = [{"network": network(i), "next_hop": 1, "as_path": [1]} for i in range(40000)]
+        frames = split_frames(self.codec.encode(BGP_UPDATE, routes))
+        self.assertGreater(len(frames), 1)
+        self.assertTrue(all(BGP_HEADER_LEN + len(body) <= BGP_MAX_LENGTH for _, body in frames))
+        self.assertEqual(set(self.announced(self.round_trip(BGP_UPDATE, routes))), {network(i) for i in range(40000)})
+
+
+class TestWithdraw(CodecTestCase):
+    def test_withdrawals(self):
+        routes = [{"network": f"10.0.{i}.0/24"} for i in range(10)] + [{"network": "192.168.1.128/25"}]
+        [message] = self.round_trip(BGP_WITHDRAW, routes)
+        self.assertEqual(message["type"], BGP_WITHDRAW)
+        self.assertEqual(
+            [route["network"] for route in message["payload"]],
+            [network(i) for i in range(10)] + [(0xc0a80180, 25)],
+        )
+
+    def test_many_withdrawals_split_across_messages(self):
+        routes = [{"network": network(i)} for i in range(30000)]
+        frames = split_frames(self.codec.encode(BGP_WITHDRAW, routes))
+        self.assertGreater(len(frames), 1)
+        withdrawn = [route["network"] for message in self.round_trip(BGP_WITHDRAW, routes) for route in message["payload"]]
+        self.assertEqual(withdrawn, [network(i) for i in range(30000)])
+
+
+class TestVote(CodecTestCase):
+    def test_votes(self):
+        votes = [(2, VOTE_TRUSTED), (3, VOTE_UNTRUSTED), (70000, VOTE_TRUSTED)]
+        [message] = self.round_trip(BGP_VOTE, votes)
+        self.assertEqual(message["type"], BGP_VOTE)
+        self.assertEqual(list(message["payload"]), votes)
+
+
+class TestJsonFallback(CodecTestCase):
+    def test_json_round_trip(self):
+        routes = [{"network": "10.0.0.0/8", "next_hop": 1, "as_path": [1, 2]}]
+        frames = split_frames(self.codec.encode(BGP_UPDATE, routes, WIRE_JSON))
+        self.assertEqual([frame_type for frame_type, _ in frames], [BgpMessageType.JSON.value])
+        self.assertEqual(self.round_trip(BGP_UPDATE, routes, WIRE_JSON), [{"type": BGP_UPDATE, "payload": routes}])
+
+    def test_open_and_keepalive_stay_binary(self):
+        for msg_type in (BGP_OPEN, BGP_KEEPALIVE):
+            with self.subTest(msg_type=msg_type):
+                [(frame_type, _)] = split_frames(self.codec.encode(msg_type, wire_format=WIRE_JSON))
+                self.assertNotEqual(frame_type, BgpMessageType.JSON.value)
+
+    def test_oversized_payload_is_split(self):
+        routes = [{"network": f"10.{i // 256}.{i % 256}.0/24", "next_hop": 1, "as_path": [1, 2, 3]} for i in range(5000)]
+        self.assertGreater(len(json.dumps({"type": BGP_UPDATE, "payload": routes})), BGP_MAX_LENGTH)
+        frames = split_frames(self.codec.encode(BGP_UPDATE, routes, WIRE_JSON))
+        self.assertGreater(len(frames), 1)
+        self.assertTrue(all(BGP_HEADER_LEN + len(body) <= BGP_MAX_LENGTH for _, body in frames))
+        decoded = self.round_trip(BGP_UPDATE, routes, WIRE_JSON)
+        self.assertTrue(all(message["type"] == BGP_UPDATE for message in decoded))
+        self.assertEqual([route for message in decoded for route in message["payload"]], routes)
+
+
+class TestStream(CodecTestCase):
+    def test_messages_read_from_a_socket(self):
+        sent = [
+            (BGP_OPEN, None),
+            (BGP_UPDATE, [{"network": "10.0.0.0/8", "next_hop": 1, "as_path": list(range(1, 600))}]),
+            (BGP_WITHDRAW, [{"network": "10.0.0.0/8"}]),
+            (BGP_VOTE, [(2, VOTE_TRUSTED)]),
+            (BGP_END_OF_RIB, None),
+            (BGP_KEEPALIVE, None),
+        ]
+        ours, theirs = socket.socketpair()
+        with ours, theirs:
+            for msg_type, payload in sent:
+                ours.sendall(b"".join(self.codec.encode(msg_type, payload)))
+            ours.shutdown(socket.SHUT_WR)
+            received = [
+                message for frame_type, body in MessageReader(theirs)
+                for message in self.codec.decode(frame_type, body)
+            ]
+        self.assertEqual([message["type"] for message in received], [msg_type for msg_type, _ in sent])
+        self.assertEqual(received[1]["payload"][0]["as_path"], tuple(range(1, 600)))
+
+
+if __name__ == "__main__":
+    unittest.main()
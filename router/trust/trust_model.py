@@ -1,43 +1,145 @@
+""" Per-neighbor trust scores.
+
+    Trust is kept in dense arrays indexed by a slot per neighbor instead of
+    per-neighbor dicts, and the total trust of every neighbor is computed in
+    one pass and cached until a vote or decay changes it. Best-path
+    selection reads the cached scores, so ranking the candidates of a full
+    table costs dict lookups rather than a trust calculation per route.
+    NumPy is used for the array arithmetic when it is installed.
+"""
+from array import array
+
+from utils.logs import get_logger
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = get_logger("trust")
+
+VOTE_STEPS = {'trusted': 0.1, 'untrusted': -0.1}
+
+
 class TrustModel:
     def __init__(self, direct_trust, direct_weight=0.6, voted_weight=0.4):
-        """Initialize the trust model with direct trust, weights for trust calculation, and a trust threshold."""
+        """Initialize the trust model with direct trust and the weights for the trust calculation."""
         self.direct_trust = direct_trust
-        self.indirect_voted_trust = {}
         self.direct_weight = direct_weight
         self.indirect_voted_weight = voted_weight
+        self.slots = {}  # neighbor ID -> index into the arrays, in slot order
+        self.direct = array("d")
+        self.voted = array("d")
+        self._totals = None  # cached total trust per slot, None once a vote or decay changed it
+        self._score_map = {}  # neighbor ID -> cached total trust
 
-    def update_voted_trust(self, neighbor_id, vote):
-        """Update trust scores based on votes."""
-        if neighbor_id not in self.indirect_voted_trust:
-            self.indirect_voted_trust[neighbor_id] = 0
-
-        if vote == 'trusted':
-            self.indirect_voted_trust[neighbor_id] += 0.1
-        elif vote == 'untrusted':
-            self.indirect_voted_trust[neighbor_id] -= 0.1
-        else:
-            print(f"Unexpected vote value: {vote} from Router {neighbor_id}")
-            return
+    def slot(self, neighbor_id):
+        """The array index of a neighbor, adding the neighbor if it is new."""
+        slot = self.slots.get(neighbor_id)
+        if slot is None:
+            slot = self.slots[neighbor_id] = len(self.direct)
+            # direct_trust is a single score in config.json, but may also be given per neighbor
+            direct = self.direct_trust.get(neighbor_id, 0) if isinstance(self.direct_trust, dict) else self.direct_trust
+            self.direct.append(direct)
+            self.voted.append(0.0)
+            self._invalidate()
+        return slot
 
-            # Normalize the value between 0 and 10
-        self.indirect_voted_trust[neighbor_id] = max(0.0, min(1.0, self.indirect_voted_trust[neighbor_id]))
+    def _invalidate(self):
+        self._totals = None
+        self._score_map = {}
 
+    def totals(self):
+        """Total trust of every neighbor by slot, recomputed only after votes or decay."""
+        if self._totals is None:
+            if numpy is not None:
+                # Views of the arrays must not outlive this block, or appending a neighbor fails
+                totals = (self.direct_weight * numpy.frombuffer(self.direct)
+                          + self.indirect_voted_weight * numpy.frombuffer(self.voted))
+                self._score_map = dict(zip(self.slots, totals.tolist()))
+            else:
+                totals = array("d", (
+                    self.direct_weight * direct + self.indirect_voted_weight * voted
+                    for direct, voted in zip(self.direct, self.voted)
+                ))
+                self._score_map = dict(zip(self.slots, totals))
+            self._totals = totals
+        return self._totals
+
+    def score_map(self):
+        """The cached {neighbor ID: total trust} of every known neighbor. Replaced, not updated, on changes."""
+        self.totals()
+        return self._score_map
+
+    def scores(self, neighbor_ids):
+        """Total trust of several neighbors at once, as a NumPy array if available, else a list."""
+        slots = [self.slot(neighbor_id) for neighbor_id in neighbor_ids]
+        totals = self.totals()
+        if numpy is not None:
+            return totals[numpy.array(slots, dtype=numpy.intp)]
+        return [totals[slot] for slot in slots]
 
     def get_trust_score(self, neighbor_id):
         """Get the trust score of a neighbor."""
-        return self.calculate_total_trust(neighbor_id)
+        score = self._score_map.get(neighbor_id)
+        if score is None:
+            return self.calculate_total_trust(neighbor_id)
+        return score
 
     def calculate_total_trust(self, neighbor_id):
         """Calculate total trust as a combination of direct trust and voted trust."""
-        direct = self.direct_trust.get(neighbor_id, 0)
-        voted = self.indirect_voted_trust.get(neighbor_id, 0)
-        total_trust = (self.direct_weight * direct) + (self.indirect_voted_weight * voted)
-        print(f"Total trust for Router {neighbor_id}: {total_trust} (Direct: {direct}, Voted: {voted})")
-        return total_trust
+        slot = self.slot(neighbor_id)
+        return float(self.totals()[slot])
+
+    def apply_votes(self, votes):
+        """Apply a round of {neighbor ID: 'trusted' or 'untrusted'} votes, keeping voted trust between 0 and 1."""
+        slots = []
+        steps = []
+        for neighbor_id, vote in votes.items():
+            step = VOTE_STEPS.get(vote)
+            if step is None:
+                log.warning("Unexpected vote value: %s from Router %s", vote, neighbor_id)
+                continue
+            slots.append(self.slot(neighbor_id))
+            steps.append(step)
+        if not slots:
+            return
+        if numpy is not None:
+            voted = numpy.frombuffer(self.voted)
+            index = numpy.array(slots, dtype=numpy.intp)
+            voted[index] = numpy.clip(voted[index] + numpy.array(steps), 0.0, 1.0)
+            del voted
+        else:
+            voted = self.voted
+            for slot, step in zip(slots, steps):
+                voted[slot] = max(0.0, min(1.0, voted[slot] + step))
+        self._invalidate()
 
+    def update_voted_trust(self, neighbor_id, vote):
+        """Update trust scores based on a single vote."""
+        self.apply_votes({neighbor_id: vote})
 
     def decay_trust_over_time(self, neighbor_id, decay_rate=0.01):
         """Decay the trust score for a neighbor over time if there are no interactions."""
-        if neighbor_id in self.indirect_voted_trust:
-            self.indirect_voted_trust[neighbor_id] = max(0, self.indirect_voted_trust[neighbor_id] - decay_rate)
-            print(f"Trust for Router {neighbor_id} decayed to {self.indirect_voted_trust[neighbor_id]}")
\ No newline at end of file
+        slot = self.slots.get(neighbor_id)
+        if slot is not None:
+            self.voted[slot] = max(0.0, self.voted[slot] - decay_rate)
+            self._invalidate()
+            log.debug("Trust for Router %s decayed to %s", neighbor_id, self.voted[slot])
+
+    def decay_all(self, decay_rate=0.01):
+        """Decay the voted trust of every neighbor at once."""
+        if not self.voted:
+            return
+        if numpy is not None:
+            voted = numpy.frombuffer(self.voted)
+            numpy.maximum(voted - decay_rate, 0.0, out=voted)
+            del voted
+        else:
+            self.voted = array("d", (max(0.0, voted - decay_rate) for voted in self.voted))
+        self._invalidate()
+
+    @property
+    def indirect_voted_trust(self):
+        """Voted trust as {neighbor ID: score}."""
+        return dict(zip(self.slots, self.voted))
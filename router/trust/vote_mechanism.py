@@ -1,32 +1,70 @@
-import random
-# TODO: Enhance and Implement the VotingMechanism class
+from messages.codec import VOTE_TRUSTED, VOTE_UNTRUSTED
+from utils.logs import get_logger
+
+log = get_logger("voting")
+
+# Routes with an AS path at least this long count against the neighbor they were learned from
+LONG_AS_PATH = 4
+
+
 class VotingMechanism:
     def __init__(self, router_id, neighbors):
-        """Initialize the voting mechanism for a router."""
+        """ Initialize the voting mechanism for a router.
+
+            Keeps, per neighbor, how many Loc-RIB routes learned via that
+            neighbor have a short and a long AS path. `route_changed` updates
+            the counts as routes enter and leave the RIB, so a round of votes
+            costs one step per neighbor instead of a walk over the table.
+        """
         self.router_id = router_id
         self.neighbors = neighbors
+        self.neighbor_ids = set(neighbors)
+        self.short_paths = {}  # neighbor ID -> routes via it with a short AS path
+        self.long_paths = {}  # neighbor ID -> routes via it with a long AS path
         self.votes = {}
 
-    def cast_vote(self, neighbor_id, as_path):
-        """Cast a vote for a neighbor, either trusting them or not."""
-       # vote = random.uniform(0.5, 1.0)  # Randomly generate a trust score between 0.5 and 1.0
+    def _count(self, route, step):
+        counts = self.long_paths if len(route.as_path) >= LONG_AS_PATH else self.short_paths
+        count = counts.get(route.next_hop, 0) + step
+        if count:
+            counts[route.next_hop] = count
+        else:
+            del counts[route.next_hop]
+
+    def route_changed(self, old_route, new_route):
+        """Account for a Loc-RIB change; either route may be None."""
+        if old_route is not None:
+            self._count(old_route, -1)
+        if new_route is not None:
+            self._count(new_route, 1)
 
-        vote = 'trusted' if len(as_path) < 4 else 'untrusted'
+    def cast_vote(self, neighbor_id):
+        """ Vote on a neighbor from the routes learned via it: trusted unless
+            most of them have long AS paths. Returns None without routes."""
+        short = self.short_paths.get(neighbor_id, 0)
+        long = self.long_paths.get(neighbor_id, 0)
+        if not short and not long:
+            return None
+        vote = VOTE_TRUSTED if short >= long else VOTE_UNTRUSTED
         self.votes[neighbor_id] = vote
-        # print(f"Router {self.router_id} cast vote for Router {neighbor_id}: {vote}")
         return vote
 
-    def exchange_votes(self, routing_table):
-        """Simulate the exchange of votes with neighbors."""
+    def exchange_votes(self):
+        """Cast this round's votes on every neighbor we have routes from, as {neighbor ID: vote}."""
         votes_result = {}
         for neighbor_id in self.neighbors:
-            for route in routing_table.table:
-                vote = self.cast_vote(neighbor_id, route['as_path'])
+            vote = self.cast_vote(neighbor_id)
+            if vote is not None:
                 votes_result[neighbor_id] = vote
-                print(f"{self.router_id} votes {vote} for {neighbor_id} with AS path: {route['as_path']}")
+                log.debug("%s votes %s for %s", self.router_id, vote, neighbor_id)
         return votes_result
 
-    def receive_votes(self, votes_from_others):
-        """Receive votes from other routers and update local trust values."""
-        for neighbor_id, vote in votes_from_others.items():
-            print(f"Router {self.router_id} received vote from Router {neighbor_id}: {vote}")
\ No newline at end of file
+    def receive_votes(self, voter_id, votes_from_others):
+        """ Take the votes a neighbor sent in a VOTE message and return the
+            ones about our own neighbors, as {neighbor ID: vote}."""
+        accepted = {}
+        for neighbor_id, vote in votes_from_others:
+            if neighbor_id in self.neighbor_ids and neighbor_id != voter_id:
+                accepted[neighbor_id] = vote
+                log.debug("Router %s received vote from Router %s on Router %s: %s", self.router_id, voter_id, neighbor_id, vote)
+        return accepted
@@ -0,0 +1,140 @@
+""" Route flap damping (RFC 2439).
+
+    Every (prefix, neighbor) pair that flaps gets a penalty that grows by a
+    fixed amount per withdrawal or attribute change and halves every
+    `half_life` seconds. The decay is applied lazily whenever the penalty
+    is read, from the stored value and the time it was last updated, so
+    nothing walks the flap history periodically.
+
+    A route whose penalty reaches the suppress threshold stays in the
+    Adj-RIB-In but is not selected or advertised until the penalty has
+    decayed to the reuse threshold. The reuse list is the router's timer
+    wheel: each pair with history has one timer, due when it can be reused
+    or, once usable, when its history can be forgotten (below half the
+    reuse threshold). Flaps in between do not move the timer; when it
+    fires the penalty is read again and the timer set for the new time.
+"""
+import math
+import time
+
+from utils.logs import get_logger
+
+log = get_logger("damping")
+
+# Defaults used by most router implementations
+HALF_LIFE = 900
+SUPPRESS_THRESHOLD = 2000
+REUSE_THRESHOLD = 750
+MAX_SUPPRESS_TIME = 3600
+WITHDRAW_PENALTY = 1000
+CHANGE_PENALTY = 500
+
+
+class FlapHistory:
+    """The damping state of one (prefix, neighbor) pair."""
+    __slots__ = ("penalty", "updated", "suppressed", "timer")
+
+    def __init__(self, now):
+        self.penalty = 0.0
+        self.updated = now  # when `penalty` was last decayed
+        self.suppressed = False
+        self.timer = None
+
+
+class FlapDamping:
+    def __init__(self, half_life=HALF_LIFE, suppress=SUPPRESS_THRESHOLD, reuse=REUSE_THRESHOLD,
+                 max_suppress_time=MAX_SUPPRESS_TIME, withdraw_penalty=WITHDRAW_PENALTY,
+                 change_penalty=CHANGE_PENALTY, clock=time.monotonic, schedule=None, on_reuse=None):
+        """ `schedule(delay, callback, *args)` starts a timer, as
+            `BGP_Router.start_timer` does, and `on_reuse(prefix, neighbor ID)`
+            is called when a suppressed route may be used again. The penalty
+            is capped so that no route stays suppressed longer than
+            `max_suppress_time` after its last flap."""
+        if not 0 < reuse < suppress:
+            raise ValueError("damping needs 0 < reuse threshold < suppress threshold")
+        self.half_life = half_life
+        self.suppress = suppress
+        self.reuse = reuse
+        self.withdraw_penalty = withdraw_penalty
+        self.change_penalty = change_penalty
+        self.ceiling = reuse * 2 ** (max_suppress_time / half_life)
+        self.clock = clock
+        self.schedule = schedule
+        self.on_reuse = on_reuse
+        self.history = {}  # (prefix, neighbor ID) -> FlapHistory
+        self.suppressed = 0  # pairs currently suppressed
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """Build from the bgp_defaults 'damping' setting: true for the defaults, or a dict of constructor arguments."""
+        return cls(**kwargs) if config is True else cls(**config, **kwargs)
+
+    def __len__(self):
+        return len(self.history)
+
+    def _decay(self, history, now):
+        if now > history.updated:
+            history.penalty *= 2 ** ((history.updated - now) / self.half_life)
+            history.updated = now
+        return history.penalty
+
+    def penalty(self, key, neighbor_id):
+        """The current penalty of a route, 0 if it has no flap history."""
+        history = self.history.get((key, neighbor_id))
+        return self._decay(history, self.clock()) if history is not None else 0.0
+
+    def is_suppressed(self, key, neighbor_id):
+        if not self.suppressed:
+            return False
+        history = self.history.get((key, neighbor_id))
+        return history is not None and history.suppressed
+
+    def withdrawn(self, key, neighbor_id):
+        """Charge a withdrawal. Returns True if this suppresses the route."""
+        return self._charge(key, neighbor_id, self.withdraw_penalty)
+
+    def changed(self, key, neighbor_id):
+        """Charge an attribute change. Returns True if this suppresses the route."""
+        return self._charge(key, neighbor_id, self.change_penalty)
+
+    def _charge(self, key, neighbor_id, amount):
+        now = self.clock()
+        pair = (key, neighbor_id)
+        history = self.history.get(pair)
+        if history is None:
+            history = self.history[pair] = FlapHistory(now)
+        history.penalty = min(self._decay(history, now) + amount, self.ceiling)
+        suppressed = not history.suppressed and history.penalty >= self.suppress
+        if suppressed:
+            history.suppressed = True
+            self.suppressed += 1
+            log.debug("Suppressed %s from Router %s, penalty %.0f", key, neighbor_id, history.penalty)
+        if history.timer is None:
+            self._arm(pair, history)
+        return suppressed
+
+    def _arm(self, pair, history):
+        """Set the timer for when the penalty decays to the next threshold that matters."""
+        if self.schedule is None:
+            return
+        threshold = self.reuse if history.suppressed else self.reuse / 2
+        delay = max(0.0, self.half_life * math.log2(history.penalty / threshold))
+        history.timer = self.schedule(delay, self._due, pair)
+
+    def _due(self, pair):
+        history = self.history.get(pair)
+        if history is None:
+            return
+        history.timer = None
+        penalty = self._decay(history, self.clock())
+        # Timers fire at or just after their deadline; allow for rounding in the decay
+        if history.suppressed and penalty <= self.reuse * (1 + 1e-9):
+            history.suppressed = False
+            self.suppressed -= 1
+            log.debug("Reusing %s from Router %s", *pair)
+            if self.on_reuse is not None:
+                self.on_reuse(*pair)
+        if not history.suppressed and penalty <= self.reuse / 2 * (1 + 1e-9):
+            del self.history[pair]
+            return
+        self._arm(pair, history)
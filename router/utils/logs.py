@@ -1 +1,188 @@
-# TODO: Logs functions for each routers
\ No newline at end of file
+""" Leveled, structured logging for the routers.
+
+    Everything logs to the `bgp.*` loggers of the standard `logging` module.
+    Messages use %-style arguments, so they are only formatted when the level
+    is enabled, and `Lazy` defers expensive values (such as a whole routing
+    table) the same way. `configure` puts a queue in front of the real
+    handler: callers only enqueue records, and a background thread formats
+    and writes them.
+
+    Until `configure` is called, only warnings and errors are shown.
+
+    Environment:
+        BGP_LOG_LEVEL   DEBUG, INFO (default), WARNING, ...
+        BGP_LOG_FORMAT  text (default) or json
+        BGP_LOG_SAMPLE  per level sampling, e.g. "DEBUG=100,INFO=10" keeps one
+                        record in 100 (or 10) of every message
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+ROOT_LOGGER = "bgp"
+TEXT = "text"
+JSON = "json"
+
+_listener = None
+
+
+def get_logger(name):
+    """Logger for one part of the simulator, e.g. get_logger("rib") -> bgp.rib."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class RouterLogger(logging.LoggerAdapter):
+    """ Adds the router ID to every record as a structured field. Other
+        fields can be passed per call: log.info("session up", fields={"peer": 2})."""
+    def process(self, msg, kwargs):
+        fields = dict(self.extra)
+        fields.update(kwargs.pop("fields", {}))
+        kwargs["extra"] = {"fields": fields}
+        return msg, kwargs
+
+
+def router_logger(router_id, name="router"):
+    return RouterLogger(get_logger(name), {"router": router_id})
+
+
+class Lazy:
+    """A log argument that is only computed if the record is actually formatted."""
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through one record in `rates[level]` of every distinct message."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counts = {}
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1)
+        if rate <= 1:
+            return True
+        key = (record.name, record.msg)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count % rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """ One line per record: timestamp, level, logger, message and key=value
+        fields, or the same as a JSON object."""
+    def __init__(self, output=TEXT):
+        super().__init__()
+        if output not in (TEXT, JSON):
+            raise ValueError(f"unknown log format {output}")
+        self.output = output
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+
+    def format(self, record):
+        fields = dict(getattr(record, "fields", {}))
+        if hasattr(record, "sample_rate"):
+            fields["sample_rate"] = record.sample_rate
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+
+        if self.output == JSON:
+            entry = {
+                "time": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage(),
+            }
+            entry.update(fields)
+            if exc_text:
+                entry["exception"] = exc_text
+            return json.dumps(entry, default=str)
+
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name} {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if exc_text:
+            line += "\n" + exc_text
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        """ Resolve the message while its arguments still hold the logged
+            values; the line itself is built on the writer thread."""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sample(spec):
+    """Parse "DEBUG=100,INFO=10" into {logging.DEBUG: 100, logging.INFO: 10}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        level, _, rate = item.partition("=")
+        rates[logging.getLevelName(level.strip().upper())] = int(rate)
+    return rates
+
+
+def configure(level=None, output=None, stream=None, sample=None):
+    """ Send the bgp.* loggers through a queue to a background writer thread.
+
+        Arguments left as None are read from the environment (see above).
+        Calling it again replaces the previous configuration.
+    """
+    global _listener
+    shutdown()
+
+    level = level if level is not None else os.getenv("BGP_LOG_LEVEL", "INFO")
+    output = output if output is not None else os.getenv("BGP_LOG_FORMAT", TEXT)
+    if sample is None:
+        sample = parse_sample(os.getenv("BGP_LOG_SAMPLE", ""))
+    elif isinstance(sample, str):
+        sample = parse_sample(sample)
+
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    handler.setFormatter(StructuredFormatter(output))
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    if sample:
+        queue_handler.addFilter(SamplingFilter(sample))
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers = [queue_handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    return root
+
+
+def shutdown():
+    """Write out every queued record and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,297 @@
+""" Prometheus style metrics: counters, gauges and histograms.
+
+    A `MetricsRegistry` holds metric families by name. Each family has label
+    names and one child per set of label values; the hot paths keep the
+    children they update, so recording a value is one attribute update
+    (plus a bisect for histograms) with no lookups or locking. Values that
+    are cheap to read on demand, such as RIB sizes or trust scores, are
+    gauges with a function that is only called when the metrics are read.
+
+    The metrics can be read in process with `snapshot()`, as the simulator
+    does, or scraped in the Prometheus text format from the `/metrics`
+    endpoint of `serve`.
+
+    Nothing here runs unless a router is given a registry: routers without
+    one are not instrumented at all (see `BGP_Router.enable_metrics`).
+"""
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.logs import get_logger
+
+log = get_logger("metrics")
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+# Seconds, from tens of microseconds (a KEEPALIVE) to seconds (a full table)
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # per bucket, not cumulative; the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def buckets(self):
+        """[(upper bound, cumulative count)], ending with +Inf."""
+        cumulative = 0
+        result = []
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+
+class Metric:
+    """One metric family: a name, its label names and a child per set of label values."""
+    kind = None
+    child_class = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        # owner -> function called when the metrics are read, returning a value or, with labels,
+        # {label values: value}; one per owner, so every router sharing a registry can report its own
+        self.functions = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        return self.child_class()
+
+    def labels(self, *values):
+        """The child for these label values, created on first use. Keep it rather than calling this per update."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        self.children.pop(tuple(str(value) for value in values), None)
+
+    def set_function(self, function, owner=None):
+        """Report what `function` returns whenever the metrics are read, replacing the owner's previous one."""
+        self.functions[owner] = function
+
+    def samples(self):
+        """[(label values, value)] of every child, including the ones the functions report."""
+        samples = [(values, child.value) for values, child in list(self.children.items())]
+        for function in list(self.functions.values()):
+            reported = function()
+            if self.labelnames:
+                samples.extend((tuple(str(value) for value in values), value) for values, value in reported.items())
+            else:
+                samples.append(((), reported))
+        return samples
+
+
+class Counter(Metric):
+    kind = COUNTER
+    child_class = CounterChild
+
+
+class Gauge(Metric):
+    kind = GAUGE
+    child_class = GaugeChild
+
+
+class Histogram(Metric):
+    kind = HISTOGRAM
+    child_class = HistogramChild
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramChild(self.bounds)
+
+    def samples(self):
+        return [(values, child) for values, child in list(self.children.items())]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}  # name -> Metric, in registration order
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        """The family called `name`, registering it first. Routers sharing a registry share its families."""
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = cls(name, *args, **kwargs)
+        if not isinstance(metric, cls):
+            raise ValueError(f"metric {name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name, help_text, labelnames=(), function=None, owner=None):
+        """A counter; with `function`, one whose values are read from it (see `Metric.set_function`)."""
+        counter = self._register(Counter, name, help_text, labelnames)
+        if function is not None:
+            counter.set_function(function, owner)
+        return counter
+
+    def gauge(self, name, help_text, labelnames=(), function=None, owner=None):
+        """A gauge; with `function`, one whose values are read from it."""
+        gauge = self._register(Gauge, name, help_text, labelnames)
+        if function is not None:
+            gauge.set_function(function, owner)
+        return gauge
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help_text, labelnames, buckets)
+
+    def unregister(self, name):
+        self.metrics.pop(name, None)
+
+    def snapshot(self):
+        """ Every metric as plain, JSON serializable data:
+            {name: [{"labels": {...}, "value": v}]}, where a histogram's value
+            is {"count", "sum", "buckets": [[upper bound, cumulative count]]}."""
+        result = {}
+        for metric in list(self.metrics.values()):
+            entries = []
+            for values, value in metric.samples():
+                if metric.kind == HISTOGRAM:
+                    value = {
+                        "count": value.count,
+                        "sum": value.sum,
+                        "buckets": [[_format_value(bound), count] for bound, count in value.buckets()],
+                    }
+                entries.append({"labels": dict(zip(metric.labelnames, values)), "value": value})
+            result[metric.name] = entries
+        return result
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for values, value in metric.samples():
+                labels = list(zip(metric.labelnames, values))
+                if metric.kind != HISTOGRAM:
+                    lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                for bound, count in value.buckets():
+                    bucket_labels = _format_labels(labels + [("le", _format_value(bound))])
+                    lines.append(f"{metric.name}_bucket{bucket_labels} {count}")
+                lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                lines.append(f"{metric.name}_count{_format_labels(labels)} {value.count}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("metrics request from %s: " + format, self.client_address[0], *args)
+
+
+def parse_address(address, default_host="127.0.0.1"):
+    """A listen address given as a port or "host:port" (from config.json or BGP_METRICS) as (host, port)."""
+    if isinstance(address, int):
+        return default_host, address
+    host, _, port = str(address).rpartition(":")
+    return host or default_host, int(port)
+
+
+def serve(registry, host="127.0.0.1", port=9100):
+    """ Serve `registry` at http://host:port/metrics from a daemon thread.
+        Returns the server; `shutdown()` stops it. Port 0 picks a free port,
+        see `server.server_address`."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    log.info("Serving metrics on http://%s:%s/metrics", *server.server_address[:2])
+    return server
@@ -0,0 +1,534 @@
+""" MRT (RFC 6396) route dumps: TABLE_DUMP_V2 RIBs and BGP4MP update traces.
+
+    `read_entries` streams the routes of a dump one record at a time, so a
+    full RouteViews or RIS RIB is never held in memory; gzip and bzip2
+    files are decompressed on the fly. Path attributes repeat heavily in
+    real dumps (every prefix a peer announces with the same path carries
+    the same bytes), so each distinct attribute block is parsed once and
+    looked up afterwards. `read_routes` picks one route per prefix from a
+    RIB dump and `RoutingTable.load_routes` / `Rib.load_routes` install
+    them in bulk.
+
+    `MrtWriter` writes the same formats, so a Loc-RIB can be dumped with
+    `dump_routing_table` and the UPDATEs of a simulation recorded as a
+    BGP4MP trace, both readable by bgpdump, bgpkit and friends.
+
+    Only IPv4 unicast is read; IPv6 and multicast records are skipped.
+    The neighbor a route is learned from is its peer's AS number, matching
+    the routers here, whose neighbor IDs are their AS numbers.
+"""
+import bz2
+import gzip
+import ipaddress
+import struct
+import time
+import zlib
+
+from utils.logs import get_logger
+from utils.path_attributes import intern_as_path
+from utils.routing_table import Route
+
+log = get_logger("mrt")
+
+MRT_HEADER = struct.Struct(">IHHI")  # timestamp, type, subtype, length
+MRT_HEADER_LEN = MRT_HEADER.size
+RIB_ENTRY = struct.Struct(">HIH")  # peer index, originated time, attribute length
+RIB_ENTRY_ADDPATH = struct.Struct(">HI4xH")  # the same around a path identifier
+
+# MRT types and the subtypes we read or write
+TABLE_DUMP_V2 = 13
+BGP4MP = 16
+BGP4MP_ET = 17  # BGP4MP with a microsecond timestamp field
+PEER_INDEX_TABLE = 1
+RIB_IPV4_UNICAST = 2
+RIB_IPV4_UNICAST_ADDPATH = 8
+BGP4MP_MESSAGE = 1
+BGP4MP_MESSAGE_AS4 = 4
+BGP4MP_MESSAGE_LOCAL = 6
+BGP4MP_MESSAGE_AS4_LOCAL = 7
+BGP4MP_MESSAGE_ADDPATH = 8
+BGP4MP_MESSAGE_AS4_ADDPATH = 9
+BGP4MP_MESSAGE_LOCAL_ADDPATH = 10
+BGP4MP_MESSAGE_AS4_LOCAL_ADDPATH = 11
+# BGP4MP message subtype -> (4-byte AS numbers, ADD-PATH identifiers in the NLRI)
+BGP4MP_SUBTYPES = {
+    BGP4MP_MESSAGE: (False, False),
+    BGP4MP_MESSAGE_AS4: (True, False),
+    BGP4MP_MESSAGE_LOCAL: (False, False),
+    BGP4MP_MESSAGE_AS4_LOCAL: (True, False),
+    BGP4MP_MESSAGE_ADDPATH: (False, True),
+    BGP4MP_MESSAGE_AS4_ADDPATH: (True, True),
+    BGP4MP_MESSAGE_LOCAL_ADDPATH: (False, True),
+    BGP4MP_MESSAGE_AS4_LOCAL_ADDPATH: (True, True),
+}
+
+AFI_IPV4 = 1
+BGP_MARKER = b"\xff" * 16
+BGP_MESSAGE_UPDATE = 2
+BGP_MAX_MESSAGE_LEN = 4096
+
+# Path attribute type codes and flags
+ATTR_ORIGIN = 1
+ATTR_AS_PATH = 2
+ATTR_NEXT_HOP = 3
+ATTR_AS4_PATH = 17
+FLAG_TRANSITIVE = 0x40
+FLAG_EXTENDED_LENGTH = 0x10
+AS_SET = 1
+AS_SEQUENCE = 2
+ORIGIN_IGP = 0
+
+
+class MrtError(ValueError):
+    """Raised when an MRT file is truncated or a record does not parse."""
+
+
+class MrtEntry:
+    """ One route of a dump: a RIB entry, or an announced or withdrawn prefix
+        of a BGP4MP UPDATE. A withdrawal has an empty AS path and no next hop."""
+    __slots__ = ("timestamp", "peer_as", "peer_ip", "prefix", "prefixlen", "as_path", "next_hop", "withdrawn", "local_as")
+
+    def __init__(self, timestamp, peer_as, peer_ip, prefix, prefixlen, as_path, next_hop, withdrawn=False, local_as=None):
+        self.timestamp = timestamp
+        self.peer_as = peer_as
+        self.peer_ip = peer_ip  # as an integer
+        self.prefix = prefix
+        self.prefixlen = prefixlen
+        self.as_path = as_path
+        self.next_hop = next_hop  # NEXT_HOP attribute as an integer, or None
+        self.withdrawn = withdrawn
+        self.local_as = local_as  # the receiving AS of a BGP4MP message, None for RIB entries
+
+    @property
+    def network(self):
+        return ipaddress.IPv4Network((self.prefix, self.prefixlen))
+
+    def route(self):
+        """The entry as a Route learned from the peer's AS."""
+        return Route(self.prefix, self.prefixlen, self.peer_as, self.as_path)
+
+    def __repr__(self):
+        action = "withdraw" if self.withdrawn else f"as_path={self.as_path}"
+        return f"MrtEntry({self.network}, peer_as={self.peer_as}, {action})"
+
+
+class Peer:
+    """A PEER_INDEX_TABLE entry."""
+    __slots__ = ("bgp_id", "ip", "asn")
+
+    def __init__(self, bgp_id, ip, asn):
+        self.bgp_id = bgp_id
+        self.ip = ip  # an integer for IPv4 peers, None for IPv6 ones
+        self.asn = asn
+
+    def __repr__(self):
+        ip = ipaddress.IPv4Address(self.ip) if self.ip is not None else "IPv6"
+        return f"Peer(AS{self.asn}, {ip})"
+
+
+def open_dump(path, mode="rb"):
+    """ Open an MRT file, decompressing gzip or bzip2 by content when reading
+        and by the .gz or .bz2 extension when writing."""
+    if "r" in mode:
+        with open(path, "rb") as raw:
+            magic = raw.read(3)
+        if magic[:2] == b"\x1f\x8b":
+            return gzip.open(path, mode)
+        if magic == b"BZh":
+            return bz2.open(path, mode)
+    elif path.endswith(".gz"):
+        return gzip.open(path, mode)
+    elif path.endswith(".bz2"):
+        return bz2.open(path, mode)
+    return open(path, mode)
+
+
+def read_records(stream):
+    """Yield (timestamp, type, subtype, body) for every record of an open MRT stream."""
+    read = stream.read
+    while True:
+        header = read(MRT_HEADER_LEN)
+        if not header:
+            return
+        if len(header) < MRT_HEADER_LEN:
+            raise MrtError("truncated MRT record header")
+        timestamp, record_type, subtype, length = MRT_HEADER.unpack(header)
+        body = read(length)
+        if len(body) < length:
+            raise MrtError(f"truncated MRT record: expected {length} bytes, got {len(body)}")
+        yield timestamp, record_type, subtype, body
+
+
+def _prefix(data, offset):
+    """Decode an NLRI style prefix at `offset`: (prefix as an integer, length, next offset)."""
+    prefixlen = data[offset]
+    if prefixlen > 32:
+        raise MrtError(f"IPv4 prefix length {prefixlen} out of range")
+    size = (prefixlen + 7) >> 3
+    offset += 1
+    prefix = int.from_bytes(data[offset:offset + size] + b"\x00" * (4 - size), "big")
+    return prefix, prefixlen, offset + size
+
+
+def _as_path(data, asn_size):
+    """Flatten AS_PATH segments to a tuple of AS numbers; AS_SET members are kept in order, confederations dropped."""
+    asns = []
+    fmt = ">%dI" if asn_size == 4 else ">%dH"
+    offset = 0
+    end = len(data)
+    while offset + 2 <= end:
+        segment_type, count = data[offset], data[offset + 1]
+        offset += 2
+        if segment_type in (AS_SEQUENCE, AS_SET):
+            asns.extend(struct.unpack_from(fmt % count, data, offset))
+        offset += count * asn_size
+    if offset != end:
+        raise MrtError("malformed AS_PATH attribute")
+    return asns
+
+
+def parse_attributes(data, asn_size=4):
+    """ The (AS path, next hop) of a path attribute block. AS4_PATH is merged
+        into a 2-byte AS_PATH as RFC 6793 describes."""
+    as_path = ()
+    as4_path = None
+    next_hop = None
+    offset = 0
+    end = len(data)
+    while offset < end:
+        flags, code = data[offset], data[offset + 1]
+        if flags & FLAG_EXTENDED_LENGTH:
+            length = (data[offset + 2] << 8) | data[offset + 3]
+            offset += 4
+        else:
+            length = data[offset + 2]
+            offset += 3
+        value = data[offset:offset + length]
+        offset += length
+        if code == ATTR_AS_PATH:
+            as_path = _as_path(value, asn_size)
+        elif code == ATTR_NEXT_HOP and length == 4:
+            next_hop = int.from_bytes(value, "big")
+        elif code == ATTR_AS4_PATH:
+            as4_path = _as_path(value, 4)
+    if offset != end:
+        raise MrtError("path attributes overrun their block")
+    if as4_path is not None and asn_size == 2 and len(as4_path) <= len(as_path):
+        as_path = as_path[:len(as_path) - len(as4_path)] + as4_path
+    return intern_as_path(as_path), next_hop
+
+
+class MrtReader:
+    def __init__(self, path, peer=None):
+        """ Read the routes of an MRT file. `peer` keeps only the routes of
+            one peer, given as its AS number or IP address string; the
+            other RIB entries are then skipped without parsing them."""
+        self.path = path
+        self.peer_as = peer if isinstance(peer, int) else None
+        self.peer_ip = int(ipaddress.IPv4Address(peer)) if isinstance(peer, str) else None
+        self.peers = []  # the last PEER_INDEX_TABLE, indexed by RIB entries
+        self.skipped = 0  # records of types or address families we do not read
+        self._wanted_peers = []  # per peer index, whether the `peer` filter keeps its routes
+        self._attributes = {4: {}, 2: {}}  # AS number size -> {attribute bytes: (AS path, next hop)}
+
+    def _wanted(self, peer_as, peer_ip):
+        return (self.peer_as is None or peer_as == self.peer_as) and (self.peer_ip is None or peer_ip == self.peer_ip)
+
+    def _parse(self, attributes, asn_size=4):
+        cache = self._attributes[asn_size]
+        parsed = cache.get(attributes)
+        if parsed is None:
+            parsed = cache[attributes] = parse_attributes(attributes, asn_size)
+        return parsed
+
+    def __iter__(self):
+        """Yield an MrtEntry for every IPv4 unicast route in the file."""
+        return self._entries()
+
+    def _entries(self, best_only=False):
+        """Yield MrtEntry records, or with `best_only` one Route per RIB record and nothing for BGP4MP."""
+        with open_dump(self.path) as stream:
+            for timestamp, record_type, subtype, body in self._records(stream):
+                try:
+                    if record_type == TABLE_DUMP_V2:
+                        if subtype == PEER_INDEX_TABLE:
+                            self.peers = self._peer_index(body)
+                            self._wanted_peers = [self._wanted(peer.asn, peer.ip) for peer in self.peers]
+                        elif subtype not in (RIB_IPV4_UNICAST, RIB_IPV4_UNICAST_ADDPATH):
+                            self.skipped += 1
+                        elif best_only:
+                            route = self._best(body, subtype == RIB_IPV4_UNICAST_ADDPATH)
+                            if route is not None:
+                                yield route
+                        else:
+                            yield from self._rib(body, subtype == RIB_IPV4_UNICAST_ADDPATH)
+                    elif record_type in (BGP4MP, BGP4MP_ET) and subtype in BGP4MP_SUBTYPES and not best_only:
+                        if record_type == BGP4MP_ET:
+                            timestamp += struct.unpack_from(">I", body)[0] / 1e6
+                            body = body[4:]
+                        yield from self._bgp4mp(timestamp, body, *BGP4MP_SUBTYPES[subtype])
+                    else:
+                        self.skipped += 1
+                except (IndexError, struct.error) as e:
+                    raise MrtError(f"{self.path}: malformed record of type {record_type}/{subtype}: {e}") from None
+        if self.skipped:
+            log.debug("Skipped %d MRT records of %s that are not IPv4 unicast routes", self.skipped, self.path)
+
+    def _records(self, stream):
+        """`read_records`, with a truncated or corrupt compressed dump reported as MrtError."""
+        try:
+            yield from read_records(stream)
+        except (EOFError, zlib.error, OSError) as e:
+            raise MrtError(f"{self.path}: cannot read dump: {e}") from None
+
+    def routes(self):
+        """ One Route per prefix of a RIB dump: the entry with the shortest AS
+            path, the first one on ties. Routes of BGP4MP updates are not included."""
+        return self._entries(best_only=True)
+
+    def _peer_index(self, body):
+        offset = 4
+        view_name_length = struct.unpack_from(">H", body, offset)[0]
+        offset += 2 + view_name_length
+        count = struct.unpack_from(">H", body, offset)[0]
+        offset += 2
+        peers = []
+        for _ in range(count):
+            peer_type = body[offset]
+            bgp_id = int.from_bytes(body[offset + 1:offset + 5], "big")
+            offset += 5
+            if peer_type & 1:
+                ip = None
+                offset += 16
+            else:
+                ip = int.from_bytes(body[offset:offset + 4], "big")
+                offset += 4
+            if peer_type & 2:
+                asn = struct.unpack_from(">I", body, offset)[0]
+                offset += 4
+            else:
+                asn = struct.unpack_from(">H", body, offset)[0]
+                offset += 2
+            peers.append(Peer(bgp_id, ip, asn))
+        return peers
+
+    def _rib(self, body, addpath):
+        prefix, prefixlen, offset = _prefix(body, 4)
+        count = struct.unpack_from(">H", body, offset)[0]
+        offset += 2
+        peers = self.peers
+        wanted = self._wanted_peers
+        entry = RIB_ENTRY_ADDPATH if addpath else RIB_ENTRY
+        for _ in range(count):
+            peer_index, originated, length = entry.unpack_from(body, offset)
+            offset += entry.size
+            if wanted[peer_index]:
+                peer = peers[peer_index]
+                as_path, next_hop = self._parse(body[offset:offset + length])
+                yield MrtEntry(originated, peer.asn, peer.ip, prefix, prefixlen, as_path, next_hop)
+            offset += length
+
+    def _best(self, body, addpath):
+        """The Route of a RIB record's entry with the shortest AS path, or None if the filter kept no entry."""
+        prefix, prefixlen, offset = _prefix(body, 4)
+        count = struct.unpack_from(">H", body, offset)[0]
+        offset += 2
+        wanted = self._wanted_peers
+        cache = self._attributes[4]
+        entry = RIB_ENTRY_ADDPATH if addpath else RIB_ENTRY
+        size = entry.size
+        best_path = None
+        best_peer = None
+        for _ in range(count):
+            peer_index, _, length = entry.unpack_from(body, offset)
+            offset += size
+            if wanted[peer_index]:
+                attributes = body[offset:offset + length]
+                parsed = cache.get(attributes) or self._parse(attributes)
+                if best_path is None or len(parsed[0]) < len(best_path):
+                    best_path = parsed[0]
+                    best_peer = peer_index
+            offset += length
+        if best_path is None:
+            return None
+        return Route(prefix, prefixlen, self.peers[best_peer].asn, best_path)
+
+    def _bgp4mp(self, timestamp, body, as4, addpath):
+        if as4:
+            peer_as, local_as, _, afi = struct.unpack_from(">IIHH", body)
+            offset = 12
+        else:
+            peer_as, local_as, _, afi = struct.unpack_from(">HHHH", body)
+            offset = 8
+        if afi != AFI_IPV4:
+            self.skipped += 1
+            return
+        peer_ip = int.from_bytes(body[offset:offset + 4], "big")
+        offset += 8
+        if not self._wanted(peer_as, peer_ip):
+            return
+        if body[offset:offset + 16] != BGP_MARKER:
+            raise MrtError(f"{self.path}: BGP4MP message without a BGP marker")
+        length, message_type = struct.unpack_from(">HB", body, offset + 16)
+        if message_type != BGP_MESSAGE_UPDATE:
+            return
+        end = offset + length
+        offset += 19
+        withdrawn_length = struct.unpack_from(">H", body, offset)[0]
+        offset += 2
+        withdrawn_end = offset + withdrawn_length
+        while offset < withdrawn_end:
+            if addpath:
+                offset += 4
+            prefix, prefixlen, offset = _prefix(body, offset)
+            yield MrtEntry(timestamp, peer_as, peer_ip, prefix, prefixlen, (), None, True, local_as)
+        attributes_length = struct.unpack_from(">H", body, offset)[0]
+        offset += 2
+        as_path, next_hop = self._parse(body[offset:offset + attributes_length], 4 if as4 else 2)
+        offset += attributes_length
+        while offset < end:
+            if addpath:
+                offset += 4
+            prefix, prefixlen, offset = _prefix(body, offset)
+            yield MrtEntry(timestamp, peer_as, peer_ip, prefix, prefixlen, as_path, next_hop, False, local_as)
+
+
+def read_entries(path, peer=None):
+    """Stream the MrtEntry records of a TABLE_DUMP_V2 or BGP4MP file."""
+    return iter(MrtReader(path, peer))
+
+
+def read_routes(path, peer=None):
+    """Stream one Route per prefix of a TABLE_DUMP_V2 RIB dump (see `MrtReader.routes`)."""
+    return MrtReader(path, peer).routes()
+
+
+def load_routing_table(routing_table, path, peer=None):
+    """Bulk-load a RIB dump into a RoutingTable. Returns the number of routes installed."""
+    return routing_table.load_routes(read_routes(path, peer))
+
+
+def _ip(ip):
+    """An IPv4 address given as a string or an integer, as an integer."""
+    return ip if isinstance(ip, int) else int(ipaddress.IPv4Address(ip))
+
+
+def _encode_prefix(prefix, prefixlen):
+    return bytes((prefixlen,)) + prefix.to_bytes(4, "big")[:(prefixlen + 7) >> 3]
+
+
+def _attribute(flags, code, value):
+    if len(value) > 255:
+        return struct.pack(">BBH", flags | FLAG_EXTENDED_LENGTH, code, len(value)) + value
+    return struct.pack(">BBB", flags, code, len(value)) + value
+
+
+def encode_attributes(as_path, next_hop):
+    """ORIGIN, a 4-byte AS_PATH and NEXT_HOP as a path attribute block."""
+    segments = []
+    for start in range(0, len(as_path), 255):
+        chunk = as_path[start:start + 255]
+        segments.append(struct.pack(f">BB{len(chunk)}I", AS_SEQUENCE, len(chunk), *chunk))
+    return (
+        _attribute(FLAG_TRANSITIVE, ATTR_ORIGIN, bytes((ORIGIN_IGP,)))
+        + _attribute(FLAG_TRANSITIVE, ATTR_AS_PATH, b"".join(segments))
+        + _attribute(FLAG_TRANSITIVE, ATTR_NEXT_HOP, _ip(next_hop).to_bytes(4, "big"))
+    )
+
+
+class MrtWriter:
+    def __init__(self, stream):
+        """Write MRT records to a binary stream, e.g. one returned by `open_dump(path, "wb")`."""
+        self.stream = stream
+        self.sequence = 0  # RIB record sequence number
+        self._attributes = {}  # (AS path, next hop) -> encoded attribute block
+
+    def record(self, timestamp, record_type, subtype, body):
+        self.stream.write(MRT_HEADER.pack(int(timestamp), record_type, subtype, len(body)))
+        self.stream.write(body)
+
+    def _encoded(self, as_path, next_hop):
+        key = (as_path, next_hop)
+        attributes = self._attributes.get(key)
+        if attributes is None:
+            attributes = self._attributes[key] = encode_attributes(as_path, next_hop)
+        return attributes
+
+    def peer_index_table(self, collector_id, peers, view_name="", timestamp=None):
+        """Write a PEER_INDEX_TABLE of (BGP ID, IP, AS number) peers; RIB entries refer to them by position."""
+        name = view_name.encode()
+        body = [struct.pack(">IH", _ip(collector_id), len(name)), name, struct.pack(">H", len(peers))]
+        for bgp_id, ip, asn in peers:
+            body.append(struct.pack(">BIII", 2, _ip(bgp_id), _ip(ip), asn))  # IPv4 peer with a 4-byte AS
+        self.record(time.time() if timestamp is None else timestamp, TABLE_DUMP_V2, PEER_INDEX_TABLE, b"".join(body))
+
+    def rib_entry(self, prefix, prefixlen, entries, timestamp=None):
+        """Write the RIB entries of a prefix, given as (peer index, AS path, next hop) triples."""
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        body = [struct.pack(">I", self.sequence), _encode_prefix(prefix, prefixlen), struct.pack(">H", len(entries))]
+        for peer_index, as_path, next_hop in entries:
+            attributes = self._encoded(as_path, next_hop)
+            body.append(struct.pack(">HIH", peer_index, timestamp, len(attributes)))
+            body.append(attributes)
+        self.sequence += 1
+        self.record(timestamp, TABLE_DUMP_V2, RIB_IPV4_UNICAST, b"".join(body))
+
+    def update(self, timestamp, peer_as, local_as, peer_ip, local_ip, announced=(), withdrawn=(), as_path=(), next_hop=None):
+        """ Write a BGP4MP_ET UPDATE from a peer: `announced` and `withdrawn`
+            are (prefix, prefix length) pairs, the announced ones sharing
+            `as_path` and `next_hop`. Split into several BGP messages if needed."""
+        header = struct.pack(">IIHHII", peer_as, local_as, 0, AFI_IPV4, _ip(peer_ip), _ip(local_ip))
+        attributes = self._encoded(intern_as_path(as_path), next_hop if next_hop is not None else peer_ip) if announced else b""
+        withdrawn = [_encode_prefix(prefix, prefixlen) for prefix, prefixlen in withdrawn]
+        announced = [_encode_prefix(prefix, prefixlen) for prefix, prefixlen in announced]
+        seconds = int(timestamp)
+        microseconds = struct.pack(">I", int(round((timestamp - seconds) * 1e6)) % 1000000)
+        # Room for prefixes once the BGP header and the two length fields are in
+        room = BGP_MAX_MESSAGE_LEN - 23
+        while withdrawn or announced:
+            withdrawn_part = b"".join(_take(withdrawn, room))
+            # Announcements start once every withdrawal is out, in the room the attributes leave
+            nlri = b"" if withdrawn else b"".join(_take(announced, room - len(withdrawn_part) - len(attributes)))
+            path_attributes = attributes if nlri else b""
+            message = (
+                struct.pack(">H", len(withdrawn_part)) + withdrawn_part
+                + struct.pack(">H", len(path_attributes)) + path_attributes + nlri
+            )
+            message = BGP_MARKER + struct.pack(">HB", 19 + len(message), BGP_MESSAGE_UPDATE) + message
+            self.record(seconds, BGP4MP_ET, BGP4MP_MESSAGE_AS4, microseconds + header + message)
+
+
+def _take(prefixes, room):
+    """Remove and return as many encoded prefixes from the front of the list as fit in `room` bytes."""
+    size = 0
+    count = 0
+    for prefix in prefixes:
+        if size + len(prefix) > room:
+            break
+        size += len(prefix)
+        count += 1
+    taken = prefixes[:count]
+    del prefixes[:count]
+    return taken
+
+
+def dump_routing_table(path, routing_table, peer_ips=None, collector_id=0, timestamp=None):
+    """ Write a RoutingTable (a Loc-RIB) as a TABLE_DUMP_V2 RIB dump. Each
+        distinct next hop becomes a peer with that AS number and the address
+        `peer_ips` gives it (0.0.0.0 if unknown). Returns the routes written."""
+    peer_ips = peer_ips or {}
+    hops = sorted(routing_table.next_hop_index, key=str)
+    positions = {hop: position for position, hop in enumerate(hops)}
+    addresses = {hop: _ip(peer_ips.get(hop, 0)) for hop in hops}
+    count = 0
+    with open_dump(path, "wb") as stream:
+        writer = MrtWriter(stream)
+        writer.peer_index_table(
+            collector_id, [(addresses[hop], addresses[hop], hop if isinstance(hop, int) else 0) for hop in hops],
+            f"Router{routing_table.router_id}", timestamp,
+        )
+        for route in sorted(routing_table.routes.values(), key=lambda route: (route.prefix, route.prefixlen)):
+            hop = route.next_hop
+            writer.rib_entry(route.prefix, route.prefixlen, [(positions[hop], route.as_path, addresses[hop])], timestamp)
+            count += 1
+    return count
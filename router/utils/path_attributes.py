@@ -0,0 +1,129 @@
+""" Interned AS paths and path attribute sets.
+
+    The routes in the RIBs mostly share a few thousand distinct paths. Every
+    distinct AS path is kept once as a tuple of AS numbers, and every
+    distinct set of attributes (next hop, AS path, LOCAL_PREF, MED, ORIGIN)
+    once as a `PathAttributes` object, so the RIBs hold references instead
+    of copies and comparing the attributes of two routes is an identity
+    check. Each set also carries its rank in the decision process,
+    computed once when it is interned.
+"""
+import sys
+import weakref
+
+# AS path tuple -> the same tuple. Tuples cannot be weakly referenced, so the
+# paths nothing else uses any more (withdrawn, churned away, only replayed
+# from MRT) are swept out whenever the table has doubled since the last sweep.
+_as_paths = {}
+_sweep_at = 4096
+# References to an unused path while sweeping: `_as_paths` (as key and value), the loop variable and getrefcount's argument
+_UNUSED_REFCOUNT = 4
+
+DEFAULT_LOCAL_PREF = 100
+ORIGIN_IGP = 0
+ORIGIN_EGP = 1
+ORIGIN_INCOMPLETE = 2
+
+
+def as_number(asn):
+    """Convert an AS as written in config.json ("AS12") to its number."""
+    if isinstance(asn, str):
+        return int(asn[2:]) if asn.upper().startswith("AS") else int(asn)
+    return int(asn)
+
+
+def intern_as_path(as_path):
+    """Return the shared tuple of AS numbers for a path given as AS numbers or "ASn" strings."""
+    if type(as_path) is tuple:
+        shared = _as_paths.get(as_path)
+        if shared is not None:
+            return shared
+    as_path = tuple(as_number(asn) for asn in as_path)
+    shared = _as_paths.get(as_path)
+    if shared is not None:
+        return shared
+    if len(_as_paths) >= _sweep_at:
+        sweep_as_paths()
+    _as_paths[as_path] = as_path
+    return as_path
+
+
+def sweep_as_paths():
+    """Forget the interned paths no route or attribute set uses any more. Returns how many were dropped."""
+    global _sweep_at
+    unused = [as_path for as_path in _as_paths if sys.getrefcount(as_path) <= _UNUSED_REFCOUNT]
+    for as_path in unused:
+        del _as_paths[as_path]
+    _sweep_at = max(4096, 2 * len(_as_paths))
+    return len(unused)
+
+
+def prepend_as(as_path, asn):
+    """The interned path with `asn` in front, unless it is already the first AS."""
+    if as_path[:1] == (asn,):
+        return as_path
+    return intern_as_path((asn,) + as_path)
+
+
+def decision_rank(local_pref, path_length, origin, med):
+    """ The RFC 4271 decision process before its tie-breakers as one integer,
+        lower is better: highest LOCAL_PREF, then shortest AS_PATH, lowest
+        ORIGIN, lowest MED. MED is compared whichever AS a route came from
+        (always-compare-med), so that the rank is a total order."""
+    return ((0xffffffff - local_pref) << 50) | (min(path_length, 0xffff) << 34) | (origin << 32) | med
+
+
+class PathAttributes:
+    """The attributes shared by every route with the same next hop, AS path, LOCAL_PREF, MED and ORIGIN. Never modify one."""
+    __slots__ = ("next_hop", "as_path", "local_pref", "med", "origin", "rank", "__weakref__")
+
+    def __init__(self, next_hop, as_path, local_pref=DEFAULT_LOCAL_PREF, med=0, origin=ORIGIN_IGP):
+        self.next_hop = next_hop
+        self.as_path = as_path
+        self.local_pref = local_pref
+        self.med = med
+        self.origin = origin
+        self.rank = decision_rank(local_pref, len(as_path), origin, med)
+
+    def __repr__(self):
+        extra = ""
+        if self.local_pref != DEFAULT_LOCAL_PREF:
+            extra += f", local_pref={self.local_pref}"
+        if self.med:
+            extra += f", med={self.med}"
+        if self.origin != ORIGIN_IGP:
+            extra += f", origin={self.origin}"
+        return f"PathAttributes(next_hop={self.next_hop!r}, as_path={self.as_path}{extra})"
+
+
+class AttributeCache:
+    """Hands out one PathAttributes per distinct attribute set; sets no route uses any more are dropped."""
+
+    def __init__(self):
+        self.entries = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, next_hop, as_path, local_pref=DEFAULT_LOCAL_PREF, med=0, origin=ORIGIN_IGP):
+        as_path = intern_as_path(as_path)
+        key = (next_hop, as_path, local_pref, med, origin)
+        attributes = self.entries.get(key)
+        if attributes is None:
+            attributes = PathAttributes(next_hop, as_path, local_pref, med, origin)
+            self.entries[key] = attributes
+        return attributes
+
+    def replace(self, attributes, as_path=None, local_pref=None, med=None, origin=None):
+        """The interned set equal to `attributes` except for the given values."""
+        return self.get(
+            attributes.next_hop,
+            attributes.as_path if as_path is None else as_path,
+            attributes.local_pref if local_pref is None else local_pref,
+            attributes.med if med is None else med,
+            attributes.origin if origin is None else origin,
+        )
+
+
+# Shared by every Rib in the process, so simulated routers share attribute sets too
+attribute_cache = AttributeCache()
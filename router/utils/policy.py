@@ -0,0 +1,342 @@
+""" Import and export policy: prefix lists and route maps.
+
+    The policies of a router are given in its config.json "policies":
+
+        "policies": {
+            "local_pref": 100,           # LOCAL_PREF of learned routes
+            "multi_exit_disc": 0,        # MED advertised to peers
+            "prefix_lists": {
+                "customers": [
+                    {"seq": 5, "action": "permit", "prefix": "10.0.0.0/8", "le": 24},
+                    {"seq": 10, "action": "deny", "prefix": "0.0.0.0/0", "le": 32}
+                ]
+            },
+            "route_maps": {
+                "from-customers": [
+                    {"seq": 10, "action": "permit", "match": {"prefix_list": "customers"},
+                     "set": {"local_pref": 200}},
+                    {"seq": 20, "action": "deny"}
+                ]
+            },
+            "import": {"2": "from-customers", "*": "..."},   # per neighbor ID, "*" for the rest
+            "export": {"3": "..."}
+        }
+
+    Both work like the usual router implementations. A prefix list entry
+    matches a prefix it covers whose length is within ge..le (exactly
+    the entry's length without either), the lowest matching sequence
+    number decides, and no match denies. A route map applies the set
+    actions of its first clause whose matches all hold, denies the route
+    if that clause is a deny, and denies routes no clause matches.
+    Matches: prefix_list, neighbor, as_path_contains, origin_as,
+    as_path_length_min, as_path_length_max. Sets: local_pref, med, origin
+    ("igp", "egp", "incomplete") and prepend (our AS that many times).
+
+    Policies are compiled for speed at full table scale: the entries of
+    every prefix list a route map uses live in one binary trie, so a route
+    walks its prefix's bits once and only looks at the entries that cover
+    it, however many lists and entries there are. Everything else a route
+    map looks at is the neighbor and the route's interned PathAttributes,
+    so the other matches of its clauses run once per distinct pair of
+    those and the outcome is remembered as a bit mask.
+"""
+from utils.logs import get_logger
+from utils.path_attributes import attribute_cache, as_number, ORIGIN_IGP, ORIGIN_EGP, ORIGIN_INCOMPLETE
+from utils.routing_table import parse_network, next_hop_key
+
+log = get_logger("policy")
+
+PERMIT = "permit"
+DENY = "deny"
+ORIGINS = {"igp": ORIGIN_IGP, "egp": ORIGIN_EGP, "incomplete": ORIGIN_INCOMPLETE}
+MATCHES = ("prefix_list", "neighbor", "as_path_contains", "origin_as", "as_path_length_min", "as_path_length_max")
+SETS = ("local_pref", "med", "origin", "prepend")
+# Decisions a route map remembers before starting over, bounding the memo as attribute sets come and go
+MEMO_SIZE = 1 << 16
+
+
+class PolicyError(ValueError):
+    """Raised when the policies of a router do not follow the schema above."""
+
+
+def _neighbor(neighbor):
+    """A neighbor as written in config.json (2, "2" or "Router2") as its ID."""
+    return int(next_hop_key(neighbor))
+
+
+def _action(action, where):
+    if action not in (PERMIT, DENY):
+        raise PolicyError(f"{where}: action must be '{PERMIT}' or '{DENY}', not {action!r}")
+    return action == PERMIT
+
+
+class _PrefixNode:
+    __slots__ = ("children", "entries")
+
+    def __init__(self):
+        self.children = [None, None]
+        self.entries = None  # [(seq, list bit, ge, le, permit)] of the entries for this prefix, by sequence number
+
+
+class PrefixTrie:
+    """ Binary trie of the entries of one or more prefix lists, each list
+        told apart by its bit, so that one walk over a prefix's bits finds
+        what every list decides for it."""
+
+    def __init__(self):
+        self.root = _PrefixNode()
+
+    def add(self, bit, network, seq, low, high, permit):
+        node = self.root
+        bits = int(network.network_address)
+        for depth in range(network.prefixlen):
+            branch = (bits >> (31 - depth)) & 1
+            if node.children[branch] is None:
+                node.children[branch] = _PrefixNode()
+            node = node.children[branch]
+        node.entries = sorted((node.entries or []) + [(seq, bit, low, high, permit)])
+
+    def permitted(self, prefix, prefixlen):
+        """The bits of the lists that permit a prefix given as an integer and a length."""
+        decided = {}  # list bit -> (seq, permit) of its lowest numbered matching entry so far
+        node = self.root
+        depth = 0
+        while node is not None:
+            if node.entries is not None:
+                for seq, bit, low, high, permit in node.entries:
+                    if low <= prefixlen <= high:
+                        current = decided.get(bit)
+                        if current is None or seq < current[0]:
+                            decided[bit] = (seq, permit)
+            if depth == prefixlen:
+                break
+            node = node.children[(prefix >> (31 - depth)) & 1]
+            depth += 1
+        mask = 0
+        for bit, (_, permit) in decided.items():
+            if permit:
+                mask |= bit
+        return mask
+
+
+class PrefixList:
+    def __init__(self, name, entries=()):
+        """A prefix list built from config.json style entry dicts."""
+        self.name = name
+        self.entries = []  # (network, seq, ge, le, permit)
+        for entry in entries:
+            self.add(**entry)
+        self._trie = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, prefix, action=PERMIT, seq=None, ge=None, le=None):
+        """Add an entry; without `seq` it goes after the others, 5 apart as routers number them."""
+        where = f"prefix list {self.name}"
+        network = parse_network(prefix)
+        permit = _action(action, where)
+        seq = (len(self.entries) + 1) * 5 if seq is None else seq
+        low = network.prefixlen if ge is None else ge
+        high = (32 if ge is not None else network.prefixlen) if le is None else le
+        if not network.prefixlen <= low <= high <= 32:
+            raise PolicyError(f"{where}: need {network.prefixlen} <= ge <= le <= 32 for {network}, got {low}..{high}")
+        self.entries.append((network, seq, low, high, permit))
+        self._trie = None
+
+    def add_to(self, trie, bit):
+        """Add the entries to a shared PrefixTrie under `bit`."""
+        for network, seq, low, high, permit in self.entries:
+            trie.add(bit, network, seq, low, high, permit)
+
+    def permits(self, prefix, prefixlen):
+        """Whether the list permits a prefix given as an integer and a length."""
+        if self._trie is None:
+            self._trie = PrefixTrie()
+            self.add_to(self._trie, 1)
+        return bool(self._trie.permitted(prefix, prefixlen))
+
+
+class RouteMapClause:
+    """One compiled route map clause."""
+    __slots__ = ("seq", "permit", "prefix_list", "neighbors", "attribute_matches", "sets", "local_as")
+
+    def __init__(self, seq, permit, prefix_list, neighbors, attribute_matches, sets, local_as):
+        self.seq = seq
+        self.permit = permit
+        self.prefix_list = prefix_list  # PrefixList or None
+        self.neighbors = neighbors  # frozenset of neighbor IDs or None for any
+        self.attribute_matches = attribute_matches  # [predicate(PathAttributes)]
+        self.sets = sets  # {attribute: value}, applied through the attribute cache
+        self.local_as = local_as
+
+    def matches(self, neighbor_id, attributes):
+        """Whether the clause's matches other than its prefix list hold."""
+        if self.neighbors is not None and neighbor_id not in self.neighbors:
+            return False
+        return all(match(attributes) for match in self.attribute_matches)
+
+    def apply(self, attributes):
+        """`attributes` after the clause's set actions."""
+        if not self.sets:
+            return attributes
+        changes = dict(self.sets)
+        prepend = changes.pop("prepend", 0)
+        if prepend:
+            changes["as_path"] = (self.local_as,) * prepend + attributes.as_path
+        return attribute_cache.replace(attributes, **changes)
+
+
+class RouteMap:
+    def __init__(self, name, clauses, prefix_lists, local_as):
+        """ Compile config.json style clauses, resolving prefix lists by name from `prefix_lists`.
+
+            Clause i in sequence order is bit i of the masks below. The
+            prefix lists of all clauses go into one trie whose walk yields
+            the clauses that the route's prefix passes, and the clauses
+            whose other matches hold are remembered per neighbor and
+            attribute set; the first clause in both is the lowest set bit.
+        """
+        self.name = name
+        self.clauses = []
+        for position, clause in enumerate(clauses):
+            self.clauses.append(self._compile(clause, position, prefix_lists, local_as))
+        self.clauses.sort(key=lambda clause: clause.seq)
+        self.trie = None
+        self.unconditional = 0  # clauses without a prefix list
+        for index, clause in enumerate(self.clauses):
+            if clause.prefix_list is None:
+                self.unconditional |= 1 << index
+                continue
+            self.trie = self.trie or PrefixTrie()
+            clause.prefix_list.add_to(self.trie, 1 << index)
+        self._matched = {}  # (neighbor ID, PathAttributes) -> mask of clauses whose other matches hold
+        self._results = {}  # (clause index, PathAttributes) -> the attributes after its set actions
+
+    def _compile(self, clause, position, prefix_lists, local_as):
+        seq = clause.get("seq", (position + 1) * 10)
+        where = f"route map {self.name} clause {seq}"
+        permit = _action(clause.get("action", PERMIT), where)
+        match = clause.get("match", {})
+        sets = dict(clause.get("set", {}))
+        unknown = set(match) - set(MATCHES) or set(sets) - set(SETS)
+        if unknown:
+            raise PolicyError(f"{where}: unknown {', '.join(sorted(unknown))}")
+
+        prefix_list = None
+        if "prefix_list" in match:
+            prefix_list = prefix_lists.get(match["prefix_list"])
+            if prefix_list is None:
+                raise PolicyError(f"{where}: no prefix list {match['prefix_list']!r}")
+        neighbors = None
+        if "neighbor" in match:
+            neighbor = match["neighbor"]
+            neighbors = frozenset(_neighbor(n) for n in (neighbor if isinstance(neighbor, list) else [neighbor]))
+
+        attribute_matches = []
+        if "as_path_contains" in match:
+            value = match["as_path_contains"]
+            asns = frozenset(as_number(asn) for asn in (value if isinstance(value, list) else [value]))
+            attribute_matches.append(lambda attributes: not asns.isdisjoint(attributes.as_path))
+        if "origin_as" in match:
+            origin_as = as_number(match["origin_as"])
+            attribute_matches.append(lambda attributes: attributes.as_path[-1:] == (origin_as,))
+        if "as_path_length_min" in match:
+            shortest = match["as_path_length_min"]
+            attribute_matches.append(lambda attributes: len(attributes.as_path) >= shortest)
+        if "as_path_length_max" in match:
+            longest = match["as_path_length_max"]
+            attribute_matches.append(lambda attributes: len(attributes.as_path) <= longest)
+
+        if "origin" in sets:
+            if sets["origin"] not in ORIGINS:
+                raise PolicyError(f"{where}: origin must be one of {', '.join(ORIGINS)}")
+            sets["origin"] = ORIGINS[sets["origin"]]
+        return RouteMapClause(seq, permit, prefix_list, neighbors, attribute_matches, sets, local_as)
+
+    def apply(self, neighbor_id, key, attributes):
+        """ The attributes a route leaves the map with, or None if it is denied.
+            `key` is the route's IPv4Network."""
+        eligible = self.unconditional
+        if self.trie is not None:
+            eligible |= self.trie.permitted(int(key.network_address), key.prefixlen)
+        pair = (neighbor_id, attributes)
+        matched = self._matched.get(pair)
+        if matched is None:
+            if len(self._matched) >= MEMO_SIZE:
+                self._matched.clear()
+            matched = 0
+            for index, clause in enumerate(self.clauses):
+                if clause.matches(neighbor_id, attributes):
+                    matched |= 1 << index
+            self._matched[pair] = matched
+        eligible &= matched
+        if not eligible:
+            return None
+        index = (eligible & -eligible).bit_length() - 1
+        if not self.clauses[index].permit:
+            return None
+        result = self._results.get((index, attributes))
+        if result is None:
+            if len(self._results) >= MEMO_SIZE:
+                self._results.clear()
+            result = self._results[index, attributes] = self.clauses[index].apply(attributes)
+        return result
+
+
+class Policy:
+    def __init__(self, route_maps, imports, exports):
+        """ `imports` and `exports` map neighbor IDs, or "*" for any other
+            neighbor, to the RouteMap applied to routes from or to them."""
+        self.route_maps = route_maps
+        self.default_import = imports.pop("*", None)
+        self.default_export = exports.pop("*", None)
+        self.imports = imports
+        self.exports = exports
+        self.denied = 0  # routes denied on import or export
+
+    @classmethod
+    def from_config(cls, policies, local_as):
+        """ Compile a router's "policies". Returns None when no route map is
+            applied, so routers without policies pay nothing for them."""
+        if not policies or not (policies.get("import") or policies.get("export")):
+            return None
+        prefix_lists = {
+            name: PrefixList(name, entries) for name, entries in policies.get("prefix_lists", {}).items()
+        }
+        route_maps = {
+            name: RouteMap(name, clauses, prefix_lists, local_as)
+            for name, clauses in policies.get("route_maps", {}).items()
+        }
+
+        def bind(direction):
+            bound = {}
+            for neighbor, name in policies.get(direction, {}).items():
+                if name not in route_maps:
+                    raise PolicyError(f"{direction} policy for {neighbor}: no route map {name!r}")
+                bound[neighbor if neighbor == "*" else _neighbor(neighbor)] = route_maps[name]
+            return bound
+
+        policy = cls(route_maps, bind("import"), bind("export"))
+        log.debug("Compiled %d route maps and %d prefix lists", len(route_maps), len(prefix_lists))
+        return policy
+
+    def import_route(self, neighbor_id, key, attributes):
+        """The attributes to store for a route learned from a neighbor, or None to reject it."""
+        route_map = self.imports.get(neighbor_id, self.default_import)
+        if route_map is None:
+            return attributes
+        result = route_map.apply(neighbor_id, key, attributes)
+        if result is None:
+            self.denied += 1
+        return result
+
+    def export_route(self, peer_id, key, attributes):
+        """The attributes to advertise a route to a peer with, or None to not advertise it."""
+        route_map = self.exports.get(peer_id, self.default_export)
+        if route_map is None:
+            return attributes
+        result = route_map.apply(peer_id, key, attributes)
+        if result is None:
+            self.denied += 1
+        return result
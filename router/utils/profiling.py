@@ -0,0 +1,379 @@
+""" Opt-in profiling of a running router, per subsystem and per thread.
+
+    A `Profiler` has two modes:
+
+      sample    a background thread takes the Python stack of every thread
+                every `interval` seconds. The stacks are written as collapsed
+                stacks ("thread;outer;...;inner count" lines) for
+                flamegraph.pl, speedscope and the like, and each sample's
+                wall time, and the CPU time its thread used since the last
+                one, is charged to the innermost subsystem on its stack.
+      cprofile  sampling as above, and each outermost call into a subsystem
+                also runs under a cProfile profile of its thread and is timed
+                exactly. Every thread's profile is written as a .pstats file.
+                This costs much more than sampling.
+
+    The subsystems are the main stages of the router:
+
+      handle_neighbor_messages  a session's receive loop, less what is below
+      socket I/O                reading and framing from the socket
+                                (messages/framing.py), `send_message` and
+                                the writer threads (utils/send_queue.py)
+      codec                     encoding and decoding messages (the rest of messages/)
+      update_routing_table      applying a received UPDATE to the RIB
+      propagate_routes          advertising Loc-RIB changes to the neighbors,
+                                including when an MRAI timer sends them
+      exchange_votes            a voting round
+      other                     anything else: timers, idle threads, ...
+
+    In cprofile mode, handle_neighbor_messages is left out of the exact
+    timings, as it is one call for the life of a session.
+
+    Nothing is wrapped or sampled until `start`, and `stop` puts the router
+    back as it was and writes the results to `directory`. The production
+    runtimes set this up through the environment and toggle it with
+    SIGUSR1, so a running container can be profiled without a restart:
+
+        BGP_PROFILE           1 to start profiling at startup
+        BGP_PROFILE_MODE      sample (default) or cprofile
+        BGP_PROFILE_DIR       where results go, /tmp/bgp-profile by default
+        BGP_PROFILE_INTERVAL  seconds between samples, 0.005 by default
+"""
+import cProfile
+import os
+import signal
+import sys
+import threading
+import time
+
+from utils.logs import get_logger
+
+log = get_logger("profiling")
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+DEFAULT_DIRECTORY = "/tmp/bgp-profile"
+DEFAULT_INTERVAL = 0.005
+OTHER = "other"
+SOCKET_IO = "socket I/O"
+CODEC = "codec"
+# Router methods -> the subsystem they are; the asyncio runtime's session loop is handle_session
+METHOD_SUBSYSTEMS = {
+    "handle_neighbor_messages": "handle_neighbor_messages",
+    "handle_session": "handle_neighbor_messages",
+    "send_message": SOCKET_IO,
+    "update_routing_table": "update_routing_table",
+    "propagate_routes": "propagate_routes",
+    # What propagate_routes sends right away is sent by these once an MRAI timer or a new session is due
+    "advertise": "propagate_routes",
+    "send_routing_table": "propagate_routes",
+    "exchange_votes": "exchange_votes",
+}
+# Methods run under cProfile and timed exactly in cprofile mode -> their subsystem
+TIMED_METHODS = {
+    "update_routing_table": "update_routing_table",
+    "propagate_routes": "propagate_routes",
+    "flush_advertisements": "propagate_routes",
+    "exchange_votes": "exchange_votes",
+}
+TIMED_CODEC_METHODS = ("encode", "decode")
+MESSAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "messages")
+FRAMING_FILE = os.path.join(MESSAGES_DIR, "framing.py")
+SEND_QUEUE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "send_queue.py")
+
+
+def _thread_cpu_clock(ident):
+    """A clock ID for the CPU time of another thread, or None where the platform has none."""
+    try:
+        return time.pthread_getcpuclockid(ident)
+    except (AttributeError, OSError):
+        return None
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SubsystemTimes:
+    """Wall and CPU seconds and calls (or samples) per (subsystem, thread)."""
+    __slots__ = ("calls", "wall", "cpu")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+
+class Profiler:
+    def __init__(self, routers, directory=DEFAULT_DIRECTORY, mode=SAMPLE, interval=DEFAULT_INTERVAL, name=None):
+        """ Profile one router or a list of them, e.g. every router of a
+            simulation. `name` prefixes the result files; by default it is
+            the router ID, or "simulation" for several routers."""
+        if mode not in (SAMPLE, CPROFILE):
+            raise ValueError(f"profiling mode must be '{SAMPLE}' or '{CPROFILE}', not {mode!r}")
+        self.routers = routers if isinstance(routers, (list, tuple)) else [routers]
+        if name is None:
+            name = f"router{self.routers[0].router_id}" if len(self.routers) == 1 else "simulation"
+        self.name = name
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.active = False
+        self.started = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._sampler = None
+        self._stacks = {}  # (thread name, code objects outermost first) -> samples
+        self._sampled = {}  # (subsystem, thread name) -> SubsystemTimes from samples
+        self._timed = {}  # (subsystem, thread name) -> SubsystemTimes from cprofile mode's wrappers
+        self._profiles = {}  # thread name -> cProfile.Profile
+        self._local = threading.local()  # .depth of wrapped calls on this thread
+        self._wrapped = []  # (object, attribute, what the instance had before or None) replaced by `start`
+        self._in_flight = 0  # profiled calls running, waited for before their profiles are written
+        self._subsystem_codes = {}
+
+    @classmethod
+    def from_environment(cls, router):
+        """The profiler the production runtimes give a router, configured from BGP_PROFILE_*."""
+        return cls(
+            router,
+            directory=os.getenv("BGP_PROFILE_DIR", DEFAULT_DIRECTORY),
+            mode=os.getenv("BGP_PROFILE_MODE", SAMPLE),
+            interval=float(os.getenv("BGP_PROFILE_INTERVAL", DEFAULT_INTERVAL)),
+        )
+
+    def install_signal(self, signum=signal.SIGUSR1, loop=None):
+        """ Toggle profiling on `signum`, as a callback of the asyncio `loop` if
+            given. Returns False where signals cannot be handled (not the main thread)."""
+        try:
+            if loop is not None:
+                loop.add_signal_handler(signum, self.toggle)
+            else:
+                signal.signal(signum, lambda *_: self.toggle())
+        except (ValueError, AttributeError, OSError, NotImplementedError, RuntimeError):
+            return False
+        return True
+
+    def toggle(self):
+        """Start profiling, or stop it and write the results. Returns the files written, if any."""
+        if self.active:
+            return self.stop()
+        self.start()
+        return []
+
+    def start(self):
+        with self._lock:
+            if self.active:
+                return
+            self.active = True
+            self.started = time.time()
+            self._stacks = {}
+            self._sampled = {}
+            self._timed = {}
+            self._profiles = {}
+            self._subsystem_codes = self._find_subsystem_codes()
+            if self.mode == CPROFILE:
+                self._wrap_all()
+            self._stopping.clear()
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+        log.info("Profiling %s (%s mode, every %ss)", self.name, self.mode, self.interval)
+
+    def stop(self):
+        """Stop profiling and write the results. Returns the paths written."""
+        with self._lock:
+            if not self.active:
+                return []
+            self.active = False
+            self._stopping.set()
+            self._sampler.join()
+            self._sampler = None
+            self._unwrap_all()
+            # A profile must not be written while its thread is still in a call that enabled it
+            deadline = time.monotonic() + 1.0
+            while self._in_flight and time.monotonic() < deadline:
+                time.sleep(0.001)
+            return self.dump()
+
+    # Sampling
+
+    def _find_subsystem_codes(self):
+        codes = {}
+        for router in self.routers:
+            for method, subsystem in METHOD_SUBSYSTEMS.items():
+                function = getattr(type(router), method, None)
+                code = getattr(function, "__code__", None)
+                if code is not None:
+                    codes[code] = subsystem
+        return codes
+
+    def _subsystem(self, code):
+        subsystem = self._subsystem_codes.get(code)
+        if subsystem is None:
+            filename = code.co_filename
+            if filename == FRAMING_FILE or filename == SEND_QUEUE_FILE:
+                subsystem = SOCKET_IO
+            elif filename.startswith(MESSAGES_DIR):
+                subsystem = CODEC
+        return subsystem
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {}
+        clocks = {}
+        cpu_seen = {}
+        last = time.perf_counter()
+        while not self._stopping.wait(self.interval):
+            now = time.perf_counter()
+            elapsed = now - last
+            last = now
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident)
+                if name is None:
+                    names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                    name = names.get(ident, str(ident))
+                    clocks[ident] = _thread_cpu_clock(ident)
+                cpu = 0.0
+                clock = clocks.get(ident)
+                if clock is not None:
+                    try:
+                        used = time.clock_gettime(clock)
+                    except OSError:
+                        # The thread ended since the frames were taken
+                        continue
+                    cpu = used - cpu_seen.get(ident, used)
+                    cpu_seen[ident] = used
+                codes = []
+                subsystem = None
+                while frame is not None:
+                    code = frame.f_code
+                    codes.append(code)
+                    if subsystem is None:
+                        subsystem = self._subsystem(code)
+                    frame = frame.f_back
+                codes.reverse()
+                key = (name, tuple(codes))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+                times = self._sampled.get((subsystem or OTHER, name))
+                if times is None:
+                    times = self._sampled[subsystem or OTHER, name] = SubsystemTimes()
+                times.calls += 1
+                times.wall += elapsed
+                times.cpu += cpu
+
+    # cprofile mode
+
+    def _wrap_all(self):
+        for router in self.routers:
+            for method, subsystem in TIMED_METHODS.items():
+                self._wrap(router, method, subsystem)
+            for method in TIMED_CODEC_METHODS:
+                self._wrap(router.codec, method, CODEC)
+
+    def _wrap(self, target, attribute, subsystem):
+        function = getattr(target, attribute, None)
+        if function is None:
+            return
+        # Another wrapper set on the instance, such as the metrics', is put back by `_unwrap_all`
+        previous = vars(target).get(attribute)
+        profiler = self
+        local = self._local
+
+        def profiled(*args, **kwargs):
+            depth = getattr(local, "depth", 0)
+            if depth or not profiler.active:
+                return function(*args, **kwargs)
+            # Only the outermost subsystem call of a thread is profiled and timed, so nothing counts twice
+            name = threading.current_thread().name
+            profile = profiler._profiles.get(name)
+            if profile is None:
+                profile = profiler._profiles[name] = cProfile.Profile()
+            local.depth = 1
+            profiler._in_flight += 1
+            wall = time.perf_counter()
+            cpu = time.thread_time()
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                local.depth = 0
+                profiler._in_flight -= 1
+                times = profiler._timed.get((subsystem, name))
+                if times is None:
+                    times = profiler._timed[subsystem, name] = SubsystemTimes()
+                times.calls += 1
+                times.wall += time.perf_counter() - wall
+                times.cpu += time.thread_time() - cpu
+
+        setattr(target, attribute, profiled)
+        self._wrapped.append((target, attribute, previous))
+
+    def _unwrap_all(self):
+        for target, attribute, previous in reversed(self._wrapped):
+            if previous is None:
+                # The class attribute shows through again
+                delattr(target, attribute)
+            else:
+                setattr(target, attribute, previous)
+        self._wrapped = []
+
+    # Results
+
+    def collapsed_stacks(self):
+        """The samples as collapsed stack lines, heaviest first."""
+        lines = []
+        for (thread, codes), count in sorted(list(self._stacks.items()), key=lambda item: -item[1]):
+            frames = ";".join([thread.replace(";", ",")] + [_frame_name(code) for code in codes])
+            lines.append(f"{frames} {count}")
+        return lines
+
+    def subsystem_table(self):
+        """The per-subsystem wall and CPU times as a text table."""
+        lines = []
+        sections = [("sampled", "samples", self._sampled)]
+        if self.mode == CPROFILE:
+            sections.append(("exact, outermost calls", "calls", self._timed))
+        for title, count_name, table in sections:
+            lines.append(f"{self.name}: per subsystem, {title}")
+            lines.append(f"{'subsystem':<26} {'thread':<24} {count_name:>9} {'wall s':>10} {'cpu s':>10} {'cpu %':>6}")
+            totals = {}
+            table = dict(table)
+            for (subsystem, thread), times in table.items():
+                total = totals.setdefault(subsystem, SubsystemTimes())
+                total.calls += times.calls
+                total.wall += times.wall
+                total.cpu += times.cpu
+            for subsystem, total in sorted(totals.items(), key=lambda item: -item[1].cpu):
+                rows = [("(all threads)", total)] + sorted(
+                    ((thread, times) for (name, thread), times in table.items() if name == subsystem),
+                    key=lambda item: -item[1].cpu,
+                )
+                for thread, times in rows:
+                    share = 100 * times.cpu / times.wall if times.wall else 0.0
+                    lines.append(
+                        f"{subsystem:<26} {thread[:24]:<24} {times.calls:>9} {times.wall:>10.3f} {times.cpu:>10.3f} {share:>6.1f}"
+                    )
+            lines.append("")
+        return "\n".join(lines)
+
+    def dump(self):
+        """Write the collapsed stacks, the subsystem table and in cprofile mode the .pstats files. Returns their paths."""
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}")
+        paths = []
+        with open(f"{prefix}.collapsed", "w") as f:
+            f.write("\n".join(self.collapsed_stacks()) + "\n")
+        paths.append(f"{prefix}.collapsed")
+        table = self.subsystem_table()
+        with open(f"{prefix}-subsystems.txt", "w") as f:
+            f.write(table)
+        paths.append(f"{prefix}-subsystems.txt")
+        for thread, profile in list(self._profiles.items()):
+            path = f"{prefix}-{thread.replace(os.sep, '_')}.pstats"
+            profile.dump_stats(path)
+            paths.append(path)
+        log.info("Wrote profile of %s to %s*\n%s", self.name, prefix, table)
+        return paths
@@ -0,0 +1,358 @@
+from utils.routing_table import Route, RoutingTable, parse_network, next_hop_key, paused_gc
+from utils.path_attributes import attribute_cache, as_number, prepend_as, DEFAULT_LOCAL_PREF, ORIGIN_IGP
+
+
+class AdjRibIn:
+    """Routes received from one neighbor, before best-path selection."""
+
+    def __init__(self, neighbor_id):
+        self.neighbor_id = neighbor_id
+        self.routes = {}  # IPv4Network -> PathAttributes
+
+    def __len__(self):
+        return len(self.routes)
+
+
+class AdjRibOut:
+    """Routes advertised to one peer, so only real changes are sent to it."""
+
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.routes = {}  # IPv4Network -> PathAttributes as advertised
+        self.pending = {}  # IPv4Network -> route or None, Loc-RIB changes waiting for the MRAI timer
+
+    def __len__(self):
+        return len(self.routes)
+
+
+class Rib:
+    def __init__(self, router_id, trust_model, local_as=None, attributes=None, damping=None, policy=None,
+                 local_pref=DEFAULT_LOCAL_PREF, med=0):
+        """ Per-neighbor Adj-RIB-In, the Loc-RIB holding the selected best paths and per-peer Adj-RIB-Out.
+
+            The Adj-RIBs store interned `PathAttributes` from `attributes`
+            (the process wide cache by default) rather than route dicts.
+            With a `FlapDamping`, learned routes that flap too often are
+            kept out of best-path selection until it reuses them. A `Policy`
+            filters and rewrites routes on import and export; learned routes
+            get `local_pref` and advertised ones `med` unless it sets others.
+        """
+        self.router_id = router_id
+        self.trust_model = trust_model
+        self.local_as = as_number(local_as) if local_as is not None else router_id
+        self.attributes = attributes if attributes is not None else attribute_cache
+        self.loc_rib = RoutingTable(router_id)
+        self.adj_rib_in = {}
+        self.adj_rib_out = {}
+        self.candidates = {}  # IPv4Network -> {neighbor key: PathAttributes}, every Adj-RIB-In entry for the prefix
+        self.stale = {}  # neighbor key -> prefixes kept across a restart that it has not announced again yet
+        self.static = {}  # neighbor key -> prefixes configured rather than learned, never marked stale
+        self.listeners = []  # called as listener(old route, new route) for every Loc-RIB change
+        self.damping = damping
+        self.policy = policy
+        self.local_pref = local_pref
+        self.med = med
+        self.loops_rejected = 0
+        self.filtered = 0  # learned routes the import policy denied
+        self.selections = 0  # best-path computations run, reported by the benchmarks
+
+    def rib_in(self, neighbor_id):
+        if neighbor_id not in self.adj_rib_in:
+            self.adj_rib_in[neighbor_id] = AdjRibIn(neighbor_id)
+            # Give the neighbor its trust slot now, so selection always finds it in the score map
+            self.trust_model.slot(neighbor_id)
+        return self.adj_rib_in[neighbor_id]
+
+    def rib_out(self, peer_id):
+        if peer_id not in self.adj_rib_out:
+            self.adj_rib_out[peer_id] = AdjRibOut(peer_id)
+        return self.adj_rib_out[peer_id]
+
+    def _store(self, neighbor_id, key, attributes):
+        """Store a route in a neighbor's Adj-RIB-In. Returns False if nothing changed."""
+        rib_in = self.rib_in(neighbor_id)
+        if rib_in.routes.get(key) is attributes:
+            return False
+        rib_in.routes[key] = attributes
+        if self.damping is not None and self.damping.is_suppressed(key, neighbor_id):
+            # Kept for when damping reuses it, but not selectable meanwhile
+            return self._uncandidate(neighbor_id, key)
+        self.candidates.setdefault(key, {})[neighbor_id] = attributes
+        return True
+
+    def _uncandidate(self, neighbor_id, key):
+        """Take a neighbor's route out of best-path selection. Returns False if it was not a candidate."""
+        candidates = self.candidates.get(key)
+        if candidates is None or candidates.pop(neighbor_id, None) is None:
+            return False
+        if not candidates:
+            del self.candidates[key]
+        return True
+
+    def _discard(self, neighbor_id, key):
+        """Remove a route from a neighbor's Adj-RIB-In. Returns False if it was not there."""
+        rib_in = self.adj_rib_in.get(neighbor_id)
+        if rib_in is None or rib_in.routes.pop(key, None) is None:
+            return False
+        self._uncandidate(neighbor_id, key)
+        return True
+
+    def _flapped(self, charge, neighbor_id, key):
+        """Charge a damping penalty for a learned route; configured routes are never damped."""
+        if key not in self.static.get(neighbor_id, ()):
+            charge(key, neighbor_id)
+
+    def add_static_route(self, network, next_hop, as_path):
+        """Load a configured route into the Adj-RIB-In of the neighbor it points at."""
+        key = parse_network(network)
+        neighbor_id = next_hop_key(next_hop)
+        self.static.setdefault(neighbor_id, set()).add(key)
+        if self._store(neighbor_id, key, self.attributes.get(neighbor_id, as_path, self.local_pref)):
+            return self._recompute([key])
+        return []
+
+    def update(self, neighbor_id, routes):
+        """ Apply an UPDATE from a neighbor and return the resulting Loc-RIB changes.
+
+            A route whose AS path already contains our AS has looped, and one
+            the import policy denies is filtered; either is treated as a
+            withdrawal of whatever the neighbor sent before.
+        """
+        dirty = []
+        stale = self.stale.get(neighbor_id)
+        damping = self.damping
+        policy = self.policy
+        rib_in = self.adj_rib_in.get(neighbor_id)
+        for route in routes:
+            key = parse_network(route['network'])
+            if stale:
+                stale.discard(key)
+            attributes = self.attributes.get(
+                neighbor_id, route['as_path'], self.local_pref, route.get('med', 0), route.get('origin', ORIGIN_IGP)
+            )
+            if self.local_as in attributes.as_path:
+                self.loops_rejected += 1
+                attributes = None
+            elif policy is not None:
+                attributes = policy.import_route(neighbor_id, key, attributes)
+                if attributes is None:
+                    self.filtered += 1
+            if attributes is None:
+                changed = self._discard(neighbor_id, key)
+                if changed and damping is not None:
+                    self._flapped(damping.withdrawn, neighbor_id, key)
+            else:
+                if damping is not None and rib_in is not None:
+                    previous = rib_in.routes.get(key)
+                    if previous is not None and previous is not attributes:
+                        self._flapped(damping.changed, neighbor_id, key)
+                changed = self._store(neighbor_id, key, attributes)
+            if changed:
+                dirty.append(key)
+        return self._recompute(dirty)
+
+    def withdraw(self, neighbor_id, networks):
+        """Apply a withdrawal from a neighbor and return the resulting Loc-RIB changes."""
+        dirty = []
+        stale = self.stale.get(neighbor_id)
+        for network in networks:
+            key = parse_network(network)
+            if stale:
+                stale.discard(key)
+            if self._discard(neighbor_id, key):
+                dirty.append(key)
+                if self.damping is not None:
+                    self._flapped(self.damping.withdrawn, neighbor_id, key)
+        return self._recompute(dirty)
+
+    def drop_neighbor(self, neighbor_id):
+        """Flush everything learned from and advertised to a neighbor, failing over to alternate paths."""
+        self.adj_rib_out.pop(neighbor_id, None)
+        self.stale.pop(neighbor_id, None)
+        rib_in = self.adj_rib_in.pop(neighbor_id, None)
+        if rib_in is None:
+            return []
+        for key in rib_in.routes:
+            self._uncandidate(neighbor_id, key)
+            if self.damping is not None:
+                self._flapped(self.damping.withdrawn, neighbor_id, key)
+        return self._recompute(list(rib_in.routes))
+
+    def reuse(self, key, neighbor_id):
+        """Make a route that flap damping suppressed selectable again. Returns the Loc-RIB changes."""
+        rib_in = self.adj_rib_in.get(neighbor_id)
+        attributes = rib_in.routes.get(key) if rib_in is not None else None
+        if attributes is None:
+            return []
+        self.candidates.setdefault(key, {})[neighbor_id] = attributes
+        return self._recompute([key])
+
+    def load_routes(self, routes):
+        """ Bulk-load Route records, e.g. from an MRT dump, as configured routes
+            of their next hops, with one best-path pass at the end. Routes
+            whose AS path contains our AS are dropped as loops. If reading
+            `routes` fails, the routes read until then are still selected
+            from before the error is raised, so the RIB stays consistent."""
+        dirty = []
+        with paused_gc():
+            try:
+                for route in routes:
+                    neighbor_id = route.next_hop
+                    attributes = self.attributes.get(neighbor_id, route.as_path, self.local_pref)
+                    if self.local_as in attributes.as_path:
+                        self.loops_rejected += 1
+                        continue
+                    key = route.network
+                    if self._store(neighbor_id, key, attributes):
+                        self.static.setdefault(neighbor_id, set()).add(key)
+                        dirty.append(key)
+            except Exception:
+                self._recompute(dirty, bulk=True)
+                raise
+            return self._recompute(dirty, bulk=True)
+
+    def restore(self, routes):
+        """ Load checkpointed Loc-RIB routes as stale Adj-RIB-In entries of their next hops.
+
+            They are used like any other route until the neighbor's End-of-RIB
+            (or its restart timer) sweeps the ones it did not announce again.
+            Configured routes already in the neighbor's Adj-RIB-In win.
+        """
+        dirty = []
+        for route in routes:
+            key = route.network
+            neighbor_id = route.next_hop
+            if key in self.rib_in(neighbor_id).routes:
+                continue
+            self._store(neighbor_id, key, self.attributes.get(neighbor_id, route.as_path, self.local_pref))
+            self.stale.setdefault(neighbor_id, set()).add(key)
+            dirty.append(key)
+        return self._recompute(dirty, bulk=True)
+
+    def mark_stale(self, neighbor_id):
+        """ Keep a neighbor's routes as stale while it restarts, instead of
+            withdrawing them. Its Adj-RIB-Out is cleared so it gets the
+            whole table again when it comes back."""
+        self.adj_rib_out.pop(neighbor_id, None)
+        rib_in = self.adj_rib_in.get(neighbor_id)
+        if rib_in is not None and rib_in.routes:
+            static = self.static.get(neighbor_id, ())
+            self.stale.setdefault(neighbor_id, set()).update(key for key in rib_in.routes if key not in static)
+
+    def sweep_stale(self, neighbor_id):
+        """Drop the neighbor's routes that are still stale and return the resulting Loc-RIB changes."""
+        dirty = [key for key in self.stale.pop(neighbor_id, ()) if self._discard(neighbor_id, key)]
+        return self._recompute(dirty)
+
+    def select(self, key, trust=None):
+        """ Run best-path selection over the candidates of one prefix: the RFC 4271
+            decision process (highest LOCAL_PREF, shortest AS path, lowest
+            ORIGIN, lowest MED, precomputed as `PathAttributes.rank`), then highest trust.
+
+            `trust` is the trust model's score map; pass it in when selecting
+            many prefixes so it is fetched once.
+        """
+        self.selections += 1
+        candidates = self.candidates.get(key)
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return next(iter(candidates.values()))
+        if trust is None:
+            trust = self.trust_model.score_map()
+        return min(
+            candidates.values(),
+            key=lambda attributes: (attributes.rank, -trust[attributes.next_hop])
+        )
+
+    def _recompute(self, dirty, bulk=False):
+        """ Reselect the best path for the given prefixes only. Returns [(prefix, new best or None)].
+
+            With `bulk`, new and changed best paths are installed in one
+            `load_items` call after the selection pass.
+        """
+        changes = []
+        installs = []
+        trust = self.trust_model.score_map()
+        for key in dirty:
+            best = self.select(key, trust)
+            current = self.loc_rib.routes.get(key)
+            if best is None:
+                if current is not None:
+                    self.loc_rib.remove_route(key)
+                    changes.append((key, None))
+                    for listener in self.listeners:
+                        listener(current, None)
+            elif current is None or current.as_path is not best.as_path or current.next_hop != best.next_hop:
+                if bulk:
+                    installs.append((key, Route(int(key.network_address), key.prefixlen, best.next_hop, best.as_path)))
+                    continue
+                route = self.loc_rib.add_route(key, best.next_hop, best.as_path)
+                changes.append((key, route))
+                for listener in self.listeners:
+                    listener(current, route)
+        if installs:
+            replaced = [self.loc_rib.routes.get(key) for key, _ in installs]
+            self.loc_rib.load_items(installs)
+            changes.extend(installs)
+            for current, (_, route) in zip(replaced, installs):
+                for listener in self.listeners:
+                    listener(current, route)
+        return changes
+
+    def get_best_route(self, network):
+        """Return the cached best path for a network from the Loc-RIB."""
+        return self.loc_rib.get_route(network)
+
+    def export(self, peer_id, changes, local_as=None):
+        """Turn Loc-RIB changes into the announcements and withdrawals that peer has not seen yet."""
+        local_as = self.local_as if local_as is None else as_number(local_as)
+        rib_out = self.rib_out(peer_id)
+        announce = []
+        withdraw = []
+        for key, route in changes:
+            # Split horizon: never advertise a route back to the neighbor it was learned
+            # from, nor to a peer whose AS (AS<peer ID>) is on the path, which would drop it as a loop
+            if route is None or route.next_hop == peer_id or peer_id in route.as_path:
+                if rib_out.routes.pop(key, None) is not None:
+                    withdraw.append({"network": str(key)})
+                continue
+            selected = self.candidates.get(key, {}).get(route.next_hop)
+            origin = selected.origin if selected is not None else ORIGIN_IGP
+            advertised = self.attributes.get(
+                self.router_id, prepend_as(route.as_path, local_as), DEFAULT_LOCAL_PREF, self.med, origin
+            )
+            if self.policy is not None:
+                advertised = self.policy.export_route(peer_id, key, advertised)
+                if advertised is None:
+                    if rib_out.routes.pop(key, None) is not None:
+                        withdraw.append({"network": str(key)})
+                    continue
+            if rib_out.routes.get(key) is advertised:
+                continue
+            rib_out.routes[key] = advertised
+            message = {"network": str(key), "next_hop": self.router_id, "as_path": advertised.as_path}
+            # Only carried when set, so routes without policy stay as small as before
+            if advertised.med:
+                message["med"] = advertised.med
+            if advertised.origin != ORIGIN_IGP:
+                message["origin"] = advertised.origin
+            announce.append(message)
+        return announce, withdraw
+
+    def enqueue(self, peer_id, changes):
+        """Queue Loc-RIB changes for a peer; a later change to a prefix replaces the queued one."""
+        self.rib_out(peer_id).pending.update(changes)
+
+    def take_pending(self, peer_id):
+        """Remove and return the changes queued for a peer, as a change list."""
+        rib_out = self.adj_rib_out.get(peer_id)
+        if rib_out is None or not rib_out.pending:
+            return []
+        changes = list(rib_out.pending.items())
+        rib_out.pending = {}
+        return changes
+
+    def full_table(self):
+        """Loc-RIB contents as a change list, used to send the whole table to a new peer."""
+        return list(self.loc_rib.routes.items())
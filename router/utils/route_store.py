@@ -0,0 +1,175 @@
+""" Columnar bulk storage for routing table snapshots.
+
+    `RouteColumns` keeps routes as parallel typed arrays from the `array`
+    module instead of one object per route: a 4-byte prefix, a 1-byte prefix
+    length, and 4-byte indexes into small tables of the distinct next hops
+    and AS paths. That is 13 bytes per route plus the shared tables, which
+    makes it suitable for RIB snapshots of internet scale tables. The
+    columns can be handed to NumPy without copying when it is installed.
+
+    `save` writes the columns to a checkpoint file laid out so that `load`
+    can memory-map it: the columns are used in place from the page cache
+    and only the small next hop and AS path tables are parsed.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from utils.path_attributes import intern_as_path
+from utils.routing_table import Route
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+CHECKPOINT_MAGIC = b"BGPRIB\x00\x01"
+# magic, byte order (0 little, 1 big), routes, distinct AS paths, AS numbers over all paths, next hop table bytes
+CHECKPOINT_HEADER = struct.Struct("<8sBxxxIIII")
+NATIVE_ORDER = 0 if sys.byteorder == "little" else 1
+
+
+class CheckpointError(ValueError):
+    """Raised when a checkpoint file is truncated, corrupt or from an incompatible host."""
+
+
+class RouteColumns:
+    def __init__(self):
+        self.prefixes = array("I")
+        self.prefixlens = array("B")
+        self.next_hop_ids = array("I")
+        self.path_ids = array("I")
+        self.next_hops = []  # distinct next hops, indexed by next_hop_ids
+        self.paths = []  # distinct AS paths, indexed by path_ids
+        self._next_hop_index = {}
+        self._path_index = {}
+
+    @classmethod
+    def from_routes(cls, routes):
+        columns = cls()
+        columns.extend(routes)
+        return columns
+
+    @classmethod
+    def from_routing_table(cls, routing_table):
+        """Snapshot every route of a RoutingTable (or a Rib's Loc-RIB)."""
+        return cls.from_routes(routing_table.routes.values())
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def _intern(self, value, table, index):
+        position = index.get(value)
+        if position is None:
+            position = index[value] = len(table)
+            table.append(value)
+        return position
+
+    def append(self, route):
+        self.prefixes.append(route.prefix)
+        self.prefixlens.append(route.prefixlen)
+        self.next_hop_ids.append(self._intern(route.next_hop, self.next_hops, self._next_hop_index))
+        self.path_ids.append(self._intern(route.as_path, self.paths, self._path_index))
+
+    def extend(self, routes):
+        for route in routes:
+            self.append(route)
+
+    def route(self, i):
+        """Rebuild the i-th route as a Route record."""
+        return Route(
+            self.prefixes[i], self.prefixlens[i], self.next_hops[self.next_hop_ids[i]], self.paths[self.path_ids[i]]
+        )
+
+    def __iter__(self):
+        next_hops = self.next_hops
+        paths = self.paths
+        for prefix, prefixlen, hop_id, path_id in zip(self.prefixes, self.prefixlens, self.next_hop_ids, self.path_ids):
+            yield Route(prefix, prefixlen, next_hops[hop_id], paths[path_id])
+
+    def nbytes(self):
+        """Bytes used by the columns themselves, not counting the shared next hop and path tables."""
+        return sum(column.itemsize * len(column) for column in (self.prefixes, self.prefixlens, self.next_hop_ids, self.path_ids))
+
+    def save(self, path):
+        """ Write a checkpoint file, atomically replacing `path`.
+
+            Layout after the header, every section 4-byte aligned: prefixes,
+            next hop IDs and path IDs as 32-bit integers, prefix lengths as
+            bytes, the offsets of each AS path into the flat list of AS
+            numbers that follows, and the next hop table as JSON. Integers
+            are in the writing host's byte order.
+        """
+        offsets = array("I", [0])
+        asns = array("I")
+        for as_path in self.paths:
+            asns.extend(as_path)
+            offsets.append(len(asns))
+        next_hops = json.dumps(self.next_hops).encode()
+        prefixlens = bytes(self.prefixlens)
+        sections = [
+            CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, NATIVE_ORDER, len(self), len(self.paths), len(asns), len(next_hops)),
+            bytes(self.prefixes), bytes(self.next_hop_ids), bytes(self.path_ids),
+            prefixlens, bytes(-len(prefixlens) % 4),
+            offsets.tobytes(), asns.tobytes(), next_hops,
+        ]
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as checkpoint:
+            checkpoint.writelines(sections)
+            # On disk before the rename, so a crash cannot leave an empty or partial checkpoint in its place
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Memory-map a checkpoint written by `save`. The columns are
+            read-only views of the file, so the result cannot be appended to."""
+        with open(path, "rb") as checkpoint:
+            # An empty file cannot be mapped at all
+            if os.fstat(checkpoint.fileno()).st_size < CHECKPOINT_HEADER.size:
+                raise CheckpointError(f"{path}: truncated header")
+            view = memoryview(mmap.mmap(checkpoint.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, order, count, path_count, asn_count, next_hops_len = CHECKPOINT_HEADER.unpack_from(view)
+        if magic != CHECKPOINT_MAGIC:
+            raise CheckpointError(f"{path}: not a RIB checkpoint")
+        if order != NATIVE_ORDER:
+            raise CheckpointError(f"{path}: written on a host with the other byte order")
+        word = array("I").itemsize
+        expected = (
+            CHECKPOINT_HEADER.size + 3 * count * word + count + (-count % 4)
+            + (path_count + 1 + asn_count) * word + next_hops_len
+        )
+        if len(view) != expected:
+            raise CheckpointError(f"{path}: expected {expected} bytes, found {len(view)}")
+
+        def take(offset, length, fmt):
+            return view[offset:offset + length].cast(fmt), offset + length
+
+        columns = cls()
+        offset = CHECKPOINT_HEADER.size
+        columns.prefixes, offset = take(offset, count * word, "I")
+        columns.next_hop_ids, offset = take(offset, count * word, "I")
+        columns.path_ids, offset = take(offset, count * word, "I")
+        columns.prefixlens, offset = take(offset, count, "B")
+        offset += -count % 4
+        offsets, offset = take(offset, (path_count + 1) * word, "I")
+        asns, offset = take(offset, asn_count * word, "I")
+        columns.paths = [intern_as_path(tuple(asns[offsets[i]:offsets[i + 1]])) for i in range(path_count)]
+        columns.next_hops = json.loads(bytes(view[offset:offset + next_hops_len]))
+        return columns
+
+    def to_numpy(self):
+        """The columns as NumPy arrays sharing this store's memory. Requires NumPy."""
+        if numpy is None:
+            raise ImportError("NumPy is not installed")
+        return {
+            "prefix": numpy.frombuffer(self.prefixes, dtype=numpy.uint32),
+            "prefixlen": numpy.frombuffer(self.prefixlens, dtype=numpy.uint8),
+            "next_hop_id": numpy.frombuffer(self.next_hop_ids, dtype=numpy.uint32),
+            "path_id": numpy.frombuffer(self.path_ids, dtype=numpy.uint32),
+        }
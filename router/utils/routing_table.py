@@ -1,80 +1,311 @@
+import gc
+import ipaddress
+from contextlib import contextmanager
+
+from utils.logs import get_logger, Lazy
+from utils.path_attributes import intern_as_path
+
+log = get_logger("routing_table")
+
+
+def parse_network(network):
+    """Convert a network given as a string, an (address, prefix length) pair or an existing network into an IPv4Network."""
+    if isinstance(network, ipaddress.IPv4Network):
+        return network
+    if isinstance(network, list):
+        network = tuple(network)
+    return ipaddress.IPv4Network(network, strict=False)
+
+
+def next_hop_key(next_hop):
+    """Normalize a next hop so that 'Router2', 'router2' and 2 all index the same neighbor."""
+    if isinstance(next_hop, str) and next_hop.lower().startswith("router"):
+        try:
+            return int(next_hop[6:])
+        except ValueError:
+            return next_hop
+    return next_hop
+
+
+@contextmanager
+def paused_gc():
+    """ Hold off the cycle collector while bulk-loading: routes cannot form
+        cycles, and a million new objects would trigger full collections
+        that each walk every object loaded so far."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class Route:
+    """ One routing table entry: the prefix as an integer and a length, the
+        neighbor ID of the next hop and an interned tuple of AS numbers."""
+    __slots__ = ("prefix", "prefixlen", "next_hop", "as_path")
+
+    def __init__(self, prefix, prefixlen, next_hop, as_path):
+        self.prefix = prefix
+        self.prefixlen = prefixlen
+        self.next_hop = next_hop
+        self.as_path = as_path
+
+    @classmethod
+    def from_network(cls, network, next_hop, as_path):
+        """Build a route from any network form, a next hop such as "Router2" and an AS path of numbers or "ASn" strings."""
+        key = parse_network(network)
+        return cls(int(key.network_address), key.prefixlen, next_hop_key(next_hop), intern_as_path(as_path))
+
+    @property
+    def network(self):
+        return ipaddress.IPv4Network((self.prefix, self.prefixlen))
+
+    def as_dict(self):
+        return {"network": str(self.network), "next_hop": self.next_hop, "as_path": list(self.as_path)}
+
+    def __eq__(self, other):
+        if not isinstance(other, Route):
+            return NotImplemented
+        return (
+            self.prefix == other.prefix and self.prefixlen == other.prefixlen
+            and self.next_hop == other.next_hop and self.as_path == other.as_path
+        )
+
+    def __repr__(self):
+        return f"Route({self.network}, next_hop={self.next_hop}, as_path={self.as_path})"
+
+
+class _TrieNode:
+    __slots__ = ("children", "network")
+
+    def __init__(self):
+        self.children = [None, None]
+        self.network = None
+
+
 class RoutingTable:
     def __init__(self, router_id):
         self.router_id = router_id
-        self.table = []  # In-memory representation of the routing table
+        self.routes = {}  # IPv4Network -> Route, exact-prefix index
+        self.next_hop_index = {}  # next hop key -> set of IPv4Network
+        self.root = _TrieNode()  # binary radix trie for longest-prefix-match
+        self._trie_pending = None  # (networks, prefixes, lengths) bulk-loaded but not in the trie yet
+
+    @property
+    def table(self):
+        """List view of the routing table, kept for callers that iterate over all routes."""
+        return list(self.routes.values())
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, network):
+        return parse_network(network) in self.routes
+
+    def _trie(self):
+        """The trie root, after inserting any networks a bulk load left pending."""
+        if self._trie_pending is not None:
+            pending, self._trie_pending = self._trie_pending, None
+            self._trie_insert_all(*pending)
+        return self.root
+
+    def _trie_insert(self, key):
+        node = self._trie()
+        bits = int(key.network_address)
+        for depth in range(key.prefixlen):
+            bit = (bits >> (31 - depth)) & 1
+            if node.children[bit] is None:
+                node.children[bit] = _TrieNode()
+            node = node.children[bit]
+        node.network = key
+
+    def _trie_insert_all(self, keys, prefixes, prefixlens):
+        """ Insert many networks at once. They are inserted in address order,
+            keeping the path of the previous one, so each network only walks
+            the bits in which it differs from the previous one."""
+        stack = [self.root]  # stack[depth] is the node at that depth on the previous network's path
+        previous = 0
+        order = [(prefix << 6) | prefixlen for prefix, prefixlen in zip(prefixes, prefixlens)]
+        for i in sorted(range(len(keys)), key=order.__getitem__):
+            bits = prefixes[i]
+            prefixlen = prefixlens[i]
+            common = min(len(stack) - 1, prefixlen, 32 - (bits ^ previous).bit_length())
+            del stack[common + 1:]
+            node = stack[common]
+            for depth in range(common, prefixlen):
+                bit = (bits >> (31 - depth)) & 1
+                child = node.children[bit]
+                if child is None:
+                    child = node.children[bit] = _TrieNode()
+                node = child
+                stack.append(node)
+            node.network = keys[i]
+            previous = bits
+
+    def _trie_remove(self, key):
+        node = self._trie()
+        bits = int(key.network_address)
+        path = []
+        for depth in range(key.prefixlen):
+            bit = (bits >> (31 - depth)) & 1
+            child = node.children[bit]
+            if child is None:
+                return
+            path.append((node, bit))
+            node = child
+        node.network = None
+        # Prune the branch back up to the first node that is still in use
+        while path and node.network is None and node.children == [None, None]:
+            parent, bit = path.pop()
+            parent.children[bit] = None
+            node = parent
+
+    def _index(self, key, route):
+        self.routes[key] = route
+        self.next_hop_index.setdefault(route.next_hop, set()).add(key)
+
+    def _unindex(self, key):
+        route = self.routes.pop(key)
+        hop = route.next_hop
+        networks = self.next_hop_index.get(hop)
+        if networks is not None:
+            networks.discard(key)
+            if not networks:
+                del self.next_hop_index[hop]
+        return route
 
     def add_route(self, network, next_hop, as_path):
-        """Add a new route to the routing table."""
-        route = {
-            "network": network,
-            "next_hop": next_hop,
-            "as_path": as_path
-        }
-        self.table.append(route)
-        self.print_updated_routing_table()
+        """Add a new route to the routing table, replacing any route for the same network."""
+        key = parse_network(network)
+        route = Route(int(key.network_address), key.prefixlen, next_hop_key(next_hop), intern_as_path(as_path))
+        if key in self.routes:
+            self._unindex(key)
+        else:
+            self._trie_insert(key)
+        self._index(key, route)
+        log.debug("Router %s installed route %s via %s", self.router_id, network, next_hop)
+        return route
+
+    def load_routes(self, routes):
+        """ Bulk-install Route records, replacing the routes of the same
+            networks, without a log line per route. Returns how many were installed.
+
+            New networks are only added to the longest-prefix-match trie, all
+            at once, when it is next used, so loading a full table costs
+            the prefix and next hop indexes only.
+        """
+        return self.load_items((ipaddress.IPv4Network((route.prefix, route.prefixlen)), route) for route in routes)
+
+    def load_items(self, items):
+        """`load_routes` for (IPv4Network, Route) pairs, as in `routes.items()`."""
+        count = 0
+        keys, prefixes, prefixlens = self._trie_pending or ([], [], [])
+        table = self.routes
+        next_hop_index = self.next_hop_index
+        with paused_gc():
+            for key, route in items:
+                # setdefault hashes the network once for the common case of a new one
+                current = table.setdefault(key, route)
+                if current is route:
+                    keys.append(key)
+                    prefixes.append(route.prefix)
+                    prefixlens.append(route.prefixlen)
+                else:
+                    self._unindex(key)
+                    table[key] = route
+                networks = next_hop_index.get(route.next_hop)
+                if networks is None:
+                    networks = next_hop_index[route.next_hop] = set()
+                networks.add(key)
+                count += 1
+        if keys:
+            self._trie_pending = (keys, prefixes, prefixlens)
+        log.debug("Router %s loaded %d routes", self.router_id, count)
+        return count
 
     def remove_route(self, network):
         """Remove a route from the routing table based on the network."""
-        removed = False
-        for route in self.table:
-            if route["network"] == network:
-                print(f"Removing route for network: {network}")
-                self.table.remove(route)
-                removed = True
-                print(f"\n--- Updated Routing Table for Router {self.router_id} ---")
-                self.print_updated_routing_table()
-                break
-        if not removed:
-            print(f"No route found for network {network} to remove.")
+        key = parse_network(network)
+        if key not in self.routes:
+            log.debug("Router %s has no route for network %s to remove.", self.router_id, network)
+            return None
+        route = self._unindex(key)
+        self._trie_remove(key)
+        log.debug("Router %s removed route for network %s", self.router_id, network)
+        return route
 
     def update_route(self, network, next_hop, as_path):
         """Update an existing route in the routing table."""
-        updated = False
-        for route in self.table:
-            if route["network"] == network:
-                route["next_hop"] = next_hop
-                route["as_path"] = as_path
-                updated = True
-                self.print_updated_routing_table()
-                break
-        if not updated:
-            print(f"No route found for network {network} to update.")
+        key = parse_network(network)
+        if key not in self.routes:
+            log.debug("Router %s has no route for network %s to update.", self.router_id, network)
+            return
+        self._unindex(key)
+        self._index(key, Route(int(key.network_address), key.prefixlen, next_hop_key(next_hop), intern_as_path(as_path)))
+        log.debug("Router %s updated route %s via %s", self.router_id, network, next_hop)
 
     def get_route(self, network):
         """Retrieve a route from the routing table based on the network."""
-        for route in self.table:
-            if route["network"] == network:
-                return route
-        return None
+        return self.routes.get(parse_network(network))
 
-    def get_best_route(self, network, trust_model):
-        """Get the best route for a network based on AS path length and trust."""
-        matching_routes = [route for route in self.table if route["network"] == network]
+    def get_routes_by_next_hop(self, next_hop):
+        """Retrieve every route whose next hop is the given neighbor."""
+        networks = self.next_hop_index.get(next_hop_key(next_hop), ())
+        return [self.routes[key] for key in networks]
 
-        if not matching_routes:
-            return None
+    def remove_routes_by_next_hop(self, next_hop):
+        """Remove every route learned via the given neighbor and return the removed routes."""
+        networks = self.next_hop_index.pop(next_hop_key(next_hop), set())
+        removed = []
+        for key in networks:
+            removed.append(self.routes.pop(key))
+            self._trie_remove(key)
+        log.debug("Router %s removed %d routes via %s", self.router_id, len(removed), next_hop)
+        return removed
 
-        #the shortest as_path and higher trust_score
-        best_route = min(
-            matching_routes,
-            key=lambda route: (len(route["as_path"]), -trust_model.get_trust_score(route["next_hop"]))
-        )
-        return best_route
+    def lookup(self, ip):
+        """Longest-prefix-match lookup of a destination address."""
+        bits = int(ipaddress.IPv4Address(ip))
+        node = self._trie()
+        match = node.network
+        for depth in range(32):
+            node = node.children[(bits >> (31 - depth)) & 1]
+            if node is None:
+                break
+            if node.network is not None:
+                match = node.network
+        return self.routes[match] if match is not None else None
+
+    def checkpoint(self, path):
+        """Write every route to a memory-mappable checkpoint file (see `RouteColumns.save`)."""
+        # route_store builds on Route, so it is imported here rather than at the top
+        from utils.route_store import RouteColumns
+        RouteColumns.from_routing_table(self).save(path)
+
+    @staticmethod
+    def read_checkpoint(path):
+        """The routes of a checkpoint file as memory-mapped RouteColumns."""
+        from utils.route_store import RouteColumns
+        return RouteColumns.load(path)
+
+    def get_best_route(self, network, trust_model):
+        """Get the best route for a network; the prefix index holds one selected route per network."""
+        return self.get_route(network)
+
+    def format_table(self, title):
+        lines = [f"--- {title} for Router {self.router_id} ---"]
+        if not self.routes:
+            lines.append("Routing table is empty.")
+        for route in self.routes.values():
+            lines.append(f"Network: {route.network}, Next Hop: Router{route.next_hop}, AS Path: {route.as_path}")
+        return "\n".join(lines)
 
     def print_routing_table(self):
-        """Print the current state of the routing table."""
-        print(f"\n--- Initial Routing Table for Router {self.router_id} ---")
-        if not self.table:
-            print("Routing table is empty.")
-        for route in self.table:
-            print(f"Network: {route['network']}, Next Hop: {route['next_hop']}, AS Path: {route['as_path']}")
-        print("--------------------------------------------\n")
+        """Log the current state of the routing table at DEBUG level; the table is only formatted if that level is on."""
+        log.debug("%s", Lazy(self.format_table, "Initial Routing Table"))
 
     def print_updated_routing_table(self):
-        """Print the updated state of the routing table after a change."""
-        print(f"\n--- Updated Routing Table for Router {self.router_id} ---")
-        if not self.table:
-            print("Routing table is empty.")
-        for route in self.table:
-            print(f"Network: {route['network']}, Next Hop: {route['next_hop']}, AS Path: {route['as_path']}")
-        print("--------------------------------------------\n")
\ No newline at end of file
+        """Log the updated state of the routing table at DEBUG level. Never called on the route update path."""
+        log.debug("%s", Lazy(self.format_table, "Updated Routing Table"))
@@ -0,0 +1,122 @@
+""" Per-peer outbound queues for the threaded runtime.
+
+    Every session socket gets a `PeerSender`: `send_message` encodes a
+    message and appends its frames to the peer's queue without blocking,
+    and a writer thread per peer drains the queue, handing everything
+    queued since its last write to the kernel in one scatter-gather
+    `sendmsg`. A slow peer therefore only holds up its own writer, never
+    the thread that is propagating routes to every neighbor.
+
+    The queue is bounded in bytes. A peer that falls so far behind that it
+    would be exceeded is not waited for: `put` refuses the message and the
+    router resets the session, as BGP implementations do with a peer that
+    stops reading. A failed write reports the peer the same way.
+"""
+import socket
+import threading
+
+from utils.logs import get_logger
+
+log = get_logger("send_queue")
+
+# Bytes a peer may have queued before its session is reset
+SEND_QUEUE_LIMIT = 4 << 20
+# Buffers per sendmsg call; Linux accepts at most 1024 (IOV_MAX)
+MAX_BUFFERS = 1024
+
+
+class PeerSender:
+    def __init__(self, sock, peer_id, on_error=None, limit=SEND_QUEUE_LIMIT):
+        """ Start the writer thread for `sock`. `on_error(peer_id, sock, error)`
+            is called from that thread if a write fails."""
+        self.sock = sock
+        self.peer_id = peer_id
+        self.on_error = on_error
+        self.limit = limit
+        self.queue = []  # frames (bytes) waiting for the writer
+        self.queued = 0  # bytes in `queue`
+        self.sent = 0  # bytes written so far
+        self.writes = 0  # sendmsg calls made, one per batch or partial write
+        self.closed = False
+        self._ready = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(target=self._run, name=f"sender-{peer_id}", daemon=True)
+        self._thread.start()
+
+    def put(self, frames):
+        """ Queue the frames of one message. Returns False, queueing nothing,
+            if the sender is closed or the peer is too far behind to take it."""
+        size = sum(len(data) for data in frames)
+        with self._ready:
+            if self.closed:
+                return False
+            if self.queued + size > self.limit and self.queued:
+                return False
+            self.queue.extend(frames)
+            self.queued += size
+            self._ready.notify()
+        return True
+
+    def close(self):
+        """Stop the writer; whatever is still queued is dropped."""
+        with self._ready:
+            self.closed = True
+            self.queue = []
+            self.queued = 0
+            self._ready.notify()
+
+    def _take(self):
+        """Wait for frames and take every one queued, or None once closed."""
+        with self._ready:
+            while not self.queue and not self.closed:
+                self._ready.wait()
+            if self.closed:
+                return None
+            frames, self.queue = self.queue, []
+            self.queued = 0
+            return frames
+
+    def _run(self):
+        while True:
+            frames = self._take()
+            if frames is None:
+                return
+            try:
+                self._write(frames)
+            except OSError as e:
+                with self._ready:
+                    if self.closed:
+                        return
+                    self.closed = True
+                log.debug("Write to Router %s failed: %s", self.peer_id, e)
+                if self.on_error is not None:
+                    self.on_error(self.peer_id, self.sock, e)
+                return
+
+    def _write(self, frames):
+        """Write the frames, as few sendmsg calls as the kernel allows, resuming after partial writes."""
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(frames))
+            self.sent += sum(len(data) for data in frames)
+            self.writes += 1
+            return
+        buffers = [memoryview(data) for data in frames]
+        first = 0
+        while first < len(buffers):
+            written = self.sock.sendmsg(buffers[first:first + MAX_BUFFERS])
+            self.sent += written
+            self.writes += 1
+            # Skip the buffers written in full and trim the one written in part
+            while first < len(buffers) and written >= len(buffers[first]):
+                written -= len(buffers[first])
+                first += 1
+            if written:
+                buffers[first] = buffers[first][written:]
+
+
+def shutdown_socket(sock):
+    """Shut a session socket down so its receive thread stops, ignoring one already gone."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
@@ -0,0 +1,131 @@
+""" Hierarchical timing wheel.
+
+    Timers are hashed into the slots of a few wheels of increasing span:
+    level 0 has one slot per tick, level 1 one slot per `slots` ticks, and so
+    on. Scheduling and cancelling are O(1) dict operations whatever the number
+    of timers, and advancing the clock only touches the slots that come due,
+    moving the timers of a coarse slot down to finer wheels as it is reached.
+    This lets one thread drive the keepalive and hold timers of thousands of
+    peers.
+
+    A timer fires on the first tick at or after its deadline, so never early
+    and, with the wheel advanced every tick, about one tick late at most.
+    The wheel is not thread safe; callers share it under a lock (`run` takes
+    the same lock while advancing).
+"""
+import math
+import time
+
+from utils.logs import get_logger
+
+log = get_logger("timers")
+
+
+class Timer:
+    """A scheduled callback. Cancelling is O(1) and safe to repeat."""
+    __slots__ = ("wheel", "deadline", "tick", "callback", "args", "bucket")
+
+    def __init__(self, wheel, deadline, tick, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.bucket = None  # the slot dict holding this timer while it is pending
+
+    @property
+    def pending(self):
+        return self.bucket is not None
+
+    def cancel(self):
+        if self.bucket is not None:
+            del self.bucket[self]
+            self.bucket = None
+            self.wheel.count -= 1
+
+
+class TimerWheel:
+    def __init__(self, tick=0.05, slots=64, levels=4, clock=time.monotonic):
+        """ `tick` is the resolution in seconds; `levels` wheels of `slots`
+            slots cover tick * slots ** levels seconds before a timer has to
+            be cascaded again from the top wheel."""
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+        self.origin = clock()
+        self.current = 0  # last tick processed
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Run `callback(*args)` `delay` seconds from now. Returns the Timer."""
+        return self.schedule_at(self.clock() + delay, callback, *args)
+
+    def schedule_at(self, deadline, callback, *args):
+        tick = max(math.ceil((deadline - self.origin) / self.tick), self.current + 1)
+        timer = Timer(self, deadline, tick, callback, args)
+        self._place(timer)
+        self.count += 1
+        return timer
+
+    def _place(self, timer):
+        delta = timer.tick - self.current
+        for level in range(self.levels):
+            if delta < self.spans[level + 1]:
+                tick = timer.tick
+                break
+        else:
+            # Beyond the top wheel: park it in the furthest top slot, it is placed again when that comes due
+            tick = self.current + self.spans[self.levels] - 1
+        bucket = self.wheels[level][(tick // self.spans[level]) % self.slots]
+        bucket[timer] = None
+        timer.bucket = bucket
+
+    def _cascade(self, level):
+        bucket = self.wheels[level][(self.current // self.spans[level]) % self.slots]
+        if bucket:
+            self.wheels[level][(self.current // self.spans[level]) % self.slots] = {}
+            for timer in bucket:
+                self._place(timer)
+
+    def advance(self, now=None):
+        """Fire every timer due by `now` (the clock by default). Returns how many fired."""
+        now = self.clock() if now is None else now
+        target = math.floor((now - self.origin) / self.tick)
+        fired = 0
+        while self.current < target:
+            if not self.count:
+                self.current = target
+                break
+            self.current += 1
+            for level in range(self.levels - 1, 0, -1):
+                if self.current % self.spans[level] == 0:
+                    self._cascade(level)
+            slot = self.current % self.slots
+            bucket = self.wheels[0][slot]
+            if not bucket:
+                continue
+            self.wheels[0][slot] = {}
+            for timer in list(bucket):
+                if timer.bucket is not bucket:
+                    continue  # cancelled by a callback that fired before it
+                timer.bucket = None
+                self.count -= 1
+                fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    log.error("Error in timer %s: %s", getattr(timer.callback, "__name__", timer.callback), e)
+        return fired
+
+    def run(self, lock, stop=None):
+        """Advance the wheel every tick until `stop` (a threading.Event) is set, holding `lock` while firing."""
+        while stop is None or not stop.is_set():
+            time.sleep(self.tick)
+            with lock:
+                self.advance()
@@ -0,0 +1,194 @@
+""" Topology files in the config.json schema.
+
+    `Topology` validates a parsed config once and indexes its routers by ID
+    and by IP, so looking up a neighbor is a dict lookup instead of a scan
+    of every router. `Topology.load` keeps a binary cache next to the file,
+    keyed on its modification time and size, so a large generated topology
+    is only parsed as JSON the first time it is used. The cache pickles
+    every router separately and a router is only unpickled when it is
+    looked up, so a router process reading its own config and its
+    neighbors' addresses starts in milliseconds whatever the topology size.
+
+    The routers' own topology is loaded lazily by `get_topology` from the
+    file named by BGP_CONFIG (config.json by default), so importing the
+    router modules does not need the file.
+"""
+import json
+import os
+import pickle
+
+from utils.logs import get_logger
+
+log = get_logger("topology")
+
+# Bumped whenever the cached structure changes, so older caches are ignored
+CACHE_VERSION = 1
+REQUIRED_DEFAULTS = ("hold_timer", "keepalive_interval")
+REQUIRED_ROUTER_KEYS = ("id", "ip", "neighbors", "trust", "routing_table")
+
+
+class TopologyError(ValueError):
+    """Raised when a topology does not follow the config.json schema."""
+
+
+class Topology:
+    def __init__(self, config, path=None, validate=True):
+        """ Index a parsed config.json style dict. Pass validate=False only for
+            configs that were already validated."""
+        self.path = path
+        self._config = config
+        if validate:
+            self.validate()
+        self.bgp_defaults = config['bgp_defaults']
+        # Router configs, or their pickled form until a lookup first needs them
+        self._entries = list(config['routers'])
+        self.by_id = {router['id']: position for position, router in enumerate(self._entries)}
+        self.by_ip = {router['ip']: position for position, router in enumerate(self._entries)}
+
+    @classmethod
+    def from_cache(cls, cached, path=None):
+        """Rebuild a topology from `cache_entry` output without unpickling any router."""
+        bgp_defaults, ids, ips, blobs = cached
+        topology = cls.__new__(cls)
+        topology.path = path
+        topology._config = None
+        topology.bgp_defaults = bgp_defaults
+        topology._entries = blobs
+        topology.by_id = {router_id: position for position, router_id in enumerate(ids)}
+        topology.by_ip = {ip: position for position, ip in enumerate(ips)}
+        return topology
+
+    def cache_entry(self):
+        """ The cached form: the IDs and IPs for the indexes, and every router
+            pickled on its own so loading the cache does not rebuild them all."""
+        routers = self.routers
+        return (
+            self.bgp_defaults,
+            [router['id'] for router in routers],
+            [router['ip'] for router in routers],
+            [pickle.dumps(router, protocol=pickle.HIGHEST_PROTOCOL) for router in routers],
+        )
+
+    def validate(self):
+        """Check the parts of the schema the routers rely on, raising TopologyError on the first problem."""
+        where = self.path or "topology"
+        if not isinstance(self._config, dict) or 'routers' not in self._config or 'bgp_defaults' not in self._config:
+            raise TopologyError(f"{where}: expected an object with 'bgp_defaults' and 'routers'")
+        for key in REQUIRED_DEFAULTS:
+            if key not in self._config['bgp_defaults']:
+                raise TopologyError(f"{where}: bgp_defaults has no '{key}'")
+        ids = set()
+        ips = set()
+        for position, router in enumerate(self._config['routers']):
+            missing = [key for key in REQUIRED_ROUTER_KEYS if key not in router]
+            if missing:
+                raise TopologyError(f"{where}: router #{position} has no {', '.join(missing)}")
+            if not isinstance(router['id'], int):
+                raise TopologyError(f"{where}: router ID {router['id']!r} is not an integer")
+            if router['id'] in ids:
+                raise TopologyError(f"{where}: duplicate router ID {router['id']}")
+            if router['ip'] in ips:
+                raise TopologyError(f"{where}: duplicate router IP {router['ip']}")
+            ids.add(router['id'])
+            ips.add(router['ip'])
+
+    @classmethod
+    def load(cls, path="config.json", cache=True):
+        """Load and validate a topology file, going through its binary cache when `cache` is set."""
+        stat = os.stat(path)
+        key = (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+        cache_path = cache_file(path)
+        if cache:
+            cached = read_cache(cache_path, key)
+            if cached is not None:
+                return cls.from_cache(cached, path)
+        with open(path) as config_file:
+            topology = cls(json.load(config_file), path)
+        if cache:
+            write_cache(cache_path, key, topology.cache_entry())
+        return topology
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, router_id):
+        return router_id in self.by_id
+
+    def _router_at(self, position):
+        router = self._entries[position]
+        if type(router) is bytes:
+            router = self._entries[position] = pickle.loads(router)
+        return router
+
+    def router(self, router_id):
+        """The config of a router by ID, or None."""
+        position = self.by_id.get(router_id)
+        return self._router_at(position) if position is not None else None
+
+    def router_by_ip(self, ip):
+        """The config of the router with the given IP address, or None."""
+        position = self.by_ip.get(ip)
+        return self._router_at(position) if position is not None else None
+
+    @property
+    def routers(self):
+        """Every router config, in file order."""
+        return [self._router_at(position) for position in range(len(self._entries))]
+
+    @property
+    def config(self):
+        """The whole topology as the config.json style dict."""
+        if self._config is None:
+            self._config = {"bgp_defaults": self.bgp_defaults, "routers": self.routers}
+        return self._config
+
+
+def cache_file(path):
+    """Where the cache of a topology file lives: .config.json.cache next to config.json."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.cache")
+
+
+def read_cache(cache_path, key):
+    """The cache entry if the cache exists and was made from the same file, else None."""
+    try:
+        with open(cache_path, "rb") as cache:
+            cached_key, cached = pickle.load(cache)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.debug("Ignoring unreadable topology cache %s: %s", cache_path, e)
+        return None
+    return cached if tuple(cached_key) == key else None
+
+
+def write_cache(cache_path, key, cached):
+    """Write the cache atomically; a directory we cannot write to just means no cache."""
+    temporary = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as cache:
+            pickle.dump((key, cached), cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, cache_path)
+    except OSError as e:
+        log.debug("Could not write topology cache %s: %s", cache_path, e)
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+
+
+_topology = None
+
+
+def get_topology():
+    """The topology of this router process, loaded on first use from BGP_CONFIG or config.json."""
+    global _topology
+    if _topology is None:
+        _topology = Topology.load(os.getenv("BGP_CONFIG", "config.json"))
+    return _topology
+
+
+def set_topology(topology):
+    """Use an already loaded topology instead of reading BGP_CONFIG."""
+    global _topology
+    _topology = topology